@@ -1,10 +1,14 @@
 from datetime import datetime
-import re
 from argparse import Namespace, ArgumentParser
 from os.path import join
 from typing import Optional, Sequence, Dict
 
-from luh3417.luhfs import Location, parse_location
+from luh3417.luhfs import (
+    COMPRESSION_MODES,
+    Location,
+    apply_compression_suffix,
+    parse_location,
+)
 from luh3417.luhsql import create_from_source
 from luh3417.restore import read_config
 from luh3417.utils import setup_logging, make_doer, run_main
@@ -57,11 +61,19 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
     parser.add_argument(
         "-c",
         "--compression-mode",
-        help="Compression mode for tar (gzip, bzip2, lzip, xz). Defaults to: gzip",
+        help=(
+            "Compression mode for tar. pigz, pbzip2, xz-mt and zstd-mt are "
+            "multi-threaded. Defaults to: gzip"
+        ),
         default="gzip",
         const="gzip",
         nargs="?",
-        choices=["gzip", "bzip2", "lzip", "xz"],
+        choices=COMPRESSION_MODES,
+    )
+    parser.add_argument(
+        "--compression-level",
+        help="Compression level. Defaults to the compression program's default",
+        type=int,
     )
 
     parser.add_argument(
@@ -77,15 +89,12 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
     parsed_args = parser.parse_args(args)
 
     # apply compression mode to file name template
-    if parsed_args.compression_mode == "bzip2":
-        parsed_args.file_name_template = re.sub(".gz", ".bz2", parsed_args.file_name_template)
-        parsed_args.backup_dir.set_compression_mode(parsed_args.compression_mode)
-    elif parsed_args.compression_mode == "lzip":
-        parsed_args.file_name_template = re.sub(".gz", ".lz", parsed_args.file_name_template)
-        parsed_args.backup_dir.set_compression_mode(parsed_args.compression_mode)
-    elif parsed_args.compression_mode == "xz":
-        parsed_args.file_name_template = re.sub(".gz", ".xz", parsed_args.file_name_template)
-        parsed_args.backup_dir.set_compression_mode(parsed_args.compression_mode)
+    parsed_args.file_name_template = apply_compression_suffix(
+        parsed_args.file_name_template, parsed_args.compression_mode
+    )
+    parsed_args.backup_dir.set_compression_mode(
+        parsed_args.compression_mode, parsed_args.compression_level
+    )
 
     return parsed_args
 
@@ -0,0 +1,125 @@
+import subprocess
+from argparse import ArgumentParser, Namespace
+from os.path import getsize, join
+from shutil import which
+from tempfile import TemporaryDirectory
+from time import monotonic
+from typing import Optional, Sequence
+
+from luh3417.luhfs import (
+    COMPRESSION_MODES,
+    get_codec,
+    get_compression_program,
+    get_decompression_program,
+)
+from luh3417.utils import LuhError, make_doer, run_main, setup_logging
+
+doing = make_doer("luh3417.benchmark_compression")
+
+
+def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
+    """
+    Parse arguments for the benchmark
+    """
+
+    parser = ArgumentParser(
+        description=(
+            "Compares the wall time and size of the archive of a sample tree "
+            "(by example a WordPress install) for each compression mode"
+        )
+    )
+
+    parser.add_argument("sample_dir", help="Directory to archive")
+
+    parser.add_argument(
+        "-c",
+        "--compression-mode",
+        help="Compression mode to test (can be repeated). Defaults to all of them",
+        action="append",
+        choices=COMPRESSION_MODES,
+    )
+
+    parser.add_argument(
+        "--compression-level",
+        help="Compression level. Defaults to the compression program's default",
+        type=int,
+    )
+
+    return parser.parse_args(args)
+
+
+def bench_mode(sample_dir, mode, level, work_dir):
+    """
+    Archives the sample dir with this compression mode then extracts it back,
+    returns the compression time, decompression time and archive size.
+    """
+
+    archive = join(work_dir, f"bench.tar{get_codec(mode).suffix}")
+    extract_dir = join(work_dir, mode)
+
+    start = monotonic()
+    cp = subprocess.run(
+        ["tar", "-C", sample_dir, "-c", "-I", get_compression_program(mode, level)]
+        + ["-f", archive, "."],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    compress_time = monotonic() - start
+
+    if cp.returncode:
+        raise LuhError(f"Could not compress with {mode}: {cp.stderr[:1000]}")
+
+    subprocess.run(["mkdir", "-p", extract_dir])
+
+    start = monotonic()
+    cp = subprocess.run(
+        ["tar", "-C", extract_dir, "-x", "-I", get_decompression_program(archive)]
+        + ["-f", archive],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    decompress_time = monotonic() - start
+
+    if cp.returncode:
+        raise LuhError(f"Could not decompress with {mode}: {cp.stderr[:1000]}")
+
+    size = getsize(archive)
+    subprocess.run(["rm", "-rf", archive, extract_dir])
+
+    return compress_time, decompress_time, size
+
+
+def main(args: Optional[Sequence[str]] = None):
+    """
+    Runs the benchmark for all the available compression programs
+    """
+
+    setup_logging()
+    args = parse_args(args)
+    modes = args.compression_mode or COMPRESSION_MODES
+    results = []
+
+    with TemporaryDirectory() as d:
+        for mode in modes:
+            program = get_codec(mode).command[0]
+
+            if not which(program):
+                doing.logger.warning("Skipping %s: %s is not installed", mode, program)
+                continue
+
+            with doing(f"Benchmarking {mode}"):
+                results.append(
+                    (mode,) + bench_mode(args.sample_dir, mode, args.compression_level, d)
+                )
+
+    print(f"{'mode':<10} {'compress':>10} {'decompress':>11} {'size (MiB)':>11}")
+
+    for mode, compress_time, decompress_time, size in results:
+        print(
+            f"{mode:<10} {compress_time:>9.2f}s {decompress_time:>10.2f}s "
+            f"{size / 1024 ** 2:>11.2f}"
+        )
+
+
+if __name__ == "__main__":
+    run_main(main, doing)
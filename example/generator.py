@@ -234,6 +234,25 @@ def get_wp_config(environment: Text):
     }
 
 
+def get_snapshot_limits(environment: Text):
+    """
+    OPTIONAL
+
+    Limits the impact of snapshots on an environment: commands run there get
+    a lower CPU/IO priority (`nice`, `ionice`) and the data read from it is
+    capped (`bwlimit`, in bytes per second, with K/M/G suffixes). See the
+    options of the same name of snapshot.
+
+    Production serves live traffic so it gets the lowest priority, other
+    environments are snapshotted as fast as possible.
+    """
+
+    if environment == "prod":
+        return {"nice": 19, "ionice": "idle", "bwlimit": "20M"}
+
+    return {}
+
+
 def get_git_version(environment: Text):
     """
     Utility method to determine the git branch depending on the environment.
@@ -29,7 +29,13 @@ setup(
     version="0.1.2",
     packages=find_packages("src"),
     package_dir={"": "src"},
-    scripts=["bin/luh3417_restore", "bin/luh3417_snapshot", "bin/luh3417_transfer"],
+    scripts=[
+        "bin/luh3417_prune",
+        "bin/luh3417_restore",
+        "bin/luh3417_snapshot",
+        "bin/luh3417_transfer",
+        "bin/luh3417_verify",
+    ],
     include_package_data=True,
     license="WTFPL",
     description="LUH3417, a WordPress backup/restore/workflow tool",
@@ -0,0 +1,307 @@
+import json
+import subprocess
+import tarfile
+import time
+from dataclasses import replace
+from hashlib import sha256
+from io import BytesIO
+from posixpath import normpath
+from shlex import quote, split
+from typing import BinaryIO, Dict, Optional, Text, Tuple
+
+from luh3417.luhfs import (
+    Location,
+    get_codec,
+    get_decompression_program,
+    guess_compression_mode,
+)
+from luh3417.utils import LuhError
+
+CHECKSUMS_NAME = "checksums.json"
+CHECKSUMS_SUFFIX = ".sha256.json"
+CHECKSUMS_ALGORITHM = "sha256"
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Run by python3 on the archive's host, see hash_archive_on_host()
+HASH_ARCHIVE_SCRIPT = f"""
+import hashlib, json, posixpath, sys, tarfile
+members, embedded = {{}}, None
+try:
+    with tarfile.open(fileobj=sys.stdin.buffer, mode="r|") as tar:
+        for member in tar:
+            if not member.isreg():
+                continue
+            fp = tar.extractfile(member)
+            if posixpath.normpath(member.name) == {CHECKSUMS_NAME!r}:
+                embedded = fp.read().decode("utf-8")
+                continue
+            h = hashlib.sha256()
+            for block in iter(lambda: fp.read({HASH_BUFFER_SIZE}), b""):
+                h.update(block)
+            members[member.name] = h.hexdigest()
+except tarfile.TarError as e:
+    sys.exit(f"corrupted: {{e}}")
+json.dump({{"members": members, "embedded": embedded}}, sys.stdout)
+"""
+
+
+class HashingReader:
+    """
+    File-like object which hashes what is read through it
+    """
+
+    def __init__(self, fp: BinaryIO):
+        self.fp = fp
+        self.hash = sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fp.read(size)
+        self.hash.update(data)
+
+        return data
+
+    def hexdigest(self) -> Text:
+        return self.hash.hexdigest()
+
+
+class ChecksumWriter:
+    """
+    Wraps a TarFile-like object (anything with an addfile() method) and
+    computes the SHA-256 of each file while it is written into the archive,
+    so that the content is read only once.
+
+    Once all members are written, close() appends the checksums to the
+    archive as a last member (`checksums.json`).
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.checksums: Dict[Text, Text] = {}
+
+    def addfile(self, tarinfo: tarfile.TarInfo, fileobj: Optional[BinaryIO] = None):
+        """
+        Adds a member to the archive, the same way as TarFile.addfile()
+        """
+
+        if fileobj is None or not tarinfo.isreg():
+            self.archive.addfile(tarinfo, fileobj)
+            return
+
+        reader = HashingReader(fileobj)
+        self.archive.addfile(tarinfo, reader)
+        self.checksums[tarinfo.name] = reader.hexdigest()
+
+    def close(self):
+        """
+        Writes the checksums into the archive
+        """
+
+        data = serialize_checksums(self.checksums)
+        info = tarfile.TarInfo(f"./{CHECKSUMS_NAME}")
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = int(time.time())
+        self.archive.addfile(info, BytesIO(data))
+
+
+def serialize_checksums(checksums: Dict[Text, Text]) -> bytes:
+    return json.dumps(
+        {"version": 1, "algorithm": CHECKSUMS_ALGORITHM, "members": checksums},
+        indent=1,
+    ).encode("utf-8")
+
+
+def parse_checksums(data: Text, source: Text) -> Dict[Text, Text]:
+    """
+    Decodes checksums which were serialized by serialize_checksums()
+    """
+
+    try:
+        content = json.loads(data)
+    except ValueError as e:
+        raise LuhError(f"Checksums of {source} are corrupted: {e}")
+
+    if content.get("algorithm") != CHECKSUMS_ALGORITHM:
+        raise LuhError(
+            f'Unsupported checksum algorithm in {source}: {content.get("algorithm")}'
+        )
+
+    return content["members"]
+
+
+def get_checksums_location(archive: Location) -> Location:
+    """
+    Location of the checksums which go next to an archive
+    """
+
+    return replace(archive, path=archive.path + CHECKSUMS_SUFFIX)
+
+
+def write_checksums(archive: Location, checksums: Dict[Text, Text]):
+    """
+    Writes the checksums next to the archive
+    """
+
+    get_checksums_location(archive).set_content(
+        serialize_checksums(checksums).decode("utf-8")
+    )
+
+
+def read_checksums(archive: Location) -> Optional[Dict[Text, Text]]:
+    """
+    Reads the checksums found next to this archive, if there are some
+    """
+
+    location = get_checksums_location(archive)
+
+    if not location.exists():
+        return None
+
+    return parse_checksums(location.get_content(), f"{location}")
+
+
+def hash_file(fp: BinaryIO) -> Text:
+    h = sha256()
+
+    for block in iter(lambda: fp.read(HASH_BUFFER_SIZE), b""):
+        h.update(block)
+
+    return h.hexdigest()
+
+
+def hash_archive(archive: Location) -> Tuple[Dict[Text, Text], Optional[Dict]]:
+    """
+    Reads the archive in a single streaming pass (nothing is extracted) and
+    hashes each of its files. Returns these checksums along with the ones
+    embedded in the archive (if any).
+
+    The archive is read on its own host, so that only the checksums go
+    through the network. If python3 isn't available there, the archive is
+    streamed to this machine instead.
+    """
+
+    if guess_compression_mode(archive.path) is None:
+        raise LuhError(f"Can't guess the compression of {archive}")
+
+    _, _, ret = archive.run_script("command -v python3")
+
+    if not ret:
+        return hash_archive_on_host(archive)
+
+    return hash_archive_locally(archive)
+
+
+def hash_archive_on_host(
+    archive: Location,
+) -> Tuple[Dict[Text, Text], Optional[Dict]]:
+    """
+    Decompresses (with a parallel decompressor if the host has one) and
+    hashes the archive on its host, with HASH_ARCHIVE_SCRIPT
+    """
+
+    codec = get_codec(guess_compression_mode(archive.path))
+    decompress = " ".join(quote(a) for a in codec.command + ["-d", "-c"])
+
+    if codec.parallel_decompress:
+        parallel = " ".join(
+            quote(a) for a in codec.parallel_decompress + ["-d", "-c"]
+        )
+        decompress = (
+            f"if command -v {quote(codec.parallel_decompress[0])} > /dev/null; "
+            f"then {parallel}; else {decompress}; fi"
+        )
+
+    out, err, ret = archive.run_script(
+        f"""
+            set -o pipefail
+            {{ {decompress}; }} < {quote(archive.path)} \\
+                | python3 -c {quote(HASH_ARCHIVE_SCRIPT)}
+        """
+    )
+
+    corrupted = [l for l in err.splitlines() if l.startswith("corrupted: ")]
+
+    if ret and corrupted:
+        raise LuhError(f"{archive} is corrupted: {corrupted[-1][11:]}")
+
+    if ret:
+        raise LuhError(f"Could not read or decompress {archive}: {err[:1000]}")
+
+    try:
+        content = json.loads(out)
+    except ValueError as e:
+        raise LuhError(f"Unexpected output while hashing {archive}: {e}")
+
+    embedded = None
+
+    if content["embedded"] is not None:
+        embedded = parse_checksums(
+            content["embedded"], f"{archive}:{CHECKSUMS_NAME}"
+        )
+
+    return content["members"], embedded
+
+
+def hash_archive_locally(
+    archive: Location,
+) -> Tuple[Dict[Text, Text], Optional[Dict]]:
+    """
+    Streams the archive to this machine where it is decompressed (with a
+    parallel decompressor if available) and hashed
+    """
+
+    program = get_decompression_program(archive.path)
+
+    if program is None:
+        raise LuhError(f"Can't guess the compression of {archive}")
+
+    reader = archive.popen(
+        ["cat", archive.path], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    decompress = subprocess.Popen(
+        split(program) + ["-d", "-c"],
+        stdin=reader.stdout,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    reader.stdout.close()
+
+    checksums = {}
+    embedded = None
+    error = None
+
+    try:
+        with tarfile.open(fileobj=decompress.stdout, mode="r|") as tar:
+            for member in tar:
+                if not member.isreg():
+                    continue
+
+                fp = tar.extractfile(member)
+
+                if normpath(member.name) == CHECKSUMS_NAME:
+                    embedded = parse_checksums(
+                        fp.read().decode("utf-8"), f"{archive}:{member.name}"
+                    )
+                else:
+                    checksums[member.name] = hash_file(fp)
+    except tarfile.TarError as e:
+        decompress.kill()
+        error = e
+    finally:
+        decompress.stdout.close()
+        decompress_err = decompress.stderr.read().decode("utf-8", "replace")
+        decompress.wait()
+        reader_err = reader.stderr.read().decode("utf-8", "replace")
+        reader.wait()
+
+    if reader.returncode:
+        raise LuhError(f"Could not read {archive}: {reader_err[:1000]}")
+
+    if error is not None:
+        raise LuhError(f"{archive} is corrupted: {error}")
+
+    if decompress.returncode:
+        raise LuhError(f"Could not decompress {archive}: {decompress_err[:1000]}")
+
+    return checksums, embedded
@@ -1,19 +1,37 @@
 import re
 import subprocess
+from contextlib import contextmanager
 from dataclasses import dataclass, replace
+from os.path import getsize
 from pathlib import Path
 from posixpath import join
 from shlex import quote
+from shutil import which
 from subprocess import CompletedProcess, Popen
-from typing import Text, Tuple
-
+from typing import (
+    IO,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Text,
+    Tuple,
+)
+
+from luh3417.luhmeter import Meter, MeteredPipe, relay
+from luh3417.luhresume import ResumableUpload, Retry, download_resumable
 from luh3417.luhssh import SshManager
+from luh3417.luhthrottle import Throttle
 from luh3417.utils import LuhError
 
 SSH_RE = re.compile(r"^([a-zA-Z0-9_-]+)@((?:[a-zA-Z0-9-]+\.)*(?:[a-zA-Z0-9-]+)):(\d*)(.*)$")
 
 
-def parse_location(location: Text, compression: Text = "gzip") -> "Location":
+def parse_location(
+    location: Text, compression: Text = "gzip", compression_level: Optional[int] = None
+) -> "Location":
     """
     Guess the location type and generates the appropriate object
     """
@@ -25,20 +43,159 @@ def parse_location(location: Text, compression: Text = "gzip") -> "Location":
         if port == '':
             port = None
         return SshLocation(user=sm.group(1), host=sm.group(2), port=port, path=sm.group(4),
-                           compression_mode=compression)
+                           compression_mode=compression,
+                           compression_level=compression_level)
+    else:
+        return LocalLocation(
+            path=location,
+            compression_mode=compression,
+            compression_level=compression_level,
+        )
+
+
+@dataclass
+class Codec:
+    """
+    A compression program usable by tar (through `-I`) or in a pipe
+    """
+
+    command: List[Text]
+    suffix: Text
+    max_level: int = 9
+    parallel_decompress: Optional[List[Text]] = None
+
+
+COMPRESSION_CODECS: Dict[Text, Codec] = {
+    "gzip": Codec(["gzip"], ".gz", parallel_decompress=["pigz"]),
+    "pigz": Codec(["pigz"], ".gz"),
+    "bzip2": Codec(["bzip2"], ".bz2", parallel_decompress=["pbzip2"]),
+    "pbzip2": Codec(["pbzip2"], ".bz2"),
+    "xz": Codec(["xz"], ".xz", parallel_decompress=["xz", "-T0"]),
+    "xz-mt": Codec(["xz", "-T0"], ".xz"),
+    "lzip": Codec(["lzip"], ".lz"),
+    "zstd": Codec(["zstd", "-q"], ".zst", 19, ["zstd", "-q", "-T0"]),
+    "zstd-mt": Codec(["zstd", "-q", "-T0"], ".zst", 19),
+}
+
+COMPRESSION_MODES = list(COMPRESSION_CODECS.keys())
+
+
+def get_codec(compression_mode: Text) -> Codec:
+    """
+    Returns the codec for this compression mode, gzip being the default
+    """
+
+    return COMPRESSION_CODECS.get(compression_mode, COMPRESSION_CODECS["gzip"])
+
+
+def get_compression_command(
+    compression_mode: Text, compression_level: Optional[int] = None
+) -> List[Text]:
+    """
+    Generates the command which compresses stdin to stdout
+    """
+
+    codec = get_codec(compression_mode)
+    command = list(codec.command)
+
+    if compression_level is not None:
+        level = max(1, min(codec.max_level, compression_level))
+        command.append(f"-{level}")
+
+    return command
+
+
+def get_compression_program(
+    compression_mode: Text, compression_level: Optional[int] = None
+) -> Text:
+    """
+    Generates the value of tar's `-I` option for this compression mode
+    """
+
+    return " ".join(get_compression_command(compression_mode, compression_level))
+
+
+def guess_compression_mode(path: Text) -> Optional[Text]:
+    """
+    Guesses the compression mode of an archive from its file name, returns
+    None if it can't be guessed
+    """
+
+    for mode, codec in COMPRESSION_CODECS.items():
+        if path.endswith(codec.suffix):
+            return mode
+
+
+def get_decompression_program(path: Text) -> Optional[Text]:
+    """
+    Generates the value of tar's `-I` option to decompress the archive found
+    at this path. If available locally, a parallel decompressor is preferred.
+    Returns None when the format can't be guessed, in which case tar should
+    detect it by itself.
+    """
+
+    mode = guess_compression_mode(path)
+
+    if mode is None:
+        return None
+
+    codec = get_codec(mode)
+    command = codec.command
+
+    if codec.parallel_decompress and which(codec.parallel_decompress[0]):
+        command = codec.parallel_decompress
+
+    return " ".join(command)
+
+
+def get_decompression_args(path: Text) -> List[Text]:
+    """
+    Generates the tar arguments to decompress the archive at this path
+    """
+
+    program = get_decompression_program(path)
+
+    if program:
+        return ["-I", program]
     else:
-        return LocalLocation(path=location, compression_mode=compression)
+        return ["-a"]
+
+
+def get_portable_decompression_args(path: Text) -> List[Text]:
+    """
+    Same as get_decompression_args() but only relying on the regular
+    (single-threaded) tools, for a tar which runs on another machine and
+    reads the archive from a pipe
+    """
+
+    mode = guess_compression_mode(path)
+
+    if mode is None:
+        return []
+
+    return ["-I", " ".join(get_codec(mode).command)]
+
+
+def apply_compression_suffix(template: Text, compression_mode: Text) -> Text:
+    """
+    Replaces the `.gz` at the end of a file name template by the suffix of the
+    compression mode
+    """
 
+    return re.sub(r"\.gz$", get_codec(compression_mode).suffix, template)
 
-def get_compression_switch(compression_mode: Text):
-    if compression_mode == "bzip2":
-        return "-j"
-    elif compression_mode == "xz":
-        return "-J"
-    elif compression_mode == "lzip":
-        return "--lzip"
-    else:  # default: gzip
-        return "-z"
+
+def replace_archive_suffix(template: Text, suffix: Text) -> Text:
+    """
+    Replaces the archive extension (`.tar.gz`, `.gz`) at the end of a file
+    name template by another suffix, for snapshots which are not archives
+    """
+
+    for ext in [".tar.gz", ".gz"]:
+        if template.endswith(ext):
+            return template[: -len(ext)] + suffix
+
+    return template + suffix
 
 
 @dataclass
@@ -59,9 +216,11 @@ class Location:
 
         raise NotImplementedError
 
-    def set_compression_mode(self, compression_mode: Text):
+    def set_compression_mode(
+        self, compression_mode: Text, compression_level: Optional[int] = None
+    ):
         """
-        Set compression mode
+        Set compression mode (and level, None being the codec's default)
         """
 
         raise NotImplementedError
@@ -95,10 +254,13 @@ class Location:
 
         raise NotImplementedError
 
-    def archive_local_dir(self, local_path, doing) -> None:
+    def archive_local_dir(
+        self, local_path, doing, expected_size: Optional[int] = None
+    ) -> None:
         """
         Puts all the content of `local_path` into a TAR/GZ archive at the
-        current location.
+        current location. The expected size of the archive (if known) is
+        used to log an ETA.
 
         Beware it's probably the opposite of what you imagined (:
         """
@@ -113,6 +275,80 @@ class Location:
 
         raise NotImplementedError
 
+    def writer_popen(self, stdin: IO) -> Popen:
+        """
+        Starts a process which writes whatever comes from stdin into the file
+        at this location
+        """
+
+        raise NotImplementedError
+
+    def popen(self, args, *p_args, **kwargs) -> Popen:
+        """
+        Starts a process on the machine targeted by this location. Same
+        arguments as Popen().
+        """
+
+        raise NotImplementedError
+
+    def throttled(self, args: Sequence[Text]) -> List[Text]:
+        """
+        Applies the throttle of this location (if any) to a command
+        """
+
+        throttle = getattr(self, "throttle", None)
+
+        return throttle.wrap(args) if throttle else list(args)
+
+    @contextmanager
+    def open_archive_stream(
+        self, doing, expected_size: Optional[int] = None
+    ) -> Iterator[BinaryIO]:
+        """
+        Opens a stream into which a TAR archive can be written. The archive
+        gets compressed and written on the fly at the current location, so
+        there is no need to stage its content on the local disk.
+        """
+
+        doing.logger.debug("Compression mode: %s", self.compression_mode)
+        compress_args = get_compression_command(
+            self.compression_mode, self.compression_level
+        )
+        doing.logger.debug("Compression command: %s", compress_args)
+
+        compress = subprocess.Popen(
+            compress_args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        pipe = MeteredPipe(compress.stdout, f"Writing {self}", expected_size)
+        writer = self.writer_popen(pipe.stdin)
+        pipe.start(writer)
+
+        if not pipe.meter:
+            compress.stdout.close()
+
+        try:
+            yield compress.stdin
+        finally:
+            try:
+                compress.stdin.close()
+            except BrokenPipeError:
+                pass
+
+            pipe.join()
+            writer_err = writer.stderr.read()
+            writer.wait()
+            compress_err = compress.stderr.read()
+            compress.wait()
+
+        if writer.returncode:
+            raise LuhError(f"Could not write archive {self}: {writer_err}")
+
+        if compress.returncode:
+            raise LuhError(f"Could not compress the archive: {compress_err}")
+
     def run_script(self, script: Text) -> Tuple[Text, Text, int]:
         """
         Runs the provided script with bash, on the machine targeted by this
@@ -181,14 +417,30 @@ class Location:
         Generates the equivalent rsync path for this location
         """
 
-        path = f"{self}"
+        path = self.path
 
         if as_dir and (not path or path[-1] != "/"):
             path += "/"
         elif not as_dir and path and path[-1] == "/":
             path = path[0:-1]
 
-        return path
+        return self.rsync_host() + path
+
+    def rsync_host(self) -> Text:
+        """
+        Prefix of rsync paths, designating the host
+        """
+
+        return ""
+
+    def rsync_shell(self, dedicated: bool = False) -> Optional[Text]:
+        """
+        Remote shell to be used by rsync (with its `-e` option) to reach this
+        location, if any. A dedicated shell doesn't go through the shared
+        connection.
+        """
+
+        return None
 
 
 @dataclass
@@ -202,9 +454,31 @@ class SshLocation(Location):
     port: Text
     path: Text
     compression_mode: Text
+    compression_level: Optional[int] = None
+    throttle: Optional[Throttle] = None
 
     def __str__(self):
-        return f"{self.user}@{self.host}:{self.port}{self.path}"
+        return f"{self.user}@{self.host}:{self.port or ''}{self.path}"
+
+    def rsync_host(self) -> Text:
+        """
+        The port can't be specified here, see rsync_shell()
+        """
+
+        return f"{self.user}@{self.host}:"
+
+    def rsync_shell(self, dedicated: bool = False) -> Optional[Text]:
+        """
+        Re-uses the SSH master connection, unless a connection of its own is
+        required
+        """
+
+        manager = SshManager.instance(self.user, self.host, self.port)
+
+        if dedicated:
+            return " ".join(manager.get_dedicated_args([])[:-1])
+
+        return " ".join(manager.get_args([])[:-1])
 
     @property
     def ssh_target(self):
@@ -225,7 +499,9 @@ class SshLocation(Location):
 
         kwargs = dict(kwargs, encoding="utf-8")
 
-        new_args = SshManager.instance(self.user, self.host, self.port).get_args(args)
+        new_args = SshManager.instance(self.user, self.host, self.port).get_args(
+            self.throttled(args)
+        )
 
         cp = subprocess.run(new_args, *p_args, **kwargs)
 
@@ -242,7 +518,9 @@ class SshLocation(Location):
         that the SSH command will be prepended to the args.
         """
 
-        new_args = SshManager.instance(self.user, self.host, self.port).get_args(args)
+        new_args = SshManager.instance(self.user, self.host, self.port).get_args(
+            self.throttled(args)
+        )
 
         cp = subprocess.Popen(new_args, *p_args, **kwargs)
 
@@ -253,6 +531,13 @@ class SshLocation(Location):
 
         return cp
 
+    def popen(self, args, *p_args, **kwargs) -> Popen:
+        """
+        Same as ssh_popen()
+        """
+
+        return self.ssh_popen(args, *p_args, **kwargs)
+
     def get_content(self) -> Text:
         """
         Uses a remote cat to get the content
@@ -272,8 +557,11 @@ class SshLocation(Location):
 
         return cp.stdout
 
-    def set_compression_mode(self, compression_mode: Text):
+    def set_compression_mode(
+        self, compression_mode: Text, compression_level: Optional[int] = None
+    ):
         self.compression_mode = compression_mode
+        self.compression_level = compression_level
 
     def delete_dir_content(self) -> None:
         """
@@ -303,29 +591,42 @@ class SshLocation(Location):
         if cp.returncode:
             raise LuhError(f"Could not create {self} as a directory: {cp.stderr}")
 
-    def archive_local_dir(self, local_path: Text, doing):
+    def archive_local_dir(
+        self, local_path: Text, doing, expected_size: Optional[int] = None
+    ):
         """
         Generates the archive locally and pipe it to a remote dd to write it
         on disk on the other side
         """
 
         doing.logger.debug("Compression mode: %s", self.compression_mode)
-        compression_switch = get_compression_switch(self.compression_mode)
-        doing.logger.debug("Compression switch: %s", compression_switch)
+        compression_program = get_compression_program(
+            self.compression_mode, self.compression_level
+        )
+        doing.logger.debug("Compression program: %s", compression_program)
 
         tar = subprocess.Popen(
-            ["tar", "-C", local_path, "-c", compression_switch, "."],
+            ["tar", "-C", local_path, "-c", "-I", compression_program, "."],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
+
+        if Retry.attempts:
+            self.upload_resumable(tar, expected_size)
+            return
+
+        pipe = MeteredPipe(tar.stdout, f"Writing {self}", expected_size)
         dd = self.ssh_popen(
             ["dd", f"of={self.path}"],
             stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
-            stdin=tar.stdout,
+            stdin=pipe.stdin,
         )
+        pipe.start(dd)
+        pipe.join()
 
-        _, dd_err = dd.communicate()
+        dd_err = dd.stderr.read()
+        dd.wait()
         _, tar_err = tar.communicate()
 
         if dd.returncode:
@@ -334,6 +635,44 @@ class SshLocation(Location):
         if tar.returncode:
             raise LuhError(f"Could not create the archive: {tar_err}")
 
+    def upload_resumable(self, tar: Popen, expected_size: Optional[int]):
+        """
+        Sends the output of tar into the remote archive in a resumable way,
+        see ResumableUpload
+        """
+
+        meter = Meter(f"Writing {self}", expected_size) if Meter.enabled else None
+        upload = ResumableUpload(self)
+
+        try:
+            upload.send(tar.stdout, meter)
+        except LuhError:
+            tar.kill()
+            tar.wait()
+            upload.discard()
+            raise
+
+        tar_err = tar.stderr.read()
+        tar.wait()
+
+        if tar.returncode:
+            upload.discard()
+            raise LuhError(f"Could not create the archive: {tar_err}")
+
+        upload.commit()
+
+    def writer_popen(self, stdin: IO) -> Popen:
+        """
+        Writes the file with a remote dd
+        """
+
+        return self.ssh_popen(
+            ["dd", f"of={self.path}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            stdin=stdin,
+        )
+
     def extract_archive_to_dir(self, target_dir: Text) -> None:
         """
         Cat the remote file and pipe it into tar
@@ -341,17 +680,25 @@ class SshLocation(Location):
 
         parse_location(target_dir, self.compression_mode).ensure_exists_as_dir()
 
+        if Retry.attempts:
+            self.extract_resumable(target_dir)
+            return
+
         cat = self.ssh_popen(
             ["cat", self.path], stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
+        pipe = MeteredPipe(cat.stdout, f"Reading {self}")
         tar = subprocess.Popen(
-            ["tar", "-C", target_dir, "-x", "-a"],
+            ["tar", "-C", target_dir, "-x"] + get_decompression_args(self.path),
             stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
-            stdin=cat.stdout,
+            stdin=pipe.stdin,
         )
+        pipe.start(tar)
+        pipe.join()
 
-        _, tar_err = tar.communicate()
+        tar_err = tar.stderr.read()
+        tar.wait()
         _, cat_err = cat.communicate()
 
         if cat.returncode:
@@ -360,6 +707,34 @@ class SshLocation(Location):
         if tar.returncode:
             raise LuhError(f"Error while extracting the archive: {tar_err}")
 
+    def extract_resumable(self, target_dir: Text) -> None:
+        """
+        Same as extract_archive_to_dir() but the download resumes if the
+        connection drops, see download_resumable()
+        """
+
+        meter = Meter(f"Reading {self}") if Meter.enabled else None
+        tar = subprocess.Popen(
+            ["tar", "-C", target_dir, "-x"] + get_decompression_args(self.path),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+        )
+
+        try:
+            download_resumable(self, tar.stdin, meter)
+        finally:
+            try:
+                tar.stdin.close()
+            except BrokenPipeError:
+                pass
+
+            tar_err = tar.stderr.read()
+            tar.wait()
+
+        if tar.returncode:
+            raise LuhError(f"Error while extracting the archive: {tar_err}")
+
     def chown(self, owner: Text) -> None:
         """
         Simply use chown
@@ -402,10 +777,19 @@ class LocalLocation(Location):
 
     path: Text
     compression_mode: Text
+    compression_level: Optional[int] = None
+    throttle: Optional[Throttle] = None
 
     def __str__(self):
         return self.path
 
+    def popen(self, args, *p_args, **kwargs) -> Popen:
+        """
+        Regular Popen() (throttled if the location is)
+        """
+
+        return subprocess.Popen(self.throttled(args), *p_args, **kwargs)
+
     def get_content(self) -> Text:
         try:
             with open(self.path, "r", encoding="utf-8") as f:
@@ -417,8 +801,11 @@ class LocalLocation(Location):
         except OSError:
             raise LuhError(f"Unknown error while opening {self}")
 
-    def set_compression_mode(self, compression_mode: Text):
+    def set_compression_mode(
+        self, compression_mode: Text, compression_level: Optional[int] = None
+    ):
         self.compression_mode = compression_mode
+        self.compression_level = compression_level
 
     def delete_dir_content(self) -> None:
 
@@ -441,12 +828,48 @@ class LocalLocation(Location):
         except OSError:
             raise LuhError(f"Unknown error while creating {self}")
 
-    def archive_local_dir(self, local_path, doing):
+    def archive_local_dir(self, local_path, doing, expected_size=None):
         doing.logger.debug("Compression mode: %s", self.compression_mode)
-        compression_switch = get_compression_switch(self.compression_mode)
-        doing.logger.debug("Compression switch: %s", compression_switch)
+        compression_program = get_compression_program(
+            self.compression_mode, self.compression_level
+        )
+        doing.logger.debug("Compression program: %s", compression_program)
+
+        if Meter.enabled:
+            tar = subprocess.Popen(
+                ["tar", "-C", local_path, "-c", "-I", compression_program, "."],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+
+            try:
+                with open(self.path, "wb") as f:
+                    meter = Meter(f"Writing {self}", expected_size)
+                    relay(tar.stdout, f, meter, close_target=False)
+            except OSError as e:
+                tar.kill()
+                raise LuhError(f"Could not create archive {self.path}: {e}")
+            finally:
+                tar_err = tar.stderr.read()
+                tar.wait()
+
+            if tar.returncode:
+                raise LuhError(f"Could not create archive {self.path}: {tar_err}")
+
+            return
+
         cp = subprocess.run(
-            ["tar", "-C", local_path, "-c", compression_switch, "-f", self.path, "."],
+            [
+                "tar",
+                "-C",
+                local_path,
+                "-c",
+                "-I",
+                compression_program,
+                "-f",
+                self.path,
+                ".",
+            ],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
@@ -454,15 +877,53 @@ class LocalLocation(Location):
         if cp.returncode:
             raise LuhError(f"Could not create archive {self.path}")
 
+    def writer_popen(self, stdin: IO) -> Popen:
+        """
+        Plain local dd
+        """
+
+        return subprocess.Popen(
+            ["dd", f"of={self.path}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            stdin=stdin,
+        )
+
     def extract_archive_to_dir(self, target_dir: Text) -> None:
         """
         Plain old local archive extraction
         """
 
         parse_location(target_dir, self.compression_mode).ensure_exists_as_dir()
+        program = get_decompression_program(self.path)
+
+        if Meter.enabled and program:
+            tar = subprocess.Popen(
+                ["tar", "-C", target_dir, "-x", "-I", program],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+
+            try:
+                with open(self.path, "rb") as f:
+                    meter = Meter(f"Reading {self}", getsize(self.path))
+                    relay(f, tar.stdin, meter)
+            except OSError as e:
+                tar.kill()
+                raise LuhError(f"Could not read archive {self.path}: {e}")
+            finally:
+                tar_err = tar.stderr.read()
+                tar.wait()
+
+            if tar.returncode:
+                raise LuhError(f"Error while extracting the archive: {tar_err}")
+
+            return
 
         tar = subprocess.run(
-            ["tar", "-C", target_dir, "-x", "-a", "-f", self.path],
+            ["tar", "-C", target_dir, "-x", "-f", self.path]
+            + get_decompression_args(self.path),
             stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
         )
@@ -490,7 +951,7 @@ class LocalLocation(Location):
         """
 
         cp = subprocess.Popen(
-            ["bash"],
+            self.throttled(["bash"]),
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -502,3 +963,17 @@ class LocalLocation(Location):
         out, err = cp.communicate()
 
         return out, err, cp.returncode
+
+
+def is_same_host(a: Location, b: Location) -> bool:
+    """
+    Tells if both locations are on the same machine
+    """
+
+    if isinstance(a, LocalLocation) and isinstance(b, LocalLocation):
+        return True
+
+    if isinstance(a, SshLocation) and isinstance(b, SshLocation):
+        return (a.user, a.host, a.port or 22) == (b.user, b.host, b.port or 22)
+
+    return False
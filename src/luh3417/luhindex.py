@@ -0,0 +1,213 @@
+import json
+import subprocess
+import tarfile
+import zlib
+from dataclasses import replace
+from posixpath import normpath
+from shlex import quote
+from typing import BinaryIO, Dict, List, Optional, Sequence, Text, Tuple
+
+from luh3417.luhfs import Location
+from luh3417.utils import LuhError
+
+INDEX_SUFFIX = ".idx"
+INDEXED_COMPRESSION_MODES = ["gzip"]
+
+
+class SegmentedGzipWriter:
+    """
+    File-like object which gzips what is written into it as a series of
+    independent gzip members (segments). Concatenated gzip members are still
+    a valid gzip stream, so the output can be decompressed as a whole by any
+    gzip tool, but each segment can also be decompressed on its own from its
+    offset.
+    """
+
+    def __init__(self, fp: BinaryIO, level: Optional[int] = None):
+        self.fp = fp
+        self.level = level if level is not None else zlib.Z_DEFAULT_COMPRESSION
+        self.compressor = None
+        self.pos = 0
+        self.written = 0
+        self.segment_start = 0
+
+    def tell(self) -> int:
+        return self.pos
+
+    def write(self, data: bytes) -> int:
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            self.segment_start = self.written
+
+        self.pos += len(data)
+        self.output(self.compressor.compress(data))
+
+        return len(data)
+
+    def output(self, data: bytes):
+        self.fp.write(data)
+        self.written += len(data)
+
+    def cut(self) -> Optional[Tuple[int, int]]:
+        """
+        Ends the current segment and returns its (offset, length) in the
+        compressed output, if anything was written into it
+        """
+
+        if self.compressor is None:
+            return None
+
+        self.output(self.compressor.flush())
+        self.compressor = None
+
+        return self.segment_start, self.written - self.segment_start
+
+
+def get_index_location(archive: Location) -> Location:
+    """
+    Location of the index which goes with an archive
+    """
+
+    return replace(archive, path=archive.path + INDEX_SUFFIX)
+
+
+def get_member_group(name: Text) -> Text:
+    """
+    Members are indexed by top-level entry of the archive (`settings.json`,
+    `dump.sql`, `wordpress`, ...)
+    """
+
+    return normpath(name).split("/")[0]
+
+
+class IndexedArchiveWriter:
+    """
+    Writes a tar.gz archive along with an index of its top-level entries.
+    Each time the archive goes from a top-level entry to another one, a new
+    gzip segment is started, and the index lists the segments of each entry.
+    It's fed like a TarFile (through addfile()).
+
+    The archive is a regular tar.gz but the index allows to extract a single
+    entry (by example `settings.json`) by reading only its segments.
+    """
+
+    def __init__(self, location: Location):
+        self.location = location
+        self.process: Optional[subprocess.Popen] = None
+        self.gz: Optional[SegmentedGzipWriter] = None
+        self.tar: Optional[tarfile.TarFile] = None
+        self.group: Optional[Text] = None
+        self.index: Dict[Text, List[Tuple[int, int]]] = {}
+
+    def __enter__(self):
+        self.process = self.location.writer_popen(subprocess.PIPE)
+        self.gz = SegmentedGzipWriter(
+            self.process.stdin, self.location.compression_level
+        )
+        self.tar = tarfile.open(fileobj=self.gz, mode="w", format=tarfile.PAX_FORMAT)
+
+        return self
+
+    def end_segment(self):
+        """
+        Ends the current segment and indexes it
+        """
+
+        segment = self.gz.cut()
+
+        if segment is not None:
+            self.index.setdefault(self.group, []).append(segment)
+
+    def addfile(self, tarinfo: tarfile.TarInfo, fileobj: Optional[BinaryIO] = None):
+        """
+        Adds a member to the archive, the same way as TarFile.addfile()
+        """
+
+        group = get_member_group(tarinfo.name)
+
+        if group != self.group:
+            self.end_segment()
+            self.group = group
+
+        self.tar.addfile(tarinfo, fileobj)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.tar.close()
+                self.end_segment()
+
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        err = self.process.stderr.read()
+        self.process.wait()
+
+        if exc_type is not None:
+            return
+
+        if self.process.returncode:
+            raise LuhError(f"Could not write archive {self.location}: {err}")
+
+        get_index_location(self.location).set_content(
+            json.dumps({"version": 1, "members": self.index})
+        )
+
+
+def read_archive_index(archive: Location) -> Optional[Dict]:
+    """
+    Reads the index of this archive, if there is one
+    """
+
+    location = get_index_location(archive)
+
+    if not location.exists():
+        return None
+
+    try:
+        return json.loads(location.get_content())
+    except ValueError as e:
+        raise LuhError(f"Index {location} is corrupted: {e}")
+
+
+def extract_archive_members(
+    archive: Location, index: Dict, names: Sequence[Text], target_dir: Text
+):
+    """
+    Extracts some top-level entries of the archive into the target dir. Only
+    the segments of these entries are read from the archive (with a range
+    read on the machine where it is stored).
+    """
+
+    members = index["members"]
+    segments = [s for name in names if name in members for s in members[name]]
+
+    if not segments:
+        return
+
+    script = " && ".join(
+        f"tail -c +{offset + 1} {quote(archive.path)} | head -c {length}"
+        for offset, length in segments
+    )
+
+    source = archive.popen(
+        ["sh", "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    tar = subprocess.Popen(
+        ["tar", "-C", target_dir, "-x", "-z"],
+        stdin=source.stdout,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    source.stdout.close()
+
+    _, tar_err = tar.communicate()
+    source_err = source.stderr.read()
+    source.wait()
+
+    if source.returncode:
+        raise LuhError(f"Error while reading the archive: {source_err[:1000]}")
+
+    if tar.returncode:
+        raise LuhError(f"Error while extracting {', '.join(names)}: {tar_err[:1000]}")
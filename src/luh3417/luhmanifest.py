@@ -0,0 +1,227 @@
+import sqlite3
+from dataclasses import dataclass, field
+from hashlib import sha256
+from os import makedirs
+from os.path import join
+from shlex import quote
+from time import time
+from typing import Dict, List, Optional, Text, Tuple
+
+from luh3417.luhfs import Location
+from luh3417.utils import LuhError
+
+MANIFEST_SCHEMA = """
+    create table if not exists entries (
+        path text primary key,
+        kind text not null,
+        size integer not null,
+        mtime real not null,
+        mode integer not null,
+        link text not null,
+        sha256 text
+    );
+    create table if not exists meta (
+        key text primary key,
+        value text not null
+    );
+"""
+
+
+@dataclass
+class ManifestEntry:
+    """
+    What is known of an entry of a tree: its type (as find's `%y`), size,
+    mtime, permission bits and target (for symlinks). The SHA-256 of a file is
+    only known if it was computed since the file last changed.
+    """
+
+    kind: Text
+    size: int
+    mtime: float
+    mode: int
+    link: Text
+    sha256: Optional[Text] = None
+
+    @property
+    def state(self) -> Tuple[Text, int, float, int, Text]:
+        """
+        What tells that an entry changed
+        """
+
+        return self.kind, self.size, self.mtime, self.mode, self.link
+
+
+@dataclass
+class ManifestChanges:
+    """
+    Paths which changed between two refreshes of a manifest
+    """
+
+    added: List[Text] = field(default_factory=list)
+    changed: List[Text] = field(default_factory=list)
+    removed: List[Text] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self):
+        return (
+            f"{len(self.added)} added, {len(self.changed)} changed, "
+            f"{len(self.removed)} removed"
+        )
+
+
+def scan_tree(location: Location) -> Dict[Text, ManifestEntry]:
+    """
+    Lists all entries of the location (with their type, size, mtime, mode
+    and link target) in a single pass of find on its host
+    """
+
+    out, err, ret = location.run_script(
+        f"cd {quote(location.path)} && "
+        f"find . -mindepth 1 -printf '%y\\0%s\\0%T@\\0%m\\0%l\\0%P\\0'"
+    )
+
+    if ret:
+        raise LuhError(f"Could not list files of {location}: {err}")
+
+    # Fields are NUL-separated, since a link target may contain anything
+    fields = out.split("\0")
+    entries = {}
+
+    for i in range(0, len(fields) - 1, 6):
+        kind, size, mtime, mode, link, path = fields[i : i + 6]
+        entries[path] = ManifestEntry(kind, int(size), float(mtime), int(mode, 8), link)
+
+    return entries
+
+
+class ManifestCache:
+    """
+    Manifest of the tree of a location (path, type, size, mtime and maybe
+    SHA-256 of each entry) cached in a local SQLite database, one per
+    location. Refreshing it costs a single find on the location's host and
+    tells what changed since the previous refresh, while the hashes of the
+    files which didn't change are kept, so they don't need to be computed
+    again.
+
+    >>> with ManifestCache(location, cache_dir) as cache:
+    >>>     changes = cache.refresh()
+    """
+
+    def __init__(self, location: Location, cache_dir: Text):
+        self.location = location
+        makedirs(cache_dir, exist_ok=True)
+        key = sha256(f"{location}".encode("utf-8")).hexdigest()[:32]
+        self.path = join(cache_dir, f"{key}.sqlite")
+        self.db = sqlite3.connect(self.path)
+        self.migrate()
+        self.db.executescript(MANIFEST_SCHEMA)
+
+    def __enter__(self) -> "ManifestCache":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def migrate(self):
+        """
+        Drops the manifests written before modes and links were recorded,
+        they'll simply be rebuilt by the next refresh
+        """
+
+        columns = [row[1] for row in self.db.execute("pragma table_info(entries)")]
+
+        if columns and "link" not in columns:
+            with self.db:
+                self.db.execute("drop table entries")
+                self.db.execute("delete from meta")
+
+    @property
+    def refreshed_at(self) -> Optional[float]:
+        """
+        Time of the last refresh, None if this manifest was never refreshed
+        """
+
+        row = self.db.execute(
+            "select value from meta where key = 'refreshed_at'"
+        ).fetchone()
+
+        return float(row[0]) if row else None
+
+    def entries(self) -> Dict[Text, ManifestEntry]:
+        """
+        All the entries, as of the last refresh
+        """
+
+        return {
+            path: ManifestEntry(kind, size, mtime, mode, link, digest)
+            for path, kind, size, mtime, mode, link, digest in self.db.execute(
+                "select path, kind, size, mtime, mode, link, sha256 from entries"
+            )
+        }
+
+    def refresh(self) -> ManifestChanges:
+        """
+        Scans the location again and stores its new state. Hashes are kept
+        for the files whose size and mtime did not change.
+        """
+
+        previous = self.entries()
+        current = scan_tree(self.location)
+        changes = ManifestChanges()
+
+        for path, entry in current.items():
+            old = previous.get(path)
+
+            if old is None:
+                changes.added.append(path)
+            elif old.state != entry.state:
+                changes.changed.append(path)
+            else:
+                entry.sha256 = old.sha256
+
+        changes.removed = [path for path in previous if path not in current]
+
+        with self.db:
+            self.db.execute("delete from entries")
+            self.db.executemany(
+                "insert into entries values (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (path, e.kind, e.size, e.mtime, e.mode, e.link, e.sha256)
+                    for path, e in current.items()
+                ),
+            )
+            self.db.execute(
+                "insert or replace into meta values ('refreshed_at', ?)",
+                (f"{time()}",),
+            )
+
+        return changes
+
+    def set_hashes(self, hashes: Dict[Text, Text]):
+        """
+        Records the SHA-256 of files, computed since the last refresh
+        """
+
+        with self.db:
+            self.db.executemany(
+                "update entries set sha256 = ? where path = ?",
+                ((digest, path) for path, digest in hashes.items()),
+            )
+
+    def clear_hashes(self, paths: List[Text]):
+        """
+        Forgets the SHA-256 of these paths (and of everything below them),
+        whose content is about to change
+        """
+
+        with self.db:
+            self.db.executemany(
+                "update entries set sha256 = null "
+                "where path = ? or substr(path, 1, length(?) + 1) = ? || '/'",
+                ((path, path, path) for path in paths),
+            )
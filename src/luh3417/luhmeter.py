@@ -0,0 +1,260 @@
+from subprocess import PIPE, Popen
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import IO, Optional, Text
+
+from luh3417.utils import make_doer
+
+doing = make_doer("luh3417.luhmeter")
+
+RELAY_BUFFER_SIZE = 1024 * 1024
+
+# Shorter waits are accumulated into the next one instead of sleeping
+MIN_WAIT = 0.01
+
+
+class RateLimiter:
+    """
+    Caps the total rate of the streams sharing it. Each stream reports the
+    bytes it sends and gets slowed down (by sleeping, which blocks the
+    producer through the pipe) as soon as the cap is reached.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.lock = Lock()
+        self.free_at = monotonic()
+
+    def consume(self, size: int) -> float:
+        """
+        Accounts for bytes sent and waits as long as needed to respect the
+        rate. Returns the time spent waiting.
+        """
+
+        with self.lock:
+            now = monotonic()
+            self.free_at = max(self.free_at, now) + size / self.rate
+            wait = self.free_at - now
+
+        if wait < MIN_WAIT:
+            return 0.0
+
+        sleep(wait)
+        return wait
+
+
+class Meter:
+    """
+    Counts the bytes flowing through a pipeline and periodically logs the
+    throughput. If the expected size is known (by example from the previous
+    snapshot), the progress and ETA are logged as well.
+
+    Metering can be switched off globally by setting `Meter.enabled` to
+    False, in which case pipelines are connected directly (no relay, so no
+    overhead at all), unless a rate limiter has to slow them down.
+    """
+
+    enabled = True
+    interval = 10.0
+
+    def __init__(
+        self,
+        name: Text,
+        expected_size: Optional[int] = None,
+        limiter: Optional[RateLimiter] = None,
+    ):
+        self.name = name
+        self.expected_size = expected_size
+        self.limiter = limiter
+        self.total = 0
+        self.throttled = 0.0
+        self.start = monotonic()
+        self.last_log = self.start
+
+    @classmethod
+    def is_needed(cls, limiter: Optional[RateLimiter] = None) -> bool:
+        """
+        Tells if data has to go through a meter (to be logged or limited)
+        """
+
+        return cls.enabled or limiter is not None
+
+    def add(self, size: int):
+        """
+        Counts bytes which went through
+        """
+
+        self.total += size
+
+        if self.limiter:
+            self.throttled += self.limiter.consume(size)
+
+        now = monotonic()
+
+        if self.enabled and now - self.last_log >= self.interval:
+            self.last_log = now
+            self.log_progress(now - self.start)
+
+    def log_progress(self, elapsed: float):
+        rate = self.total / elapsed if elapsed else 0.0
+        message = (
+            f"{self.name}: {self.total / 1024 ** 2:.1f} MiB, "
+            f"{rate / 1024 ** 2:.1f} MiB/s"
+        )
+
+        if self.expected_size and rate and self.total < self.expected_size:
+            eta = (self.expected_size - self.total) / rate
+            percent = self.total * 100 / self.expected_size
+            message += f", ~{percent:.0f}%, ETA {eta:.0f}s"
+
+        doing.logger.info(message)
+
+    def done(self):
+        """
+        Logs the totals, including the time spent waiting for the rate
+        limiter (which is how much the limit stretched this stream)
+        """
+
+        elapsed = monotonic() - self.start
+        rate = self.total / elapsed if elapsed else 0.0
+        message = (
+            f"{self.name}: {self.total / 1024 ** 2:.1f} MiB in {elapsed:.1f}s "
+            f"({rate / 1024 ** 2:.1f} MiB/s"
+        )
+
+        if self.limiter:
+            message += f", {self.throttled:.1f}s waiting for the bandwidth limit"
+
+        doing.logger.info(message + ")")
+
+
+def relay(
+    source: IO, target: IO, meter: Optional[Meter], close_target: bool = True
+):
+    """
+    Copies everything from source to target, counting the bytes (if there is
+    a meter)
+    """
+
+    read = getattr(source, "read1", source.read)
+
+    try:
+        while True:
+            data = read(RELAY_BUFFER_SIZE)
+
+            if not data:
+                break
+
+            target.write(data)
+
+            if meter:
+                meter.add(len(data))
+    except BrokenPipeError:
+        # The target died, make sure that the source doesn't wait forever
+        source.close()
+    finally:
+        if close_target:
+            try:
+                target.close()
+            except BrokenPipeError:
+                pass
+
+        if meter:
+            meter.done()
+
+
+def start_relay(
+    source: IO, target: IO, meter: Optional[Meter], close_target: bool = True
+) -> Thread:
+    """
+    Runs relay() in a thread
+    """
+
+    thread = Thread(target=relay, args=(source, target, meter, close_target))
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+class MeteredPipe:
+    """
+    Connects the output of a process to the input of another one. If metering
+    is enabled (or the rate is limited), data goes through a relay thread
+    which meters it, otherwise the second process directly reads the output
+    of the first one.
+
+    >>> pipe = MeteredPipe(source.stdout, "Copying files")
+    >>> target = Popen(args, stdin=pipe.stdin)
+    >>> pipe.start(target)
+    >>> ...
+    >>> pipe.join()
+    """
+
+    def __init__(
+        self,
+        source: IO,
+        name: Text,
+        expected_size: Optional[int] = None,
+        limiter: Optional[RateLimiter] = None,
+    ):
+        self.source = source
+        self.meter = (
+            Meter(name, expected_size, limiter) if Meter.is_needed(limiter) else None
+        )
+        self.thread: Optional[Thread] = None
+
+    @property
+    def stdin(self):
+        """
+        Value to give as stdin of the target process
+        """
+
+        return PIPE if self.meter else self.source
+
+    def start(self, target: Popen):
+        """
+        Starts relaying data into the target process
+        """
+
+        if self.meter:
+            self.thread = start_relay(self.source, target.stdin, self.meter)
+
+    def join(self):
+        """
+        Waits for the relay to be done
+        """
+
+        if self.thread:
+            self.thread.join()
+
+
+class Drain:
+    """
+    Reads a stream (typically the stderr of a process) until its end in a
+    thread, so that the process never gets stuck on a full pipe while its
+    other outputs are being consumed.
+
+    >>> drain = Drain(p.stderr)
+    >>> ...
+    >>> err = drain.read()
+    """
+
+    def __init__(self, stream: IO):
+        self.stream = stream
+        self.content = None
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        self.content = self.stream.read()
+
+    def read(self):
+        """
+        Waits for the end of the stream and returns everything it contained
+        """
+
+        self.thread.join()
+
+        return self.content
@@ -0,0 +1,350 @@
+import os
+import subprocess
+from hashlib import sha256
+from shlex import quote
+from tempfile import TemporaryFile
+from threading import Condition
+from time import sleep
+from typing import IO, Iterator, Optional, Text, Tuple
+
+from luh3417.luhmeter import RELAY_BUFFER_SIZE, Meter, start_relay
+from luh3417.luhssh import SshManager
+from luh3417.utils import LuhError, make_doer
+
+doing = make_doer("luh3417.luhresume")
+
+PARTIAL_SUFFIX = ".partial"
+
+# Exit code of SSH when the connection failed (as opposed to the remote
+# command failing)
+SSH_CONNECTION_ERROR = 255
+
+
+class Retry:
+    """
+    How transfers of archives through SSH recover from dropped connections.
+    With `Retry.attempts` at 0 (the default) transfers are not resumable and
+    stream straight through SSH, otherwise they resume from where they
+    stopped, up to this number of times.
+
+    The wait before each attempt starts at `Retry.delay` and doubles every
+    time, up to `Retry.max_delay`, so that the attempts span more than the
+    time SSH needs to notice that a connection is dead (see SshManager).
+    """
+
+    attempts = 0
+    delay = 10.0
+    max_delay = 120.0
+
+    @classmethod
+    def get_delay(cls, attempt: int) -> float:
+        """
+        Time to wait before this attempt (starting at 1)
+        """
+
+        return min(cls.delay * 2 ** (attempt - 1), cls.max_delay)
+
+
+class Spool:
+    """
+    Temporary file written by a producer while a consumer reads it from any
+    offset, waiting for the data to come. The data is hashed on the way.
+
+    Everything is kept until the end (any offset may have to be sent again),
+    so it takes as much local disk as the whole stream.
+    """
+
+    def __init__(self):
+        self.file = TemporaryFile()
+        self.hash = sha256()
+        self.size = 0
+        self.finished = False
+        self.condition = Condition()
+
+    def write(self, data: bytes) -> int:
+        self.file.write(data)
+        self.file.flush()
+        self.hash.update(data)
+
+        with self.condition:
+            self.size += len(data)
+            self.condition.notify_all()
+
+        return len(data)
+
+    def close(self):
+        """
+        Called by the producer once everything is written
+        """
+
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def read_from(self, offset: int) -> Iterator[bytes]:
+        """
+        Reads everything from this offset, until the producer is done
+        """
+
+        while True:
+            with self.condition:
+                while offset >= self.size and not self.finished:
+                    self.condition.wait()
+
+                if offset >= self.size:
+                    return
+
+                size = min(self.size - offset, RELAY_BUFFER_SIZE)
+
+            data = os.pread(self.file.fileno(), size, offset)
+            offset += len(data)
+            yield data
+
+    def discard(self):
+        self.file.close()
+
+
+def reconnect(location, attempt: int) -> None:
+    """
+    Waits a bit (more at each attempt) then makes sure that the SSH master
+    connection to this location is up
+    """
+
+    sleep(Retry.get_delay(attempt))
+    SshManager.instance(location.user, location.host, location.port).reconnect()
+
+
+def get_remote_size(location, path: Text) -> Optional[int]:
+    """
+    Size of a remote file, None if it can't be known (yet)
+    """
+
+    out, _, ret = location.run_script(f"stat -c %s {quote(path)}")
+
+    if ret:
+        return None
+
+    return int(out.strip())
+
+
+def get_remote_sha256(location, path: Text) -> Text:
+    """
+    SHA-256 of a remote file, computed on its host
+    """
+
+    out, err, ret = location.run_script(f"sha256sum {quote(path)}")
+
+    if ret:
+        raise LuhError(f"Could not hash {location}: {err}")
+
+    return out.split()[0]
+
+
+class ResumableUpload:
+    """
+    Writes a stream into a remote file, surviving dropped connections. The
+    stream is spooled on the local disk (which needs as much free space as
+    the size of the stream) while being sent into a `.partial` file next to
+    the target. If the connection drops, the upload resumes from the size of
+    the partial file.
+
+    Once the upload is done, the caller checks that the stream was complete
+    then calls commit(), which compares the checksums of both sides and gives
+    its final name to the partial file.
+
+    >>> upload = ResumableUpload(location)
+    >>> upload.send(process.stdout, meter)
+    >>> process.wait()
+    >>> upload.commit()
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.partial = location.path + PARTIAL_SUFFIX
+        self.spool = Spool()
+
+    def send_from(self, offset: int) -> Tuple[int, Text]:
+        """
+        Sends what's in the spool from this offset, returns the exit code and
+        the errors of the remote side
+        """
+
+        cat = self.location.ssh_popen(
+            ["sh", "-c", f"cat >> {quote(self.partial)}"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+        try:
+            for data in self.spool.read_from(offset):
+                cat.stdin.write(data)
+
+            cat.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        err = cat.stderr.read().decode("utf-8", "replace")
+        cat.wait()
+
+        return cat.returncode, err
+
+    def get_offset(self) -> Optional[int]:
+        """
+        Size of the partial file, None if the host can't be reached
+        """
+
+        offset = get_remote_size(self.location, self.partial)
+
+        if offset is not None and offset > self.spool.size:
+            raise LuhError(f"Remote archive {self.partial} is bigger than sent")
+
+        return offset
+
+    def send(self, source: IO, meter: Optional[Meter] = None):
+        """
+        Spools the source and sends it, retrying as configured by Retry
+        """
+
+        _, err, ret = self.location.run_script(f": > {quote(self.partial)}")
+
+        if ret:
+            raise LuhError(f"Could not write remote archive: {err}")
+
+        producer = start_relay(source, self.spool, meter)
+        offset = 0
+        attempt = 0
+
+        while True:
+            # The offset is unknown if the host could not be reached again
+            if offset is not None:
+                ret, err = self.send_from(offset)
+
+                if ret and ret != SSH_CONNECTION_ERROR:
+                    raise LuhError(f"Could not write remote archive: {err}")
+
+                # After a connection error the size is only asked once
+                # reconnected, below
+                if not ret and self.get_offset() == self.spool.size:
+                    break
+
+            attempt += 1
+
+            if attempt > Retry.attempts:
+                raise LuhError(
+                    f"Could not write remote archive: {err or 'connection lost'}"
+                )
+
+            doing.logger.warning(
+                "Upload to %s interrupted, resuming (attempt %s of %s)",
+                self.location,
+                attempt,
+                Retry.attempts,
+            )
+            reconnect(self.location, attempt)
+            offset = self.get_offset()
+
+        producer.join()
+
+    def commit(self):
+        """
+        Checks that the remote file is identical to what was sent then
+        renames it
+        """
+
+        try:
+            local = self.spool.hash.hexdigest()
+            remote = get_remote_sha256(self.location, self.partial)
+
+            if local != remote:
+                raise LuhError(
+                    f"Checksum mismatch after upload to {self.location}: "
+                    f"{local} sent, {remote} written"
+                )
+
+            _, err, ret = self.location.run_script(
+                f"mv {quote(self.partial)} {quote(self.location.path)}"
+            )
+
+            if ret:
+                raise LuhError(f"Could not commit the remote archive: {err}")
+        finally:
+            self.spool.discard()
+
+    def discard(self):
+        """
+        Drops the spool and the partial file
+        """
+
+        self.spool.discard()
+        self.location.run_script(f"rm -f {quote(self.partial)}")
+
+
+def download_resumable(location, target: IO, meter: Optional[Meter] = None):
+    """
+    Copies a remote file into a stream (by example the stdin of a tar). If
+    the connection drops, the copy resumes from the offset which was reached
+    (with `tail -c +N`), which is transparent for the reader of the stream.
+    Once done, the checksum of what was received is compared with the one of
+    the remote file.
+    """
+
+    received = 0
+    attempt = 0
+    h = sha256()
+
+    while True:
+        tail = location.ssh_popen(
+            ["tail", "-c", f"+{received + 1}", location.path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        try:
+            for data in iter(lambda: tail.stdout.read1(RELAY_BUFFER_SIZE), b""):
+                target.write(data)
+                h.update(data)
+                received += len(data)
+
+                if meter:
+                    meter.add(len(data))
+        except BrokenPipeError:
+            # The reader stopped, it's up to the caller to report why
+            tail.kill()
+            tail.wait()
+            return
+
+        err = tail.stderr.read().decode("utf-8", "replace")
+        tail.wait()
+
+        if not tail.returncode:
+            break
+
+        attempt += 1
+
+        if tail.returncode != SSH_CONNECTION_ERROR or attempt > Retry.attempts:
+            raise LuhError(
+                f"Error while reading the remote archive: {err or 'connection lost'}"
+            )
+
+        doing.logger.warning(
+            "Download from %s interrupted at %s bytes, resuming (attempt %s of %s)",
+            location,
+            received,
+            attempt,
+            Retry.attempts,
+        )
+        reconnect(location, attempt)
+
+    target.close()
+
+    if meter:
+        meter.done()
+
+    remote = get_remote_sha256(location, location.path)
+
+    if h.hexdigest() != remote:
+        raise LuhError(
+            f"Checksum mismatch after download from {location}: "
+            f"{remote} expected, {h.hexdigest()} received"
+        )
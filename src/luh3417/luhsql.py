@@ -1,12 +1,38 @@
+import re
 import subprocess
 from dataclasses import dataclass
+from enum import Enum
+from functools import partial
+from os.path import join
+from shlex import quote
 from subprocess import DEVNULL, PIPE
-from typing import List, Optional, Text, TextIO
+from threading import Event, Lock
+from time import monotonic
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Text,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 from luh3417.luhfs import LocalLocation, Location, SshLocation
+from luh3417.luhmeter import Drain, Meter, relay
 from luh3417.luhssh import SshManager
+from luh3417.luhthrottle import Throttle, get_limiter
 from luh3417.serialized_replace import ReplaceMap, walk
-from luh3417.utils import LuhError
+from luh3417.utils import LuhError, escape, run_concurrently
+
+DUMP_SHARDS_DIR = "dump_shards"
+
+DUMP_SINGLE_TRANSACTION = "single-transaction"
+DUMP_LOCK = "lock"
+DUMP_CONSISTENCY_MODES = [DUMP_SINGLE_TRANSACTION, DUMP_LOCK]
 
 
 def create_from_source(wp_config, source: Location, db_host: Text):
@@ -38,6 +64,7 @@ def create_from_source(wp_config, source: Location, db_host: Text):
         ssh_user=ssh_user,
         ssh_host=ssh_host,
         ssh_port=ssh_port,
+        throttle=source.throttle,
     )
 
 
@@ -81,6 +108,215 @@ def patch_sql_dump(source_path: Text, dest_path: Text, replace: ReplaceMap):
         raise LuhError(f"Could not open SQL dump: {e}")
 
 
+class DumpEventType(Enum):
+    """
+    Kinds of events found in a mysqldump output
+    """
+
+    COMMENT = 0
+    TABLE_START = 1
+    DDL = 2
+    INSERT = 3
+    STATEMENT = 4
+    FOOTER = 5
+
+
+@dataclass
+class DumpEvent:
+    """
+    A piece of dump, located by its byte offsets within the dump. All the
+    events of a dump put back together give the exact original dump (except
+    for TABLE_START which is empty and just signals the beginning of a new
+    table).
+    """
+
+    type: DumpEventType
+    start: int
+    end: int
+    data: bytes
+    table: Optional[Text] = None
+    rows: int = 0
+
+
+DUMP_TABLE_COMMENT_RE = re.compile(
+    rb"^-- (?:Table structure|Dumping data|Temporary view structure) "
+    rb"for (?:table|view) `((?:[^`]|``)+)`"
+)
+DUMP_STATEMENT_RE = re.compile(
+    rb"^\s*(?:/\*!\d+\s*)?(?P<verb>[A-Za-z]+)"
+    rb"(?:\s+(?:IGNORE\s+)?(?:INTO|TABLE|(?:ALGORITHM=\w+\s+)?VIEW)"
+    rb"(?:\s+IF (?:NOT )?EXISTS)?\s+`(?P<table>(?:[^`]|``)+)`)?"
+)
+DUMP_STRING_RE = re.compile(rb"'[^'\\]*(?:\\.[^'\\]*)*'")
+DUMP_FOOTER_RE = re.compile(rb"^/\*!\d+ SET \w+\s*=\s*@OLD_")
+DDL_VERBS = {b"CREATE", b"DROP", b"ALTER", b"RENAME", b"TRUNCATE"}
+
+# Comments written by mysqldump when it starts dumping a table, which (with
+# --single-transaction) is after its transaction started
+DUMP_STARTED_MARKERS = [
+    b"\n-- Table structure for table ",
+    b"\n-- Dumping data for table ",
+    b"\n-- Temporary view structure for view ",
+]
+
+
+def count_insert_rows(statement: bytes) -> int:
+    """
+    Counts the rows inserted by an (extended) INSERT statement, by counting
+    the separators between rows once the strings are emptied (so that their
+    content can't be mistaken for a separator).
+    """
+
+    return 1 + DUMP_STRING_RE.sub(b"''", statement).count(b"),(")
+
+
+def parse_dump(fp: BinaryIO) -> Iterator[DumpEvent]:
+    """
+    Parses a mysqldump output as a stream of events. It works line by line,
+    so it only keeps one statement at a time in memory (extended INSERTs are
+    limited in size by mysqldump's --net-buffer-length).
+
+    This relies on the way mysqldump formats its output: comments are on
+    their own lines and a statement ends with a line ending with `;` (strings
+    can't span lines since mysqldump escapes new lines).
+    """
+
+    offset = 0
+    pending = []
+    pending_start = 0
+    table = None
+
+    def table_start(name: bytes, at: int) -> Iterator[DumpEvent]:
+        nonlocal table
+
+        decoded = name.replace(b"``", b"`").decode("utf-8", "replace")
+
+        if decoded != table:
+            table = decoded
+            yield DumpEvent(DumpEventType.TABLE_START, at, at, b"", table)
+
+    for line in fp:
+        if not pending:
+            stripped = line.strip()
+
+            if not stripped or stripped.startswith(b"--"):
+                m = DUMP_TABLE_COMMENT_RE.match(stripped)
+
+                if m:
+                    yield from table_start(m.group(1), offset)
+
+                yield DumpEvent(
+                    DumpEventType.COMMENT, offset, offset + len(line), line, table
+                )
+                offset += len(line)
+                continue
+
+            pending_start = offset
+
+        pending.append(line)
+        offset += len(line)
+
+        if not line.rstrip().endswith(b";"):
+            continue
+
+        data = b"".join(pending)
+        pending = []
+        m = DUMP_STATEMENT_RE.match(data)
+        verb = m.group("verb").upper() if m else b""
+
+        if m and m.group("table") and verb in DDL_VERBS | {b"INSERT", b"REPLACE"}:
+            yield from table_start(m.group("table"), pending_start)
+
+        if DUMP_FOOTER_RE.match(data):
+            event_type = DumpEventType.FOOTER
+        elif verb in DDL_VERBS:
+            event_type = DumpEventType.DDL
+        elif verb in {b"INSERT", b"REPLACE"}:
+            event_type = DumpEventType.INSERT
+        else:
+            event_type = DumpEventType.STATEMENT
+
+        yield DumpEvent(
+            event_type,
+            pending_start,
+            offset,
+            data,
+            table,
+            count_insert_rows(data) if event_type == DumpEventType.INSERT else 0,
+        )
+
+    if pending:
+        yield DumpEvent(
+            DumpEventType.STATEMENT, pending_start, offset, b"".join(pending), table
+        )
+
+
+@dataclass
+class DumpPass:
+    """
+    A run of mysqldump. Several runs can be needed to dump a DB, depending
+    on the consistency mode.
+    """
+
+    extra_args: List[Text]
+    tables: Optional[List[Text]] = None
+    locks: bool = False
+
+
+@dataclass
+class TableShard:
+    """
+    A range of rows of a table, delimited by its integer primary key. Bounds
+    set to None are open.
+    """
+
+    table: Text
+    key: Optional[Text] = None
+    low: Optional[int] = None
+    high: Optional[int] = None
+
+    @property
+    def where(self) -> Optional[Text]:
+        """
+        Generates the condition selecting this shard's rows (suitable for
+        mysqldump's `--where`)
+        """
+
+        conditions = []
+
+        if self.key and self.low is not None:
+            conditions.append(f"{escape(self.key, '`')} >= {self.low}")
+
+        if self.key and self.high is not None:
+            conditions.append(f"{escape(self.key, '`')} < {self.high}")
+
+        return " and ".join(conditions) or None
+
+
+class DumpStartWatcher:
+    """
+    Wraps the file into which the output of mysqldump is written and sets an
+    event as soon as mysqldump started to dump tables (see
+    DUMP_STARTED_MARKERS)
+    """
+
+    def __init__(self, fp: BinaryIO, started: Event):
+        self.fp = fp
+        self.started = started
+        self.tail = b"\n"
+
+    def write(self, data: bytes) -> int:
+        if not self.started.is_set():
+            window = self.tail + data
+
+            if any(marker in window for marker in DUMP_STARTED_MARKERS):
+                self.started.set()
+
+            self.tail = window[-64:]
+
+        return self.fp.write(data)
+
+
 @dataclass
 class LuhSql:
     """
@@ -95,6 +331,7 @@ class LuhSql:
     ssh_host: Optional[Text]
     ssh_port: Optional[Text]
     sudo_user: Optional[Text] = None
+    throttle: Optional[Throttle] = None
 
     def ssh_args(self, args: List[Text]) -> List[Text]:
         """
@@ -117,11 +354,15 @@ class LuhSql:
             return list(args)
 
     def mysql_args(
-        self, command: Text, extra_args: Optional[List[Text]] = None
+        self,
+        command: Text,
+        extra_args: Optional[List[Text]] = None,
+        tables: Optional[List[Text]] = None,
     ) -> List[Text]:
         """
         Generates the MySQL connection arguments depending on the connection
-        method and so on
+        method and so on. Tables (if any) are placed after the DB name, which
+        is what mysqldump expects.
         """
 
         out = [command] + (extra_args if extra_args else [])
@@ -135,56 +376,463 @@ class LuhSql:
         if self.db_name:
             out += [self.db_name]
 
+        if tables:
+            out += list(tables)
+
         return out
 
     def args(
-        self, command: Text, extra_args: Optional[List[Text]] = None
+        self,
+        command: Text,
+        extra_args: Optional[List[Text]] = None,
+        tables: Optional[List[Text]] = None,
     ) -> List[Text]:
         """
         Generates the proper arguments for this command and the connection
         configuration
         """
 
-        args = self.mysql_args(command, extra_args)
+        args = self.mysql_args(command, extra_args, tables)
         args = self.sudo_args(args)
+
+        if self.throttle:
+            args = self.throttle.wrap(args)
+
         args = self.ssh_args(args)
 
         return args
 
-    def dump_to_file(self, file_path: Text):
+    def run_dump(
+        self,
+        fp: BinaryIO,
+        extra_args: List[Text],
+        tables: Optional[List[Text]] = None,
+        what: Text = "MySQL DB",
+        pipe: Optional["DumpPipe"] = None,
+        started: Optional[Event] = None,
+    ):
+        """
+        Runs mysqldump with the provided args and writes its output into fp.
+        If a pipe is provided, the output also goes into it (the dump is
+        relayed line by line instead of being written directly by mysqldump).
+
+        If an event is provided, it is set once mysqldump started to dump
+        tables (see DumpStartWatcher) or, at the latest, once it stopped.
+        """
+
+        args = self.args("mysqldump", extra_args, tables)
+        limiter = get_limiter(self.throttle)
+        meter = (
+            Meter(f"Dumping {what}", limiter=limiter)
+            if Meter.is_needed(limiter)
+            else None
+        )
+
+        if started:
+            fp = DumpStartWatcher(fp, started)
+
+        try:
+            if pipe is None and meter is None and started is None:
+                p = subprocess.Popen(
+                    args, stderr=PIPE, stdout=fp, stdin=DEVNULL, encoding="utf-8"
+                )
+                _, err = p.communicate()
+            elif pipe is None:
+                p = subprocess.Popen(args, stderr=PIPE, stdout=PIPE, stdin=DEVNULL)
+                stderr = Drain(p.stderr)
+                relay(p.stdout, fp, meter, close_target=False)
+                p.wait()
+                err = stderr.read().decode("utf-8", "replace")
+            else:
+                p = subprocess.Popen(args, stderr=PIPE, stdout=PIPE, stdin=DEVNULL)
+                stderr = Drain(p.stderr)
+
+                for line in p.stdout:
+                    fp.write(line)
+                    pipe.write(line)
+
+                    if meter:
+                        meter.add(len(line))
+
+                if meter:
+                    meter.done()
+
+                p.wait()
+                err = stderr.read().decode("utf-8", "replace")
+        finally:
+            if started:
+                started.set()
+
+        if p.returncode:
+            raise LuhError(f"Could not dump {what}: {err}")
+
+    def get_table_engines(self) -> Dict[Text, Text]:
         """
-        Dumps the database into the specified file
+        Returns the storage engine of each table of the DB (views excluded)
         """
 
-        with open(file_path, "w", encoding="utf-8") as f:
-            p = subprocess.Popen(
-                self.args("mysqldump", ["--hex-blob"]),
-                stderr=PIPE,
-                stdout=f,
-                stdin=DEVNULL,
-                encoding="utf-8",
+        rows = self.run_select(
+            "select table_name, engine from information_schema.tables "
+            "where table_schema = database() and table_type = 'BASE TABLE';"
+        )
+
+        return {row[0]: row[1] for row in rows if len(row) == 2}
+
+    def dump_to_file(
+        self,
+        file_path: Text,
+        ignore_tables: Optional[List[Text]] = None,
+        consistency: Text = DUMP_SINGLE_TRANSACTION,
+        pipe: Optional["DumpPipe"] = None,
+        started: Optional[Event] = None,
+    ) -> float:
+        """
+        Dumps the database into the specified file. Tables listed in
+        `ignore_tables` are left out (typically because they are dumped
+        separately as shards, see `dump_with_shards()`). The `started` event
+        is set once the first pass started, see run_dump().
+
+        If a DumpPipe is given, the dump is also sent into it while it is being
+        written. The pipe is not closed by this method.
+
+        The consistency mode can be:
+
+        - `single-transaction` - InnoDB tables are dumped from a
+          consistent snapshot without taking any lock. Tables using another
+          engine (MyISAM, ...) can't work this way so they are dumped in a
+          second pass which locks them.
+        - `lock` - The mysqldump default, all tables are locked
+
+        Returns the number of seconds during which tables were locked.
+        """
+
+        lock_time = 0.0
+
+        with open(file_path, "wb") as f:
+            for dump_pass in self.get_dump_passes(ignore_tables, consistency):
+                start = monotonic()
+                self.run_dump(
+                    f, dump_pass.extra_args, dump_pass.tables, pipe=pipe, started=started
+                )
+
+                if dump_pass.locks:
+                    lock_time += monotonic() - start
+
+        return lock_time
+
+    def get_dump_passes(
+        self,
+        ignore_tables: Optional[List[Text]] = None,
+        consistency: Text = DUMP_SINGLE_TRANSACTION,
+    ) -> List["DumpPass"]:
+        """
+        Computes the mysqldump runs needed to dump the DB with this
+        consistency mode, see dump_to_file()
+        """
+
+        ignore = set(ignore_tables or [])
+        ignore_args = [f"--ignore-table={self.db_name}.{t}" for t in sorted(ignore)]
+
+        if consistency == DUMP_LOCK:
+            return [DumpPass(["--hex-blob"] + ignore_args, locks=True)]
+        elif consistency != DUMP_SINGLE_TRANSACTION:
+            raise LuhError(f"Unknown dump consistency mode: {consistency}")
+
+        locked = sorted(
+            table
+            for table, engine in self.get_table_engines().items()
+            if table not in ignore and (engine or "").lower() != "innodb"
+        )
+        locked_args = [f"--ignore-table={self.db_name}.{t}" for t in locked]
+        passes = [
+            DumpPass(
+                ["--hex-blob", "--single-transaction", "--quick"]
+                + ignore_args
+                + locked_args
             )
+        ]
 
-            _, err = p.communicate()
+        if locked:
+            passes.append(
+                DumpPass(["--hex-blob", "--lock-tables", "--quick"], locked, True)
+            )
+
+        return passes
+
+    def make_dump_script(
+        self,
+        file_path: Text,
+        ignore_tables: Optional[List[Text]] = None,
+        consistency: Text = DUMP_SINGLE_TRANSACTION,
+    ) -> Text:
+        """
+        Generates a shell script which dumps the DB into the specified file,
+        to be run on the machine which can reach the DB (the SSH host if any)
+        """
 
-            if p.returncode:
-                raise LuhError(f"Could not dump MySQL DB: {err}")
+        commands = [f": > {quote(file_path)}"]
+
+        for dump_pass in self.get_dump_passes(ignore_tables, consistency):
+            args = self.sudo_args(
+                self.mysql_args("mysqldump", dump_pass.extra_args, dump_pass.tables)
+            )
+            commands.append(f"{' '.join(quote(a) for a in args)} >> {quote(file_path)}")
 
-    def restore_dump(self, fp: TextIO):
+        return "\n".join(commands)
+
+    def restore_dump(
+        self,
+        fp: Union[TextIO, BinaryIO],
+        listener: Optional[Callable[[DumpEvent], None]] = None,
+    ):
         """
         Restores a dump into the DB, reading the dump from an input TextIO
         (which can be the stdout of another process or simply an open file, by
         example).
+
+        If a listener is provided, the dump (which must then be opened in
+        binary mode) goes through parse_dump() and each event is given to the
+        listener before being sent to MySQL.
+        """
+
+        if listener is None:
+            p = subprocess.Popen(
+                self.args("mysql"),
+                stderr=PIPE,
+                stdout=DEVNULL,
+                stdin=fp,
+                encoding="utf-8",
+            )
+            _, err = p.communicate()
+        else:
+            p = subprocess.Popen(
+                self.args("mysql"),
+                stderr=PIPE,
+                stdout=DEVNULL,
+                stdin=PIPE,
+                encoding="utf-8",
+            )
+            stderr = Drain(p.stderr)
+
+            try:
+                for event in parse_dump(fp):
+                    listener(event)
+                    p.stdin.buffer.write(event.data)
+            except BrokenPipeError:
+                pass
+            except BaseException:
+                p.kill()
+                raise
+            finally:
+                try:
+                    p.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+                p.wait()
+
+            err = stderr.read()
+
+        if p.returncode:
+            raise LuhError(f"Could not import MySQL DB: {err}")
+
+    def get_table_shards(self, table: Text, shards: int) -> List[TableShard]:
+        """
+        Computes the primary key ranges that split the table into `shards`
+        roughly even shards, based on the MIN/MAX of the key. The first and
+        last ranges are open so that no row can be missed.
+
+        If the table does not have a single integer primary key (or is empty)
+        then a single unbounded shard is returned.
+        """
+
+        name = escape(table, "'")
+        keys = self.run_select(
+            f"select column_name from information_schema.columns "
+            f"where table_schema = database() "
+            f"and table_name = {name} "
+            f"and column_key = 'PRI' "
+            f"and data_type in "
+            f"('tinyint', 'smallint', 'mediumint', 'int', 'bigint');"
+        )
+
+        if shards < 2 or len(keys) != 1:
+            return [TableShard(table)]
+
+        key = keys[0][0]
+        min_max = self.run_select(
+            f"select min({escape(key, '`')}), max({escape(key, '`')}) "
+            f"from {escape(table, '`')};"
+        )
+
+        try:
+            low, high = (int(x) for x in min_max[0])
+        except (IndexError, ValueError):
+            return [TableShard(table)]
+
+        step = max(1, -(-(high - low + 1) // shards))
+        cuts = list(range(low + step, high + 1, step))
+
+        return [
+            TableShard(table, key, a, b) for a, b in zip([None] + cuts, cuts + [None])
+        ]
+
+    def dump_table_shard(
+        self,
+        shard: TableShard,
+        file_path: Text,
+        with_ddl: bool,
+        consistency: Text = DUMP_SINGLE_TRANSACTION,
+        started: Optional[Event] = None,
+    ):
+        """
+        Dumps the rows of a single shard of a table. Only one shard should
+        come `with_ddl`, the other ones just contain the data. The `started`
+        event is set as explained in run_dump().
+
+        Table locks and key disabling are skipped from the dump as they would
+        serialize the concurrent imports of the shards.
+        """
+
+        extra = ["--hex-blob", "--skip-add-locks", "--skip-disable-keys"]
+
+        if consistency == DUMP_SINGLE_TRANSACTION:
+            extra += ["--single-transaction", "--quick"]
+
+        if shard.where:
+            extra.append(f"--where={shard.where}")
+
+        if not with_ddl:
+            extra.append("--no-create-info")
+
+        with open(file_path, "wb") as f:
+            self.run_dump(
+                f, extra, [shard.table], f"shard of {shard.table}", started=started
+            )
+
+    def dump_with_shards(
+        self,
+        file_path: Text,
+        dir_path: Text,
+        shard_tables: List[Text],
+        shards: int,
+        consistency: Text = DUMP_SINGLE_TRANSACTION,
+        synchronize: bool = True,
+    ) -> Tuple[float, Dict[Text, List[Text]]]:
+        """
+        Dumps the DB into `file_path` except for the `shard_tables`, which are
+        split into shards by primary key ranges (see get_table_shards()) and
+        dumped into `dir_path`. The main dump and all the shards of all the
+        tables are dumped concurrently, each in a session of its own.
+
+        To make these sessions consistent with each other, a global read lock
+        (see GlobalReadLock) is held until all of them started their
+        transaction. With the `lock` mode (or when a sharded table isn't
+        InnoDB) there is no transaction, so the lock is held until the end of
+        the dump. Without `synchronize`, no lock is taken and the shards are
+        not consistent with the rest of the dump.
+
+        Returns the time during which tables were locked and the files of the
+        shards of each table, the first one of each table containing its DDL.
+        """
+
+        plans = {table: self.get_table_shards(table, shards) for table in shard_tables}
+        paths = {
+            table: [join(dir_path, f"{table}.{i:03d}.sql") for i in range(len(s))]
+            for table, s in plans.items()
+        }
+        events = [Event()]
+        tasks = [
+            partial(
+                self.dump_to_file,
+                file_path,
+                shard_tables,
+                consistency,
+                started=events[0],
+            )
+        ]
+
+        for table, table_shards in plans.items():
+            for i, (shard, path) in enumerate(zip(table_shards, paths[table])):
+                events.append(Event())
+                tasks.append(
+                    partial(
+                        self.dump_table_shard,
+                        shard,
+                        path,
+                        i == 0,
+                        consistency,
+                        events[-1],
+                    )
+                )
+
+        if not synchronize:
+            return run_concurrently(*tasks)[0], paths
+
+        engines = self.get_table_engines()
+        in_transaction = consistency == DUMP_SINGLE_TRANSACTION and all(
+            (engines.get(table) or "").lower() == "innodb" for table in shard_tables
+        )
+
+        with GlobalReadLock(self) as lock:
+            if in_transaction:
+
+                def release():
+                    for event in events:
+                        event.wait()
+
+                    lock.release()
+
+                tasks.append(release)
+
+            lock_time = run_concurrently(*tasks)[0]
+
+        if in_transaction:
+            return lock_time + lock.held_for, paths
+
+        return lock.held_for, paths
+
+    def restore_table_shards(self, shards: Dict[Text, List[Text]]):
+        """
+        Restores the shards generated by `dump_with_shards()`. The first shard
+        of each table is imported first since it (re)creates the table, then
+        all the other shards of all the tables are imported concurrently.
+        """
+
+        def restore(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.restore_dump(f)
+            except OSError as e:
+                raise LuhError(f"Could not read SQL dump shard: {e}")
+
+        first = [paths[0] for paths in shards.values() if paths]
+        others = [path for paths in shards.values() for path in paths[1:]]
+
+        for batch in [first, others]:
+            if batch:
+                run_concurrently(*(partial(restore, path) for path in batch))
+
+    def run_select(self, query: Text) -> List[List[Text]]:
+        """
+        Runs a query and returns the rows of the result, each row being a list
+        of (text) values
         """
 
         p = subprocess.Popen(
-            self.args("mysql"), stderr=PIPE, stdout=DEVNULL, stdin=fp, encoding="utf-8"
+            self.args("mysql", ["-N", "-B"]),
+            stderr=PIPE,
+            stdout=PIPE,
+            stdin=PIPE,
+            encoding="utf-8",
         )
 
-        _, err = p.communicate()
+        out, err = p.communicate(query)
 
         if p.returncode:
-            raise LuhError(f"Could not import MySQL DB: {err}")
+            raise LuhError(f"Could not run MySQL query: {err}")
+
+        return [line.split("\t") for line in out.splitlines()]
 
     def run_query(self, query: Text):
         """
@@ -203,3 +851,158 @@ class LuhSql:
 
         if p.returncode:
             raise LuhError(f"Could not run MySQL query: {err}")
+
+
+class DumpPipe:
+    """
+    Imports a dump into a DB while it is being generated, patching each line
+    with the replace map on the fly. This avoids writing, patching and then
+    reading again the whole dump.
+
+    Feed it with write() and call close() at the end, which waits for the
+    import to be complete. If the dump fails, call abort() instead so that
+    MySQL does not keep running.
+    """
+
+    def __init__(self, db: LuhSql, replace: Optional[ReplaceMap] = None):
+        self.replace = replace
+        self.broken = False
+        self.process = subprocess.Popen(
+            db.args("mysql"), stdin=PIPE, stdout=DEVNULL, stderr=PIPE
+        )
+        self.stderr = Drain(self.process.stderr)
+
+    def write(self, line: bytes):
+        """
+        Patches and sends a line of the dump to MySQL. If MySQL already
+        stopped then the line is ignored, the error will be reported by
+        close().
+        """
+
+        if self.broken:
+            return
+
+        if self.replace:
+            line = walk(line, self.replace)
+
+        try:
+            self.process.stdin.write(line)
+        except BrokenPipeError:
+            self.broken = True
+
+    def close(self):
+        """
+        Ends the import and raises an error if it did not work
+        """
+
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        self.process.wait()
+        err = self.stderr.read()
+
+        if self.process.returncode:
+            raise LuhError(
+                f"Could not import MySQL DB: {err.decode('utf-8', 'replace')}"
+            )
+
+    def abort(self) -> Text:
+        """
+        Stops the import right away, leaving the DB partially imported.
+        Returns what MySQL reported until then.
+        """
+
+        self.process.kill()
+
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        self.process.wait()
+
+        return self.stderr.read().decode("utf-8", "replace")
+
+
+class GlobalReadLock:
+    """
+    Holds FLUSH TABLES WITH READ LOCK in a MySQL session of its own. While it
+    is held nothing can be written into the DB, so the dump sessions which
+    start their transaction meanwhile all see the same data. This requires
+    the RELOAD privilege.
+
+    The lock is released by release() (by example once all the sessions
+    started) or at the latest when leaving the context.
+
+    >>> with GlobalReadLock(db) as lock:
+    >>>     ...
+    >>>     lock.release()
+    """
+
+    def __init__(self, db: LuhSql):
+        self.db = db
+        self.process: Optional[subprocess.Popen] = None
+        self.stderr: Optional[Drain] = None
+        self.locked_at: Optional[float] = None
+        self.held_for = 0.0
+        self.mutex = Lock()
+
+    def __enter__(self) -> "GlobalReadLock":
+        self.process = subprocess.Popen(
+            self.db.args("mysql", ["-N", "-B", "--unbuffered"]),
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=PIPE,
+            encoding="utf-8",
+        )
+        self.stderr = Drain(self.process.stderr)
+
+        try:
+            self.process.stdin.write("FLUSH TABLES WITH READ LOCK;\nSELECT 'locked';\n")
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+        if self.process.stdout.readline().strip() != "locked":
+            self.process.kill()
+            self.process.wait()
+            raise LuhError(f"Could not lock the DB: {self.stderr.read()}")
+
+        self.locked_at = monotonic()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.release()
+        else:
+            try:
+                self.release()
+            except LuhError:
+                pass
+
+    def release(self):
+        """
+        Releases the lock. Raises an error if the session holding it stopped
+        before, as the lock may then have been lost at any time.
+        """
+
+        with self.mutex:
+            if self.locked_at is None:
+                return
+
+            self.held_for = monotonic() - self.locked_at
+            self.locked_at = None
+
+            try:
+                self.process.stdin.write("UNLOCK TABLES;\n")
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+            self.process.wait()
+
+            if self.process.returncode:
+                raise LuhError(f"The lock of the DB was lost: {self.stderr.read()}")
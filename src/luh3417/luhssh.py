@@ -1,7 +1,10 @@
+from os.path import exists
 from shlex import quote
 from shutil import rmtree
-from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired, run
 from tempfile import mkdtemp
+from threading import Lock
+from time import monotonic, sleep
 from typing import Dict, Optional, Text, Tuple, Union
 
 from luh3417.utils import make_doer
@@ -73,10 +76,16 @@ class SshManager:
     """
 
     _instances: Dict[Tuple, "SshManager"] = {}
+    _instances_lock = Lock()
 
     forward_agent = True
     compress = False
 
+    # The master gives up after this many seconds without answer from the
+    # server, so that a dead connection is noticed instead of hanging
+    alive_interval = 15
+    alive_count_max = 3
+
     def __init__(self, user: Text, host: Text, port: Text):
         """
         Dont call directly! Use instance() instead.
@@ -87,6 +96,7 @@ class SshManager:
         self.port: Text = port
         self.control_dir: Text = None
         self.process: Popen = None
+        self.lock = Lock()
 
     @property
     def control(self):
@@ -114,6 +124,8 @@ class SshManager:
                     "ControlPath": self.control,
                     "ControlMaster": "yes",
                     "ControlPersist": "no",
+                    "ServerAliveInterval": self.alive_interval,
+                    "ServerAliveCountMax": self.alive_count_max,
                 },
                 nothing=True,
                 forward_agent=self.forward_agent,
@@ -146,6 +158,71 @@ class SshManager:
         if self.control_dir:
             rmtree(self.control_dir)
 
+    @property
+    def alive_window(self) -> float:
+        """
+        How long the master can take to notice by itself that the server
+        stopped answering
+        """
+
+        return self.alive_interval * self.alive_count_max
+
+    def is_alive(self) -> bool:
+        """
+        Checks that the master connection still works by running a command
+        through it. The process can still be running while the connection is
+        dead (by example right after the network went down), in which case the
+        command doesn't answer in time.
+        """
+
+        if not self.process or self.process.poll() is not None:
+            return False
+
+        try:
+            cp = run(
+                self.get_args(["true"]),
+                stdin=DEVNULL,
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+                timeout=self.alive_interval,
+            )
+        except TimeoutExpired:
+            return False
+
+        return not cp.returncode
+
+    def wait_ready(self):
+        """
+        Waits for the master to accept sessions (or to give up connecting),
+        so that the commands which follow a reconnection don't fail straight
+        away
+        """
+
+        deadline = monotonic() + self.alive_window
+
+        while monotonic() < deadline and self.process.poll() is None:
+            if exists(self.control):
+                return
+
+            sleep(0.1)
+
+    def reconnect(self):
+        """
+        Starts a new master connection if the current one doesn't work
+        anymore (by example because the network went down)
+        """
+
+        with self.lock:
+            if self.is_alive():
+                return
+
+            doing.logger.debug(
+                f"Reconnecting SSH to {self.user}@{self.host}:{self.port}"
+            )
+            self.cleanup()
+            self.start()
+            self.wait_ready()
+
     def get_args(self, args):
         """
         Generating args for a child connection using this master
@@ -160,6 +237,22 @@ class SshManager:
             forward_agent=self.forward_agent,
         ) + [quote(a) for a in args]
 
+    def get_dedicated_args(self, args):
+        """
+        Generating args for a connection of its own (not going through the
+        master), so that transfers running in parallel don't share a single
+        TCP stream
+        """
+
+        return make_ssh_args(
+            self.user,
+            self.host,
+            self.port,
+            options={"ControlPath": "none"},
+            compress=self.compress,
+            forward_agent=self.forward_agent,
+        ) + [quote(a) for a in args]
+
     @classmethod
     def instance(cls, user, host, port=None) -> "SshManager":
         """
@@ -171,11 +264,13 @@ class SshManager:
 
         key = (user, host, port)
 
-        if key not in cls._instances:
-            cls._instances[key] = cls(user, host, port)
-            cls._instances[key].start()
+        # Steps can run in threads, only one of them must start the master
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(user, host, port)
+                cls._instances[key].start()
 
-        return cls._instances[key]
+            return cls._instances[key]
 
     @classmethod
     def shutdown(cls):
@@ -0,0 +1,575 @@
+import gzip
+import json
+import subprocess
+import tarfile
+import zlib
+from dataclasses import dataclass, replace
+from hashlib import sha256
+from io import BytesIO
+from posixpath import basename, dirname, join
+from secrets import token_hex
+from shlex import quote
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import time
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set, Text, Tuple
+
+from luh3417.luhfs import LocalLocation, Location, replace_archive_suffix
+from luh3417.utils import LuhError
+
+CHUNKS_DIR = "chunks"
+MANIFEST_SUFFIX = ".manifest.gz"
+PART_SUFFIX = ".part"
+
+# Temporary chunks older than this were left by an interrupted snapshot
+STALE_PART_MINUTES = 24 * 60
+
+# Chunks deleted by a single command when pruning the store
+PRUNE_BATCH_SIZE = 1000
+
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+# Gear rolling hash: each byte shifts the hash by one bit, so that its top bits
+# only depend on the last GEAR_BITS bytes. The table must never change, or the
+# chunks of the store would no longer match the new ones.
+GEAR_BITS = 30
+GEAR_MASK = (1 << GEAR_BITS) - 1
+GEAR = [
+    int.from_bytes(sha256(bytes([i])).digest()[:4], "big") & GEAR_MASK
+    for i in range(256)
+]
+
+# Normalized chunking: cuts are harder to find before the average size and
+# easier after, which keeps most chunks close to it
+CHUNK_MASK_BEFORE_AVG = ((1 << 22) - 1) << (GEAR_BITS - 22)
+CHUNK_MASK_AFTER_AVG = ((1 << 18) - 1) << (GEAR_BITS - 18)
+
+
+def find_cut(buf: bytes) -> int:
+    """
+    Finds the end of the chunk which starts at the beginning of buf.
+
+    Cut points are content-defined so that an insertion or a deletion only
+    changes the chunks around it: a position is a cut point when the top bits
+    of the gear hash of the bytes preceding it are zero. The bytes before the
+    minimum size can't be cut points so they are not even hashed.
+    """
+
+    end = min(len(buf), CHUNK_MAX_SIZE)
+
+    if end <= CHUNK_MIN_SIZE:
+        return end
+
+    normal = min(end, CHUNK_AVG_SIZE)
+    gear = GEAR
+    h = 0
+    i = CHUNK_MIN_SIZE
+
+    for b in buf[CHUNK_MIN_SIZE:normal]:
+        h = ((h << 1) + gear[b]) & GEAR_MASK
+        i += 1
+
+        if not h & CHUNK_MASK_BEFORE_AVG:
+            return i
+
+    for b in buf[normal:end]:
+        h = ((h << 1) + gear[b]) & GEAR_MASK
+        i += 1
+
+        if not h & CHUNK_MASK_AFTER_AVG:
+            return i
+
+    return end
+
+
+def iter_chunks(fp: BinaryIO) -> Iterator[bytes]:
+    """
+    Splits the content of a file into content-defined chunks
+    """
+
+    buf = b""
+    eof = False
+
+    while True:
+        while not eof and len(buf) < CHUNK_MAX_SIZE:
+            data = fp.read(CHUNK_MAX_SIZE)
+
+            if data:
+                buf += data
+            else:
+                eof = True
+
+        if not buf:
+            return
+
+        cut = find_cut(buf)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+def chunk_path(digest: Text) -> Text:
+    """
+    Path of a chunk, relatively to the store
+    """
+
+    return join(CHUNKS_DIR, digest[:2], digest)
+
+
+def is_manifest(path: Text) -> bool:
+    """
+    Tells if the snapshot at this path is a manifest of a deduplicating store
+    """
+
+    return path.endswith(MANIFEST_SUFFIX)
+
+
+def apply_manifest_suffix(template: Text) -> Text:
+    """
+    Replaces the archive extension of a file name template by the manifest
+    suffix
+    """
+
+    return replace_archive_suffix(template, MANIFEST_SUFFIX)
+
+
+def list_chunks(store: Location) -> Set[Text]:
+    """
+    Lists the chunks which already exist in the store. Temporary chunks left
+    by interrupted snapshots are cleaned up on the way.
+    """
+
+    chunks = join(store.path, CHUNKS_DIR)
+    out, err, ret = store.run_script(
+        f"""
+            mkdir -p {quote(chunks)} \\
+            && find {quote(chunks)} -type f -name '*{PART_SUFFIX}' \\
+                -mmin +{STALE_PART_MINUTES} -delete \\
+            && find {quote(chunks)} -type f ! -name '*{PART_SUFFIX}' -printf '%f\\n'
+        """
+    )
+
+    if ret:
+        raise LuhError(f"Could not list the chunks of {store}: {err}")
+
+    return set(out.split())
+
+
+class StoreWriter:
+    """
+    Writes a snapshot into a content-addressed store. It's fed like a TarFile
+    (through addfile()) and splits the content of files into chunks which are
+    stored by hash, so that content which is already in the store is not
+    uploaded again. The list of members with their chunks is written into a
+    manifest when closing.
+
+    New chunks are uploaded through a single tar stream extracted in the
+    store, with a temporary name unique to this snapshot. Only the chunks
+    uploaded by this snapshot get their final name (as well as the manifest)
+    once everything is written, so that an interrupted or concurrent
+    snapshot can't leave broken chunks behind.
+    """
+
+    def __init__(self, store: Location, manifest_name: Text):
+        self.store = store
+        self.manifest_name = manifest_name
+        self.part_suffix = f".{token_hex(8)}{PART_SUFFIX}"
+        self.known: Set[Text] = set()
+        self.uploaded: List[Text] = []
+        self.members: List[Dict] = []
+        self.process: Optional[subprocess.Popen] = None
+        self.upload: Optional[tarfile.TarFile] = None
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self.reused_chunks = 0
+
+    def __enter__(self):
+        self.known = list_chunks(self.store)
+
+        # The temporary manifest tells prune_store() that a snapshot is being
+        # written (it's overwritten by the real one on closing)
+        self.store.child(self.manifest_name + self.part_suffix).set_content("")
+
+        self.process = self.store.popen(
+            ["tar", "-C", self.store.path, "-x"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        self.upload = tarfile.open(fileobj=self.process.stdin, mode="w|")
+
+        return self
+
+    def add_bytes(self, name: Text, data: bytes):
+        """
+        Uploads a file into the store
+        """
+
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = int(time())
+        self.upload.addfile(info, BytesIO(data))
+
+    def add_chunk(self, chunk: bytes) -> Text:
+        """
+        Stores a chunk if it's not known yet and returns its hash
+        """
+
+        digest = sha256(chunk).hexdigest()
+
+        if digest in self.known:
+            self.reused_chunks += 1
+        else:
+            compressed = zlib.compress(chunk)
+            self.add_bytes(chunk_path(digest) + self.part_suffix, compressed)
+            self.known.add(digest)
+            self.uploaded.append(digest)
+            self.new_chunks += 1
+            self.new_bytes += len(compressed)
+
+        return digest
+
+    def addfile(self, tarinfo: tarfile.TarInfo, fileobj: Optional[BinaryIO] = None):
+        """
+        Adds a member to the snapshot, the same way as TarFile.addfile()
+        """
+
+        chunks = []
+
+        if fileobj is not None:
+            chunks = [self.add_chunk(c) for c in iter_chunks(fileobj)]
+
+        self.members.append(
+            {
+                "name": tarinfo.name,
+                "type": tarinfo.type.decode(),
+                "mode": tarinfo.mode,
+                "uid": tarinfo.uid,
+                "gid": tarinfo.gid,
+                "uname": tarinfo.uname,
+                "gname": tarinfo.gname,
+                "mtime": tarinfo.mtime,
+                "size": tarinfo.size if fileobj is not None else 0,
+                "linkname": tarinfo.linkname,
+                "chunks": chunks,
+            }
+        )
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                manifest = json.dumps({"version": 1, "members": self.members})
+                self.add_bytes(
+                    self.manifest_name + self.part_suffix,
+                    gzip.compress(manifest.encode("utf-8")),
+                )
+
+            self.upload.close()
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        err = self.process.stderr.read()
+        self.process.wait()
+
+        if exc_type is not None:
+            return
+
+        if self.process.returncode:
+            raise LuhError(f"Could not write into the store {self.store}: {err}")
+
+        self.commit()
+
+    def commit(self):
+        """
+        Gives their final name to the chunks uploaded by this snapshot and to
+        its manifest
+        """
+
+        renames = [
+            (chunk_path(digest) + self.part_suffix, chunk_path(digest))
+            for digest in self.uploaded
+        ]
+        renames.append((self.manifest_name + self.part_suffix, self.manifest_name))
+
+        out, err, ret = self.store.run_script(
+            "set -e\n"
+            f"cd {quote(self.store.path)}\n"
+            + "".join(f"mv -- {quote(a)} {quote(b)}\n" for a, b in renames)
+        )
+
+        if ret:
+            raise LuhError(f"Could not commit the snapshot into {self.store}: {err}")
+
+
+class ChunkReader:
+    """
+    File-like object reading the content of a file from its chunks
+    """
+
+    def __init__(self, root: Text, digests: List[Text]):
+        self.root = root
+        self.digests = iter(digests)
+        self.buffer = b""
+        self.pos = 0
+
+    def load_next(self) -> bool:
+        """
+        Loads the next chunk into the buffer, returns False if there is none
+        """
+
+        try:
+            digest = next(self.digests)
+        except StopIteration:
+            return False
+
+        try:
+            with open(join(self.root, chunk_path(digest)), "rb") as f:
+                self.buffer = zlib.decompress(f.read())
+                self.pos = 0
+        except (OSError, zlib.error) as e:
+            raise LuhError(f"Could not read chunk {digest}: {e}")
+
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+
+        while size != 0:
+            if self.pos >= len(self.buffer) and not self.load_next():
+                break
+
+            end = len(self.buffer) if size < 0 else self.pos + size
+            part = self.buffer[self.pos : end]
+            self.pos += len(part)
+            parts.append(part)
+
+            if size > 0:
+                size -= len(part)
+
+        return b"".join(parts)
+
+
+def read_manifest(location: Location) -> Dict:
+    """
+    Reads and decodes a manifest from the store
+    """
+
+    p = location.popen(
+        ["cat", location.path], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    data, err = p.communicate()
+
+    if p.returncode:
+        raise LuhError(f"Could not read manifest {location}: {err}")
+
+    try:
+        return json.loads(gzip.decompress(data).decode("utf-8"))
+    except (OSError, ValueError) as e:
+        raise LuhError(f"Manifest {location} is corrupted: {e}")
+
+
+def fetch_chunks(store: Location, digests: Set[Text], target_dir: Text):
+    """
+    Copies the chunks from the store to a local directory through a single
+    tar stream
+    """
+
+    source = store.popen(
+        ["tar", "-C", store.path, "-c", "-T", "-"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    target = subprocess.Popen(
+        ["tar", "-C", target_dir, "-x"],
+        stdin=source.stdout,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    source.stdout.close()
+
+    def feed():
+        try:
+            for digest in digests:
+                source.stdin.write(f"{chunk_path(digest)}\n".encode())
+
+            source.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    feeder = Thread(target=feed)
+    feeder.start()
+
+    _, target_err = target.communicate()
+    feeder.join()
+    source_err = source.stderr.read()
+    source.wait()
+
+    if source.returncode:
+        raise LuhError(f"Could not read chunks from {store}: {source_err[:1000]}")
+
+    if target.returncode:
+        raise LuhError(f"Could not write chunks locally: {target_err[:1000]}")
+
+
+def extract_manifest_to_dir(location: Location, target_dir: Text):
+    """
+    Rebuilds the snapshot described by the manifest at this location into
+    the target dir. Chunks are fetched from the store (unless it is local),
+    assembled into a tar stream and extracted by tar (so permissions, links
+    and so on are restored like with a regular archive).
+    """
+
+    store = replace(location, path=dirname(location.path))
+    manifest = read_manifest(location)
+
+    with TemporaryDirectory() as cache:
+        if isinstance(store, LocalLocation):
+            root = store.path
+        else:
+            digests = set(c for m in manifest["members"] for c in m["chunks"])
+            fetch_chunks(store, digests, cache)
+            root = cache
+
+        tar = subprocess.Popen(
+            ["tar", "-C", target_dir, "-x"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+        try:
+            with tarfile.open(
+                fileobj=tar.stdin, mode="w|", format=tarfile.PAX_FORMAT
+            ) as out:
+                for member in manifest["members"]:
+                    info = tarfile.TarInfo(member["name"])
+                    info.type = member["type"].encode()
+                    info.size = member["size"]
+
+                    for k in ["mode", "uid", "gid", "uname", "gname", "mtime"]:
+                        setattr(info, k, member[k])
+
+                    info.linkname = member["linkname"]
+
+                    if member["chunks"]:
+                        out.addfile(info, ChunkReader(root, member["chunks"]))
+                    else:
+                        out.addfile(info)
+
+            tar.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        err = tar.stderr.read()
+        tar.wait()
+
+        if tar.returncode:
+            raise LuhError(
+                f"Error while extracting {basename(location.path)}: {err[:1000]}"
+            )
+
+
+@dataclass
+class PruneStats:
+    """
+    Outcome of the pruning of a store
+    """
+
+    manifests: int = 0
+    kept_chunks: int = 0
+    deleted_chunks: int = 0
+    deleted_bytes: int = 0
+    missing_chunks: int = 0
+
+
+def list_store_files(store: Location) -> Tuple[List[Text], Dict[Text, int], List[Text]]:
+    """
+    Lists the manifests of the store, its chunks (with their size) and the
+    snapshots currently being written into it. Temporary manifests left by
+    interrupted snapshots are cleaned up on the way.
+    """
+
+    chunks = join(store.path, CHUNKS_DIR)
+    in_progress = f"*{MANIFEST_SUFFIX}.*{PART_SUFFIX}"
+    out, err, ret = store.run_script(
+        f"""
+            set -e
+            mkdir -p {quote(chunks)}
+            find {quote(store.path)} -maxdepth 1 -type f -name '{in_progress}' \\
+                -mmin +{STALE_PART_MINUTES} -delete
+            find {quote(store.path)} -maxdepth 1 -type f -name '{in_progress}' \\
+                -printf 'P\\t%f\\n'
+            find {quote(store.path)} -maxdepth 1 -type f -name '*{MANIFEST_SUFFIX}' \\
+                -printf 'M\\t%f\\n'
+            find {quote(chunks)} -type f ! -name '*{PART_SUFFIX}' \\
+                -printf 'C\\t%f\\t%s\\n'
+        """
+    )
+
+    if ret:
+        raise LuhError(f"Could not list the content of {store}: {err}")
+
+    manifests, sizes, writing = [], {}, []
+
+    for line in out.splitlines():
+        kind, name, *size = line.split("\t")
+
+        if kind == "M":
+            manifests.append(name)
+        elif kind == "P":
+            writing.append(name)
+        elif kind == "C":
+            sizes[name] = int(size[0])
+
+    return sorted(manifests), sizes, writing
+
+
+def prune_store(store: Location, dry_run: bool = False) -> PruneStats:
+    """
+    Deletes the chunks which are not referenced by any manifest of the store
+    anymore (typically once old manifests were deleted), by marking the chunks
+    of all the manifests then sweeping the others.
+
+    This can't run while a snapshot is being written into the store, since
+    that snapshot might reuse chunks which are not referenced yet.
+    """
+
+    manifests, sizes, writing = list_store_files(store)
+
+    if writing:
+        raise LuhError(
+            f"Snapshots are being written into {store}, try again later: "
+            + ", ".join(writing)
+        )
+
+    stats = PruneStats(manifests=len(manifests))
+    referenced = set()
+
+    for name in manifests:
+        manifest = read_manifest(store.child(name))
+        referenced.update(c for m in manifest["members"] for c in m["chunks"])
+
+    garbage = [digest for digest in sizes if digest not in referenced]
+    stats.kept_chunks = len(sizes) - len(garbage)
+    stats.deleted_chunks = len(garbage)
+    stats.deleted_bytes = sum(sizes[digest] for digest in garbage)
+    stats.missing_chunks = len(referenced - sizes.keys())
+
+    if dry_run:
+        return stats
+
+    for i in range(0, len(garbage), PRUNE_BATCH_SIZE):
+        paths = [chunk_path(digest) for digest in garbage[i : i + PRUNE_BATCH_SIZE]]
+        out, err, ret = store.run_script(
+            f"cd {quote(store.path)} && rm -f -- "
+            + " ".join(quote(path) for path in paths)
+        )
+
+        if ret:
+            raise LuhError(f"Could not delete chunks from {store}: {err}")
+
+    return stats
@@ -0,0 +1,90 @@
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Text
+
+from luh3417.luhmeter import RateLimiter
+from luh3417.utils import parse_size
+
+IONICE_CLASSES = {"idle": "3", "best-effort": "2"}
+
+
+def parse_rate(value: Text) -> int:
+    """
+    Parses a byte rate like `500K` or `10M` (per second) into bytes per second
+    """
+
+    return parse_size(re.sub(r"/s$", "", value.strip(), flags=re.IGNORECASE))
+
+
+@dataclass
+class Throttle:
+    """
+    Limits the impact of a snapshot on a (production) source: commands run
+    on the source get a lower CPU (nice) and I/O (ionice) priority, and the
+    data read from it is capped to a byte rate.
+
+    The rate limiter is shared by all the streams coming from the source (DB
+    dump and files, which can run concurrently) so that the cap applies to
+    their sum.
+    """
+
+    nice: Optional[int] = None
+    ionice: Optional[Text] = None
+    bwlimit: Optional[int] = None
+    limiter: Optional[RateLimiter] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        if self.bwlimit:
+            self.limiter = RateLimiter(self.bwlimit)
+
+    def wrap(self, args: Sequence[Text]) -> List[Text]:
+        """
+        Prefixes a command with nice/ionice
+        """
+
+        prefix = []
+
+        if self.nice is not None:
+            prefix += ["nice", "-n", f"{self.nice}"]
+
+        if self.ionice:
+            prefix += ["ionice", "-c", IONICE_CLASSES[self.ionice]]
+
+        return prefix + list(args)
+
+    def rsync_args(self) -> List[Text]:
+        """
+        Arguments for rsync to apply the bandwidth limit (in KiB/s)
+        """
+
+        if not self.bwlimit:
+            return []
+
+        return [f"--bwlimit={max(1, self.bwlimit // 1024)}"]
+
+    def __str__(self):
+        limits = []
+
+        if self.nice is not None:
+            limits.append(f"nice {self.nice}")
+
+        if self.ionice:
+            limits.append(f"ionice {self.ionice}")
+
+        if self.bwlimit:
+            limits.append(f"{self.bwlimit / 1024 ** 2:.1f} MiB/s")
+
+        return ", ".join(limits) or "no limits"
+
+    def __bool__(self):
+        return self.nice is not None or bool(self.ionice) or bool(self.bwlimit)
+
+
+def get_limiter(throttle: Optional[Throttle]) -> Optional[RateLimiter]:
+    """
+    The rate limiter of a throttle, if any
+    """
+
+    return throttle.limiter if throttle else None
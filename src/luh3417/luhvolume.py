@@ -0,0 +1,401 @@
+import json
+import shutil
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import replace
+from hashlib import sha256
+from posixpath import basename, dirname, join
+from tempfile import TemporaryFile
+from typing import IO, BinaryIO, Dict, Iterator, List, Optional, Text, Tuple
+
+from luh3417.luhfs import (
+    Location,
+    SshLocation,
+    get_compression_command,
+    get_compression_program,
+    get_decompression_args,
+)
+from luh3417.luhmeter import RELAY_BUFFER_SIZE, Meter
+from luh3417.luhssh import SshManager
+from luh3417.utils import LuhError
+
+VOLUMES_SUFFIX = ".volumes"
+DEFAULT_VOLUME_JOBS = 4
+
+
+def is_multi_volume(path: Text) -> bool:
+    """
+    Tells if the snapshot at this path is the index of a multi-volume archive
+    """
+
+    return path.endswith(VOLUMES_SUFFIX)
+
+
+def get_volumes_index(archive: Location) -> Location:
+    """
+    Location of the index of a multi-volume archive
+    """
+
+    return replace(archive, path=archive.path + VOLUMES_SUFFIX)
+
+
+def get_volume(archive: Location, n: int) -> Location:
+    """
+    Location of the n-th volume of an archive
+    """
+
+    return replace(archive, path=f"{archive.path}.{n:04d}")
+
+
+def volume_popen(location: Location, args: List[Text], **kwargs) -> subprocess.Popen:
+    """
+    Starts a process for the transfer of a volume. Remote processes get an
+    SSH connection of their own, so that volumes transferred in parallel
+    really go through parallel TCP streams.
+    """
+
+    if isinstance(location, SshLocation):
+        manager = SshManager.instance(location.user, location.host, location.port)
+        args = manager.get_dedicated_args(location.throttled(args))
+
+        return subprocess.Popen(args, **kwargs)
+
+    return location.popen(args, **kwargs)
+
+
+def spool_volume(
+    source: IO, size: int, meter: Optional[Meter]
+) -> Optional[Tuple[BinaryIO, int, Text]]:
+    """
+    Reads up to `size` bytes from the source into a temporary file. Returns
+    the file (rewound), the size which was read and its SHA-256, or None if
+    the source is exhausted.
+    """
+
+    fp = TemporaryFile()
+    h = sha256()
+    read = 0
+
+    while read < size:
+        data = source.read(min(RELAY_BUFFER_SIZE, size - read))
+
+        if not data:
+            break
+
+        fp.write(data)
+        h.update(data)
+        read += len(data)
+
+        if meter:
+            meter.add(len(data))
+
+    if not read:
+        fp.close()
+        return None
+
+    fp.seek(0)
+
+    return fp, read, h.hexdigest()
+
+
+def upload_volume(location: Location, fp: BinaryIO):
+    """
+    Writes a spooled volume at its location
+    """
+
+    try:
+        p = volume_popen(
+            location,
+            ["dd", f"of={location.path}", "bs=1M"],
+            stdin=fp,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        _, err = p.communicate()
+    finally:
+        fp.close()
+
+    if p.returncode:
+        err = err.decode("utf-8", "replace")
+        raise LuhError(f"Could not write volume {location}: {err[:1000]}")
+
+
+def write_volumes(
+    source: IO,
+    archive: Location,
+    volume_size: int,
+    jobs: int = DEFAULT_VOLUME_JOBS,
+    meter: Optional[Meter] = None,
+) -> List[Dict]:
+    """
+    Splits the (compressed) archive coming from the source into volumes of
+    `volume_size` bytes. Each volume is spooled on the local disk then
+    uploaded, up to `jobs` at the same time (the next volume is only spooled
+    once an upload slot is free, to bound the local disk usage). Returns the
+    list of volumes (with their size and SHA-256), to be written in the index
+    once the archive is known to be complete.
+
+    Concatenating the volumes gives back the regular archive.
+    """
+
+    volumes = []
+    uploads: List[Future] = []
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            running = [f for f in uploads if not f.done()]
+
+            if len(running) >= jobs:
+                wait(running, return_when=FIRST_COMPLETED)
+
+            if any(f.done() and f.exception() for f in uploads):
+                # Let the producer finish, the error is reported below
+                while source.read(RELAY_BUFFER_SIZE):
+                    pass
+
+                break
+
+            volume = spool_volume(source, volume_size, meter)
+
+            if volume is None:
+                break
+
+            fp, size, digest = volume
+            location = get_volume(archive, len(volumes))
+            volumes.append(
+                {"name": basename(location.path), "size": size, "sha256": digest}
+            )
+            uploads.append(pool.submit(upload_volume, location, fp))
+
+    if meter:
+        meter.done()
+
+    errors = []
+
+    for future in uploads:
+        try:
+            future.result()
+        except LuhError as e:
+            errors.append(e.message)
+
+    if errors:
+        raise LuhError("\n".join(errors))
+
+    return volumes
+
+
+def write_volumes_index(
+    archive: Location, volumes: List[Dict], volume_size: int
+) -> Location:
+    """
+    Writes the index of the volumes, which makes the archive complete, and
+    returns its location
+    """
+
+    index = get_volumes_index(archive)
+    index.set_content(
+        json.dumps(
+            {
+                "version": 1,
+                "archive": basename(archive.path),
+                "volume_size": volume_size,
+                "volumes": volumes,
+            }
+        )
+    )
+
+    return index
+
+
+def archive_dir_to_volumes(
+    local_path: Text,
+    archive: Location,
+    volume_size: int,
+    jobs: int = DEFAULT_VOLUME_JOBS,
+    expected_size: Optional[int] = None,
+) -> Location:
+    """
+    Same as Location.archive_local_dir() but writes the archive as volumes,
+    see write_volumes(). Returns the location of the index.
+    """
+
+    tar = subprocess.Popen(
+        ["tar", "-C", local_path, "-c", "-I"]
+        + [get_compression_program(archive.compression_mode, archive.compression_level)]
+        + ["."],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    meter = Meter(f"Writing {archive}", expected_size) if Meter.enabled else None
+
+    try:
+        volumes = write_volumes(tar.stdout, archive, volume_size, jobs, meter)
+    finally:
+        tar.stdout.close()
+        tar_err = tar.stderr.read()
+        tar.wait()
+
+    if tar.returncode:
+        raise LuhError(f"Could not create the archive: {tar_err}")
+
+    return write_volumes_index(archive, volumes, volume_size)
+
+
+@contextmanager
+def open_volumes_stream(
+    archive: Location,
+    volume_size: int,
+    jobs: int = DEFAULT_VOLUME_JOBS,
+    expected_size: Optional[int] = None,
+) -> Iterator[BinaryIO]:
+    """
+    Same as Location.open_archive_stream() but the compressed archive is
+    written as volumes, see write_volumes(). The index is only written if
+    the whole archive was written without error.
+    """
+
+    compress = subprocess.Popen(
+        get_compression_command(archive.compression_mode, archive.compression_level),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    meter = Meter(f"Writing {archive}", expected_size) if Meter.enabled else None
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        splitter = pool.submit(
+            write_volumes, compress.stdout, archive, volume_size, jobs, meter
+        )
+
+        try:
+            yield compress.stdin
+        finally:
+            try:
+                compress.stdin.close()
+            except BrokenPipeError:
+                pass
+
+            error = splitter.exception()
+            compress_err = compress.stderr.read()
+            compress.wait()
+
+    if error:
+        raise error
+
+    if compress.returncode:
+        raise LuhError(f"Could not compress the archive: {compress_err}")
+
+    write_volumes_index(archive, splitter.result(), volume_size)
+
+
+def read_volumes_index(index: Location) -> Dict:
+    """
+    Reads the index of a multi-volume archive
+    """
+
+    try:
+        return json.loads(index.get_content())
+    except ValueError as e:
+        raise LuhError(f"Index {index} is corrupted: {e}")
+
+
+def download_volume(location: Location, volume: Dict) -> BinaryIO:
+    """
+    Downloads a volume into a temporary file (rewound) and checks it
+    """
+
+    fp = TemporaryFile()
+    h = sha256()
+    p = volume_popen(
+        location,
+        ["cat", location.path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    for data in iter(lambda: p.stdout.read1(RELAY_BUFFER_SIZE), b""):
+        fp.write(data)
+        h.update(data)
+
+    err = p.stderr.read().decode("utf-8", "replace")
+    p.wait()
+
+    if p.returncode:
+        fp.close()
+        raise LuhError(f"Could not read volume {location}: {err[:1000]}")
+
+    if fp.tell() != volume["size"] or h.hexdigest() != volume["sha256"]:
+        fp.close()
+        raise LuhError(f"Volume {location} is corrupted")
+
+    fp.seek(0)
+
+    return fp
+
+
+def extract_volumes_to_dir(
+    index: Location, target_dir: Text, jobs: int = DEFAULT_VOLUME_JOBS
+):
+    """
+    Extracts a multi-volume archive into the target dir. Volumes are
+    downloaded in parallel (up to `jobs` at the same time) while the ones
+    already there are fed in order into tar, so the archive is reassembled
+    on the fly and only a few volumes are on the local disk at any time.
+    """
+
+    content = read_volumes_index(index)
+    volumes = content["volumes"]
+    archive = replace(index, path=join(dirname(index.path), content["archive"]))
+    meter = Meter(f"Reading {index}") if Meter.enabled else None
+
+    tar = subprocess.Popen(
+        ["tar", "-C", target_dir, "-x"] + get_decompression_args(archive.path),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        downloads: Dict[int, Future] = {}
+
+        try:
+            for i in range(len(volumes)):
+                for j in range(i, min(i + jobs, len(volumes))):
+                    if j not in downloads:
+                        location = replace(
+                            archive, path=join(dirname(index.path), volumes[j]["name"])
+                        )
+                        downloads[j] = pool.submit(
+                            download_volume, location, volumes[j]
+                        )
+
+                with downloads.pop(i).result() as fp:
+                    shutil.copyfileobj(fp, tar.stdin, RELAY_BUFFER_SIZE)
+
+                if meter:
+                    meter.add(volumes[i]["size"])
+        except BrokenPipeError:
+            pass
+        except LuhError:
+            tar.kill()
+            raise
+        finally:
+            for future in downloads.values():
+                future.cancel()
+
+            # Also needed after a kill, as the decompressor started by tar
+            # reads the same pipe
+            try:
+                tar.stdin.close()
+            except BrokenPipeError:
+                pass
+
+            tar_err = tar.stderr.read()
+            tar.wait()
+
+    if meter:
+        meter.done()
+
+    if tar.returncode:
+        raise LuhError(f"Error while extracting the archive: {tar_err[:1000]}")
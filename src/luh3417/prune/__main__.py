@@ -0,0 +1,68 @@
+from argparse import ArgumentParser, Namespace
+from typing import Optional, Sequence
+
+from luh3417.luhfs import parse_location
+from luh3417.luhstore import PruneStats, prune_store
+from luh3417.utils import make_doer, run_main, setup_logging
+
+doing = make_doer("luh3417.prune")
+
+
+def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
+    """
+    Parse arguments for the pruning
+    """
+
+    parser = ArgumentParser(
+        prog="python -m luh3417.prune",
+        description=(
+            "Deletes the chunks of a deduplicating store (see snapshot "
+            "--archive-format dedup) which are not used by any of its "
+            "manifests anymore. Delete the manifests of the snapshots you "
+            "don't want to keep first. Refuses to run while a snapshot is "
+            "being written into the store."
+        ),
+    )
+
+    parser.add_argument("store", help="Location of the store", type=parse_location)
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        help="Only report what would be deleted",
+        action="store_true",
+    )
+
+    return parser.parse_args(args)
+
+
+def main(args: Optional[Sequence[str]] = None) -> PruneStats:
+    """
+    Prunes the store
+    """
+
+    setup_logging()
+    args = parse_args(args)
+
+    with doing(f"Pruning {args.store}"):
+        stats = prune_store(args.store, args.dry_run)
+
+    doing.logger.info(
+        "%s %s unused chunks (%.1f MiB), kept %s chunks used by %s manifests",
+        "Would delete" if args.dry_run else "Deleted",
+        stats.deleted_chunks,
+        stats.deleted_bytes / 1024 ** 2,
+        stats.kept_chunks,
+        stats.manifests,
+    )
+
+    if stats.missing_chunks:
+        doing.logger.error(
+            "%s chunks used by the manifests are missing from the store",
+            stats.missing_chunks,
+        )
+
+    return stats
+
+
+if __name__ == "__main__":
+    run_main(main, doing)
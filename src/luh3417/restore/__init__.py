@@ -1,12 +1,47 @@
 import json
+import subprocess
+from collections import defaultdict
+from dataclasses import replace
 from json import JSONDecodeError
-from typing import Dict, List, Optional, Text
-
-from luh3417.luhfs import Location, parse_location
-from luh3417.luhsql import LuhSql, create_root_from_source
+from logging import Logger
+from os import listdir, makedirs
+from os.path import dirname, getsize, isdir, join
+from shlex import quote
+from tempfile import NamedTemporaryFile
+from typing import Callable, Dict, List, Optional, Text
+
+from luh3417.luhfs import (
+    Location,
+    SshLocation,
+    get_portable_decompression_args,
+    is_same_host,
+    parse_location,
+)
+from luh3417.luhmeter import Meter
+from luh3417.luhmanifest import ManifestCache
+from luh3417.luhphp import set_wp_config_values
+from luh3417.luhsql import (
+    DUMP_SHARDS_DIR,
+    DumpEvent,
+    DumpEventType,
+    DumpPipe,
+    LuhSql,
+    create_from_source,
+    create_root_from_source,
+    patch_sql_dump,
+)
 from luh3417.record_set import RecordSet, Zone, parse_domain
 from luh3417.serialized_replace import ReplaceMap
-from luh3417.snapshot import sync_files
+from luh3417.snapshot import (
+    INCREMENTAL_FILES_NAME,
+    DeltaStats,
+    FileOwner,
+    copy_files,
+    copy_files_with_delete,
+    delta_copy_files,
+    pipe_direct,
+    sync_files,
+)
 from luh3417.utils import LuhError, escape
 
 
@@ -46,28 +81,362 @@ def get_wp_config(config: Dict) -> Dict:
         raise LuhError("Configuration is incomplete, missing wp_config")
 
 
-def restore_files(wp_root: Text, remote: Location):
+def restore_files(
+    wp_root: Text, remote: Location, jobs: int = 1, owner: Optional[FileOwner] = None
+):
     """
-    Restores the file from the local wp_root to the remote location
+    Restores the file from the local wp_root to the remote location, with
+    `jobs` rsync in parallel, giving them the owner (if any)
     """
 
     local = parse_location(wp_root)
-    sync_files(local, remote, delete=True)
+    sync_files(local, remote, delete=True, jobs=jobs, owner=owner)
+
+
+def restore_files_delta(
+    wp_root: Text, remote: Location, cache_dir: Optional[Text] = None
+) -> DeltaStats:
+    """
+    Restores the files from the local wp_root to the remote location, only
+    sending the files which differ from what is already there. The manifest
+    of the remote location is kept in the cache dir, if any.
+    """
+
+    if not cache_dir:
+        return delta_copy_files(wp_root, remote)
+
+    with ManifestCache(remote, cache_dir) as cache:
+        return delta_copy_files(wp_root, remote, cache)
+
+
+def read_archive_member(snap: Location, member: Text) -> bytes:
+    """
+    Reads a single member of the archive, on the machine where it is stored
+    (tar stops as soon as the member is found)
+    """
+
+    p = snap.popen(
+        ["tar", "-x", "--occurrence=1", "-O", "-f", snap.path, member],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    out, err = p.communicate()
+
+    if p.returncode:
+        raise LuhError(f"Could not read {member} from {snap}: {err[:1000]}")
+
+    return out
+
+
+def find_incremental_chain(snap: Location, config: Dict) -> List[Location]:
+    """
+    Finds the archives an incremental snapshot depends on, from the full
+    one to its parent. They are expected next to the snapshot.
+    """
+
+    chain = []
+    incremental = config.get("incremental")
+
+    while incremental and incremental["level"]:
+        parent = replace(snap, path=join(dirname(snap.path), incremental["parent"]))
+        chain.insert(0, parent)
+
+        try:
+            settings = json.loads(read_archive_member(parent, "./settings.json"))
+        except JSONDecodeError as e:
+            raise LuhError(f"Could not decode the settings of {parent}: {e}")
+
+        incremental = settings.get("incremental")
+
+        if incremental is None:
+            raise LuhError(f"{parent} is not an incremental snapshot")
+
+    return chain
+
+
+def extract_incremental_files(chain: List[Location], local_dir: Text):
+    """
+    Applies the incremental archives of the chain in order (each read on the
+    machine where it is stored), then the one extracted in the local dir,
+    into its wordpress directory. Files which were deleted between two
+    archives get deleted as well.
+    """
+
+    target_dir = join(local_dir, "wordpress")
+    extract = ["tar", "-x", "--listed-incremental=/dev/null", "-C", target_dir]
+    makedirs(target_dir, exist_ok=True)
+
+    for archive in chain:
+        source_p = archive.popen(
+            [
+                "tar",
+                "-x",
+                "--occurrence=1",
+                "-O",
+                "-f",
+                archive.path,
+                f"./{INCREMENTAL_FILES_NAME}",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        target_p = subprocess.Popen(
+            extract,
+            stdin=source_p.stdout,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        source_p.stdout.close()
+        _, target_err = target_p.communicate()
+        source_err = source_p.stderr.read()
+        source_p.wait()
+
+        if source_p.returncode:
+            raise LuhError(
+                f"Could not read the files of {archive}: {source_err[:1000]}"
+            )
+
+        if target_p.returncode:
+            raise LuhError(
+                f"Could not extract the files of {archive}: {target_err[:1000]}"
+            )
+
+    cp = subprocess.run(
+        extract + ["-f", join(local_dir, INCREMENTAL_FILES_NAME)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+    if cp.returncode:
+        raise LuhError(f"Could not extract the files: {cp.stderr[:1000]}")
+
+
+def stream_archive_files(snap: Location, remote: Location):
+    """
+    Extracts the wordpress directory of the archive into the remote location.
+    If both are on the same host, the archive is extracted there. Otherwise
+    the archive is streamed into the remote's tar, directly from the
+    snapshot's host if possible.
+    """
+
+    remote.delete_dir_content()
+    remote.ensure_exists_as_dir()
+
+    extract = ["tar", "-C", remote.path, "-x", "--strip-components=2"]
+
+    if is_same_host(snap, remote):
+        _, err, ret = remote.run_script(
+            " ".join(quote(a) for a in extract + ["-f", snap.path, "./wordpress"])
+        )
+
+        if ret:
+            raise LuhError(f"Error while extracting the files: {err[:1000]}")
+
+        return
+
+    extract += get_portable_decompression_args(snap.path) + ["./wordpress"]
+
+    if isinstance(snap, SshLocation) and isinstance(remote, SshLocation):
+        if pipe_direct(snap, ["cat", snap.path], remote, " ".join(map(quote, extract))):
+            return
+
+    source = snap.popen(
+        ["cat", snap.path], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    target = remote.popen(
+        extract, stdin=source.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    source.stdout.close()
+
+    _, target_err = target.communicate()
+    source_err = source.stderr.read()
+    source.wait()
+
+    if source.returncode:
+        raise LuhError(f"Error while reading the archive: {source_err[:1000]}")
+
+    if target.returncode:
+        raise LuhError(f"Error while extracting the files: {target_err[:1000]}")
+
+
+def stream_archive_db(snap: Location, db: LuhSql, replace: Optional[ReplaceMap]):
+    """
+    Reads the dump from the archive (on the machine where it is stored) and
+    imports it into the DB, patching it on the fly
+    """
+
+    source = snap.popen(
+        ["tar", "-x", "-O", "-f", snap.path, "./dump.sql"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    pipe = DumpPipe(db, replace)
+
+    for line in source.stdout:
+        pipe.write(line)
+
+    source_err = source.stderr.read()
+    source.wait()
+    pipe.close()
+
+    if source.returncode:
+        raise LuhError(f"Error while reading the dump: {source_err[:1000]}")
+
 
+def fetch_tree_metadata(tree: Location, target_dir: Text):
+    """
+    Copies the settings and dumps of a tree snapshot into the local target
+    dir. Files are left where they are and restored from the tree directly.
+    """
+
+    copy_files(tree, parse_location(target_dir), ["./wordpress"], None)
+
+
+def restore_tree_files(
+    tree: Location, remote: Location, jobs: int = 1, owner: Optional[FileOwner] = None
+):
+    """
+    Restores the files of a tree snapshot to the remote location. If both
+    are remote, files are relayed through a tar stream, otherwise they are
+    synced with `jobs` rsync in parallel. Files are given the owner (if any).
+    """
+
+    if isinstance(tree, SshLocation) and isinstance(remote, SshLocation):
+        copy_files_with_delete(
+            tree.child("wordpress"), remote, delete=True, owner=owner
+        )
+    else:
+        sync_files(
+            tree.child("wordpress"), remote, delete=True, jobs=jobs, owner=owner
+        )
+
+
+def patch_remote_wp_config(values: Dict, remote: Location):
+    """
+    Sets the values into the wp-config.php of a restored website
+    """
+
+    wp_config = remote.child("wp-config.php")
+
+    with NamedTemporaryFile("w", encoding="utf-8", suffix=".php") as f:
+        f.write(wp_config.get_content())
+        f.flush()
+        set_wp_config_values(values, f.name)
 
-def restore_db(db: LuhSql, dump_path: Text):
+        with open(f.name, "r", encoding="utf-8") as patched:
+            wp_config.set_content(patched.read())
+
+
+def restore_db(db: LuhSql, dump_path: Text, logger: Optional[Logger] = None):
     """
     Restores the specified file into DB, using the wp config and remote
     location to connect the DB.
+
+    If a logger is provided, the dump is parsed on the fly in order to log the
+    progress of the import table by table. The throughput is logged as well
+    unless metering is disabled.
     """
 
+    listener = None
+
     try:
-        with open(dump_path, "r", encoding="utf-8") as f:
-            db.restore_dump(f)
+        size = getsize(dump_path)
+        progress = make_restore_progress(logger, size) if logger is not None else None
+        meter = Meter("Restoring DB", size) if Meter.enabled else None
+
+        if progress or meter:
+
+            def listener(event: DumpEvent):
+                if progress:
+                    progress(event)
+
+                if meter:
+                    meter.add(len(event.data))
+
+        with open(dump_path, "rb") as f:
+            db.restore_dump(f, listener)
+
+        if meter:
+            meter.done()
     except OSError as e:
         raise LuhError(f"Could not read SQL dump: {e}")
 
 
+def make_restore_progress(logger: Logger, total: int) -> Callable[[DumpEvent], None]:
+    """
+    Generates a dump events listener which logs each table being restored
+    along with the rows count of the previous one
+    """
+
+    rows = {}
+
+    def listener(event: DumpEvent):
+        if event.type == DumpEventType.INSERT:
+            rows[event.table] = rows.get(event.table, 0) + event.rows
+        elif event.type in (DumpEventType.TABLE_START, DumpEventType.FOOTER):
+            for table, count in rows.items():
+                logger.debug("Restored %s rows into %s", count, table)
+
+            rows.clear()
+
+            if event.type == DumpEventType.TABLE_START:
+                progress = 100 * event.start / max(1, total)
+                logger.debug("Restoring %s (%.0f%%)", event.table, progress)
+
+    return listener
+
+
+def find_dump_shards(root: Text) -> Dict[Text, List[Text]]:
+    """
+    Lists the table shards found in the extracted snapshot, grouped by table.
+    Each list is sorted so that the shard holding the DDL comes first.
+    """
+
+    shards_dir = join(root, DUMP_SHARDS_DIR)
+    out = defaultdict(list)
+
+    if not isdir(shards_dir):
+        return {}
+
+    for name in sorted(listdir(shards_dir)):
+        parts = name.rsplit(".", 2)
+
+        if len(parts) == 3 and parts[2] == "sql":
+            out[parts[0]].append(join(shards_dir, name))
+
+    return dict(out)
+
+
+def patch_dump_shards(
+    shards: Dict[Text, List[Text]], replace: ReplaceMap
+) -> Dict[Text, List[Text]]:
+    """
+    Applies the replace map on all the shards, returning the paths of the
+    patched shards
+    """
+
+    out = {}
+
+    for table, paths in shards.items():
+        out[table] = []
+
+        for path in paths:
+            new_path = f"{path[:-4]}.patched.sql"
+            patch_sql_dump(path, new_path, replace)
+            out[table].append(new_path)
+
+    return out
+
+
+def restore_db_shards(db: LuhSql, shards: Dict[Text, List[Text]]):
+    """
+    Restores all the sharded tables, their shards being imported
+    concurrently
+    """
+
+    db.restore_table_shards(shards)
+
+
 def run_queries(db: LuhSql, queries: List[Text]):
     """
     Runs all the queries from the config
@@ -113,6 +482,26 @@ def ensure_db_exists(wp_config, mysql_root, source: Location, db_host: Text):
     )
 
 
+def open_dump_pipe(patch_location: Location) -> DumpPipe:
+    """
+    Reads a restore patch in order to prepare the target DB (creating it if
+    `mysql_root` is set) and opens a pipe which imports a dump into it while
+    applying the patch's `replace_in_dump`. This allows to transfer the DB
+    without having to restore it afterwards.
+    """
+
+    config = patch_config({}, patch_location)
+    remote = get_remote(config)
+    wp_config = get_wp_config(config)
+
+    if config["mysql_root"]:
+        ensure_db_exists(wp_config, config["mysql_root"], remote, None)
+
+    db = create_from_source(wp_config, remote, None)
+
+    return DumpPipe(db, make_replace_map(config["replace_in_dump"]))
+
+
 def install_outer_files(outer_files: List[Dict], source: Location):
     """
     Given the list of outer files, sets the appropriate content to the
@@ -4,23 +4,46 @@ from tempfile import TemporaryDirectory
 from typing import Optional, Sequence
 
 from luh3417.luhfs import Location, parse_location
+from luh3417.luhindex import extract_archive_members, read_archive_index
+from luh3417.luhmeter import Meter
 from luh3417.luhphp import set_wp_config_values
-from luh3417.luhsql import create_from_source, patch_sql_dump
+from luh3417.luhresume import Retry
+from luh3417.luhsql import DUMP_SHARDS_DIR, create_from_source, patch_sql_dump
+from luh3417.luhstore import extract_manifest_to_dir, is_manifest
+from luh3417.luhvolume import (
+    DEFAULT_VOLUME_JOBS,
+    extract_volumes_to_dir,
+    is_multi_volume,
+)
+from luh3417.scheduler import StepScheduler
+from luh3417.snapshot import is_tree_snapshot, resolve_owner
 from luh3417.restore import (
     configure_dns,
     ensure_db_exists,
+    extract_incremental_files,
+    fetch_tree_metadata,
+    find_incremental_chain,
+    find_dump_shards,
     get_remote,
     get_wp_config,
     install_outer_files,
     make_replace_map,
     patch_config,
+    patch_dump_shards,
+    patch_remote_wp_config,
+    read_archive_member,
     read_config,
     restore_db,
+    restore_db_shards,
     restore_files,
+    restore_files_delta,
+    restore_tree_files,
+    stream_archive_db,
+    stream_archive_files,
     run_post_install,
     run_queries,
 )
-from luh3417.utils import make_doer, run_main, setup_logging
+from luh3417.utils import LuhError, make_doer, run_main, setup_logging
 
 doing = make_doer("luh3417.restore")
 
@@ -45,8 +68,8 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
     parser.add_argument(
         "snapshot",
         help=(
-            "Location of the snapshot file. Syntax: `~/snap.tar.gz` or "
-            "`user@host:snap.tar.gz`"
+            "Location of the snapshot file (or directory, for tree snapshots). "
+            "Syntax: `~/snap.tar.gz` or `user@host:snap.tar.gz`"
         ),
         type=parse_location,
     )
@@ -61,7 +84,99 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
         nargs="?",
     )
 
-    return parser.parse_args(args)
+    parser.add_argument(
+        "--skip-db",
+        help=(
+            "Do not restore the DB, because it was already imported (by "
+            "example with snapshot's --stream-db-to)"
+        ),
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--delta",
+        help=(
+            "Only send the files whose size, mode or checksum differ from the "
+            "files which are already at the target location (and the "
+            "directories or links whose mode or target differ)"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--manifest-cache",
+        help=(
+            "Local directory where the manifest of the target's files (size, "
+            "mtime, mode, SHA-256) is cached, so that --delta doesn't hash again "
+            "the files which didn't change since the last time"
+        ),
+    )
+
+    parser.add_argument(
+        "--stream",
+        help=(
+            "Don't extract the archive locally: the files are extracted on "
+            "the target (directly from the snapshot's host if possible) and "
+            "the dump is streamed into MySQL. Only settings.json is fetched "
+            "locally."
+        ),
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--no-progress",
+        help="Don't meter the data pipes nor log their throughput",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--retries",
+        help=(
+            "Make the download of the snapshot through SSH resumable: if the "
+            "connection drops, it resumes where it stopped, up to this number "
+            "of times. Defaults to: 0 (not resumable)"
+        ),
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--volume-jobs",
+        help=(
+            "Number of volumes of a multi-volume snapshot downloaded at the "
+            f"same time. Defaults to: {DEFAULT_VOLUME_JOBS}"
+        ),
+        default=DEFAULT_VOLUME_JOBS,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--rsync-jobs",
+        help=(
+            "Number of rsync running in parallel when files are synced to the "
+            "target, each on a part of the tree balanced by size. Defaults "
+            "to: 1"
+        ),
+        default=1,
+        type=int,
+    )
+
+    parsed_args = parser.parse_args(args)
+    path = parsed_args.snapshot.path
+
+    if parsed_args.retries < 0:
+        parser.error("--retries can't be negative")
+
+    if parsed_args.stream and (is_tree_snapshot(path) or is_manifest(path)):
+        parser.error("--stream only works with archives")
+
+    if parsed_args.stream and is_multi_volume(path):
+        parser.error("--stream doesn't work with multi-volume archives")
+
+    if parsed_args.volume_jobs < 1:
+        parser.error("--volume-jobs must be at least 1")
+
+    if parsed_args.rsync_jobs < 1:
+        parser.error("--rsync-jobs must be at least 1")
+
+    return parsed_args
 
 
 def main(args: Optional[Sequence[str]] = None):
@@ -71,78 +186,223 @@ def main(args: Optional[Sequence[str]] = None):
 
     setup_logging()
     args = parse_args(args)
+    Meter.enabled = not args.no_progress
+    Retry.attempts = args.retries
     snap: Location = args.snapshot
+    is_tree = is_tree_snapshot(snap.path)
+    is_volumes = is_multi_volume(snap.path)
+    index = None
+
+    if (
+        not is_tree
+        and not is_manifest(snap.path)
+        and not is_volumes
+        and not args.stream
+    ):
+        with doing("Looking for an archive index"):
+            index = read_archive_index(snap)
 
     with TemporaryDirectory() as d:
-        with doing("Extracting archive"):
-            snap.extract_archive_to_dir(d)
+        if is_tree:
+            with doing("Reading snapshot tree"):
+                fetch_tree_metadata(snap, d)
+        elif args.stream:
+            with doing("Reading settings"), open(join(d, "settings.json"), "wb") as f:
+                f.write(read_archive_member(snap, "./settings.json"))
+        elif index:
+            with doing("Extracting settings"):
+                extract_archive_members(snap, index, ["settings.json"], d)
+        else:
+            with doing("Extracting archive"):
+                if is_manifest(snap.path):
+                    extract_manifest_to_dir(snap, d)
+                elif is_volumes:
+                    extract_volumes_to_dir(snap, d, args.volume_jobs)
+                else:
+                    snap.extract_archive_to_dir(d)
 
         with doing("Reading configuration"):
             config = patch_config(
                 read_config(join(d, "settings.json")), args.patch, args.allow_in_place
             )
 
+            if args.stream and config["args"].get("shard_table") and not args.skip_db:
+                raise LuhError("Snapshots with sharded tables can't be streamed")
+
+            if args.stream and config.get("incremental"):
+                raise LuhError("Incremental snapshots can't be streamed")
+
+        if config.get("incremental") and not args.stream:
+            with doing("Applying the chain of incremental snapshots"):
+                chain = find_incremental_chain(snap, config)
+                doing.logger.info(
+                    "Snapshot of level %s, applying %s previous archive(s)",
+                    config["incremental"]["level"],
+                    len(chain),
+                )
+                extract_incremental_files(chain, d)
+
+        if index:
+            with doing("Extracting archive"):
+                names = ["wordpress"]
+
+                if not args.skip_db:
+                    names += ["dump.sql", DUMP_SHARDS_DIR]
+
+                extract_archive_members(snap, index, names, d)
+
         dump = join(d, "dump.sql")
+        shards = find_dump_shards(d)
+        replace = None
 
-        if config["replace_in_dump"]:
+        if config["replace_in_dump"] and args.stream:
+            replace = make_replace_map(config["replace_in_dump"])
+        elif config["replace_in_dump"] and not args.skip_db:
             with doing("Patch the SQL dump"):
                 new_dump = join(d, "dump_patched.sql")
-                patch_sql_dump(
-                    dump, new_dump, make_replace_map(config["replace_in_dump"])
-                )
+                replace = make_replace_map(config["replace_in_dump"])
+                patch_sql_dump(dump, new_dump, replace)
                 dump = new_dump
+                shards = patch_dump_shards(shards, replace)
 
-        if config["php_define"]:
+        if config["php_define"] and not is_tree and not args.stream:
             with doing("Patch wp-config.php"):
                 set_wp_config_values(
                     config["php_define"], join(d, "wordpress", "wp-config.php")
                 )
 
-        with doing("Restoring files"):
+        with doing("Reading WP config"):
             remote = get_remote(config)
-            restore_files(join(d, "wordpress"), remote)
+            wp_config = get_wp_config(config)
+            db = create_from_source(wp_config, remote, args.db_host)
 
-        if config["git"]:
-            with doing("Cloning Git repos"):
-                for repo in config["git"]:
-                    location = remote.child(repo["location"])
-                    location.set_git_repo(repo["repo"], repo["version"])
+        write_owner = None
+
+        if config["owner"] and not args.stream and not args.delta:
+            with doing("Resolving the owner of the files"):
+                write_owner = resolve_owner(remote, config["owner"])
+
+                if not write_owner:
                     doing.logger.info(
-                        "Cloned %s@%s to %s", repo["repo"], repo["version"], location
+                        "Files can't be given their owner while written, they "
+                        "will be chowned afterwards"
                     )
 
-        if config["owner"]:
-            with doing("Changing files owner"):
+        def restore_files_step():
+            if is_tree:
+                restore_tree_files(snap, remote, args.rsync_jobs, write_owner)
+            elif args.stream:
+                stream_archive_files(snap, remote)
+            elif args.delta:
+                stats = restore_files_delta(
+                    join(d, "wordpress"), remote, args.manifest_cache
+                )
+                doing.logger.info(
+                    "Transferred %s entries (%.1f MiB), skipped %s unchanged "
+                    "entries (%.1f MiB), deleted %s entries",
+                    stats.transferred_entries,
+                    stats.transferred_bytes / 1024 ** 2,
+                    stats.skipped_entries,
+                    stats.skipped_bytes / 1024 ** 2,
+                    stats.deleted,
+                )
+            else:
+                restore_files(
+                    join(d, "wordpress"), remote, args.rsync_jobs, write_owner
+                )
+
+            if config["php_define"] and (is_tree or args.stream):
+                patch_remote_wp_config(config["php_define"], remote)
+
+        def restore_db_step():
+            if args.stream:
+                stream_archive_db(snap, db, replace)
+            else:
+                restore_db(db, dump, doing.logger)
+
+        def change_owner_step():
+            if not write_owner:
                 remote.chown(config["owner"])
+                return
 
-        with doing("Reading WP config"):
-            wp_config = get_wp_config(config)
+            # The files already have their owner, only the repos cloned
+            # afterwards still need it
+            for repo in config["git"]:
+                remote.child(repo["location"]).chown(config["owner"])
 
-        if config["mysql_root"]:
-            mysql_root = config["mysql_root"]
+        def clone_git_repos_step():
+            for repo in config["git"]:
+                location = remote.child(repo["location"])
+                location.set_git_repo(repo["repo"], repo["version"])
+                doing.logger.info(
+                    "Cloned %s@%s to %s", repo["repo"], repo["version"], location
+                )
 
-            with doing("Ensuring that DB and user exist"):
-                ensure_db_exists(wp_config, mysql_root, remote)
+        steps = StepScheduler(doing.logger)
+        steps.add("Restoring files", restore_files_step)
 
-        with doing("Restoring DB"):
-            db = create_from_source(wp_config, remote, args.db_host)
-            restore_db(db, dump)
+        if config["git"]:
+            steps.add("Cloning Git repos", clone_git_repos_step, ["Restoring files"])
+
+        if config["owner"] and (not write_owner or config["git"]):
+            steps.add(
+                "Changing files owner",
+                change_owner_step,
+                ["Restoring files", "Cloning Git repos"],
+            )
+
+        if config["mysql_root"] and not args.skip_db:
+            steps.add(
+                "Ensuring that DB and user exist",
+                lambda: ensure_db_exists(
+                    wp_config, config["mysql_root"], remote, args.db_host
+                ),
+            )
+
+        if not args.skip_db:
+            steps.add(
+                "Restoring DB",
+                restore_db_step,
+                ["Ensuring that DB and user exist"],
+            )
+
+        if shards and not args.skip_db:
+            steps.add(
+                "Restoring sharded tables",
+                lambda: restore_db_shards(db, shards),
+                ["Restoring DB"],
+            )
 
         if config["setup_queries"]:
-            with doing("Running setup queries"):
-                run_queries(db, config["setup_queries"])
+            steps.add(
+                "Running setup queries",
+                lambda: run_queries(db, config["setup_queries"]),
+                ["Restoring DB", "Restoring sharded tables"],
+            )
 
         if config["outer_files"]:
-            with doing("Creating outer files"):
-                install_outer_files(config["outer_files"], remote)
+            steps.add(
+                "Creating outer files",
+                lambda: install_outer_files(config["outer_files"], remote),
+                ["Restoring files", "Cloning Git repos", "Changing files owner"],
+            )
 
         if config["post_install"]:
-            with doing("Running post install scripts"):
-                run_post_install(config["post_install"], remote)
+            steps.add(
+                "Running post install scripts",
+                lambda: run_post_install(config["post_install"], remote),
+                list(steps.steps),
+            )
 
         if config["dns"]:
-            with doing("Configuring DNS"):
-                configure_dns(config["dns"])
+            steps.add(
+                "Configuring DNS",
+                lambda: configure_dns(config["dns"]),
+                list(steps.steps),
+            )
+
+        with doing("Restoring"):
+            steps.run()
 
 
 if __name__ == "__main__":
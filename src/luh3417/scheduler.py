@@ -0,0 +1,117 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from logging import Logger
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional, Sequence, Text
+
+from luh3417.utils import LuhError
+
+
+@dataclass
+class Step:
+    """
+    A step of a pipeline, which can only start once the steps it comes after
+    are done
+    """
+
+    name: Text
+    run: Callable[[], Any]
+    after: Sequence[Text] = ()
+    start: Optional[float] = None
+    end: Optional[float] = None
+
+
+@dataclass
+class StepScheduler:
+    """
+    Runs steps in threads as soon as the steps they depend on are done, so
+    that independent steps run in parallel.
+
+    Dependencies on steps which were not added are ignored, that way optional
+    steps can simply not be added without changing the constraints of the
+    others. If a step fails (whatever the exception, including a SystemExit
+    from a nested doing()), no other step is started and a LuhError listing
+    the errors is raised once running steps are finished (the traceback of
+    unexpected exceptions is logged).
+    """
+
+    logger: Logger
+    max_workers: int = 4
+    steps: Dict[Text, Step] = field(default_factory=dict)
+
+    def add(self, name: Text, run: Callable[[], Any], after: Sequence[Text] = ()):
+        """
+        Adds a step, which will run after the steps named in `after`
+        """
+
+        self.steps[name] = Step(name, run, after)
+
+    def is_ready(self, step: Step, done: Sequence[Text]) -> bool:
+        return all(d in done or d not in self.steps for d in step.after)
+
+    def run(self):
+        """
+        Runs all the steps and logs their timeline
+        """
+
+        origin = monotonic()
+        pending = list(self.steps.values())
+        running: Dict[Future, Step] = {}
+        done: List[Text] = []
+        errors: List[Text] = []
+
+        def run_step(step: Step):
+            self.logger.info(step.name)
+            step.start = monotonic() - origin
+
+            try:
+                return step.run()
+            finally:
+                step.end = monotonic() - origin
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                if not errors:
+                    for step in [s for s in pending if self.is_ready(s, done)]:
+                        pending.remove(step)
+                        running[pool.submit(run_step, step)] = step
+
+                if not running:
+                    if not errors:
+                        names = ", ".join(s.name for s in pending)
+                        errors.append(f"Steps can't be ordered: {names}")
+
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    step = running.pop(future)
+
+                    try:
+                        future.result()
+                    except LuhError as e:
+                        errors.append(f"{step.name}: {e.message}")
+                    except SystemExit:
+                        errors.append(f"{step.name}: failed (see above)")
+                    except Exception as e:
+                        self.logger.error("%s: unexpected error", step.name, exc_info=e)
+                        errors.append(f"{step.name}: unexpected error: {e!r}")
+                    else:
+                        done.append(step.name)
+
+        self.log_timeline()
+
+        if errors:
+            raise LuhError("\n".join(errors))
+
+    def log_timeline(self):
+        """
+        Logs when each step started and ended
+        """
+
+        for step in sorted(self.steps.values(), key=lambda s: s.start or 0):
+            if step.start is not None:
+                self.logger.info(
+                    "%7.1fs -> %7.1fs  %s", step.start, step.end or 0, step.name
+                )
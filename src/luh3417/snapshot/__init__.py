@@ -1,59 +1,384 @@
-import subprocess
+import json
+import os
 import re
-
-from typing import Sequence, Text
+import stat
+import subprocess
+import tarfile
+from dataclasses import dataclass, replace
+from hashlib import sha256
+from posixpath import basename, dirname, join, normpath, relpath
+from shlex import quote
+from typing import Dict, List, Optional, Sequence, Text, Tuple
 
 from luh3417.luhfs import LocalLocation, Location, SshLocation
-from luh3417.luhssh import SshManager
-from luh3417.utils import LuhError
+from luh3417.luhmanifest import ManifestCache, scan_tree
+from luh3417.luhmeter import Drain, Meter, MeteredPipe, relay
+from luh3417.luhssh import SshManager, make_ssh_args
+from luh3417.luhthrottle import Throttle, get_limiter
+from luh3417.utils import LuhError, make_doer, run_concurrently
+
+doing = make_doer("luh3417.snapshot")
+
+TREE_SUFFIX = ".tree"
+SNAR_SUFFIX = ".snar"
+INCREMENTAL_STATE_SUFFIX = ".snar.json"
+INCREMENTAL_FILES_NAME = "files.tar"
+
+# Format of the {time} of the snapshot file name template
+SNAPSHOT_TIME_RE = r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?Z"
+
+RSYNC_EXCLUDES = [".git", ".idea", "*.swp", "*.un~"]
 
+# Above this, directories are not split any further into stripes
+MAX_STRIPE_UNITS = 256
 
-def rsync_files(source: Location, target: Location, delete: bool = False):
+
+@dataclass
+class FileOwner:
     """
-    Use rsync to copy files from a location to another
+    Numeric owner and group (None to leave it as is) given to the files while
+    they are written, which spares a recursive chown afterwards
     """
 
-    args = [
-        "rsync",
-        "-rz",
-        "--exclude=.git",
-        "--exclude=.idea",
-        "--exclude=*.swp",
-        "--exclude=*.un~",
-    ]
+    uid: Optional[int] = None
+    gid: Optional[int] = None
+
+    def tar_args(self) -> List[Text]:
+        """
+        Arguments for the tar creating the archive. Names are left empty so
+        that the tar extracting it (as root) uses the ids.
+        """
+
+        args = []
+
+        if self.uid is not None:
+            args.append(f"--owner=:{self.uid}")
+
+        if self.gid is not None:
+            args.append(f"--group=:{self.gid}")
+
+        return args
+
+    def rsync_args(self) -> List[Text]:
+        """
+        Arguments for rsync (which must run as root on the receiving side)
+        """
+
+        uid = "" if self.uid is None else f"{self.uid}"
+        gid = "" if self.gid is None else f"{self.gid}"
+        args = [f"--chown={uid}:{gid}"]
+
+        if self.uid is not None:
+            args.append("--owner")
+
+        if self.gid is not None:
+            args.append("--group")
+
+        return args
+
+
+def resolve_owner(target: Location, owner: Text) -> Optional[FileOwner]:
+    """
+    Resolves an owner given with the syntax of chown (`user`, `user:group`,
+    `user:` or `:group`) into ids on the target's host. Returns None if the
+    ownership can't be applied while the files are written, which is the
+    case if they are not written by root.
+    """
+
+    user, sep, group = owner.partition(":")
+    script = ['[ "$(id -u)" = 0 ] || exit 1']
+    script.append(f"id -u {quote(user)}" if user else "echo")
+
+    if group:
+        script.append(f"getent group {quote(group)} | cut -d: -f3")
+    elif sep and user:
+        script.append(f"id -g {quote(user)}")
+    else:
+        script.append("echo")
+
+    out, _, ret = target.run_script("set -e\n" + "\n".join(script))
+    lines = out.split("\n")
+
+    if ret or len(lines) < 2 or (group and not lines[1].strip()):
+        return None
+
+    uid, gid = (int(line) if line.strip() else None for line in lines[:2])
+
+    return FileOwner(uid, gid)
+
+
+def make_rsync_args(
+    source: Location,
+    target: Location,
+    recurse: bool = True,
+    delete: bool = False,
+    dedicated: bool = False,
+    owner: Optional[FileOwner] = None,
+) -> List[Text]:
+    """
+    Generates the rsync command copying the source directory into the target
+    one. Without recursion, only the entries directly inside the source are
+    copied (sub-directories are created empty).
+    """
+
+    args = ["rsync", "-rz" if recurse else "-dz"]
+    args += [f"--exclude={exclude}" for exclude in RSYNC_EXCLUDES]
 
     if delete:
         args.append("--delete")
 
-    args += [source.rsync_path(True), target.rsync_path(True)]
+    if owner:
+        args += owner.rsync_args()
 
+    shell = source.rsync_shell(dedicated) or target.rsync_shell(dedicated)
+
+    if shell:
+        args += ["-e", shell]
+
+    return args + [source.rsync_path(True), target.rsync_path(True)]
+
+
+def rsync_files(
+    source: Location,
+    target: Location,
+    delete: bool = False,
+    owner: Optional[FileOwner] = None,
+):
+    """
+    Use rsync to copy files from a location to another
+    """
+
+    args = make_rsync_args(source, target, delete=delete, owner=owner)
     cp = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
 
     return cp.returncode, cp.stderr
 
 
-def sync_files(source: Location, target: Location, delete: bool = False):
+@dataclass
+class StripeUnit:
     """
-    Use rsync to copy files from a location to another
+    Part of a tree synced by its own rsync: a directory with all its content
+    or, if shallow, only the entries directly inside it
+    """
+
+    path: Text
+    size: int
+    shallow: bool = False
+
+
+def get_dir_sizes(source: Location) -> Optional[Dict[Text, int]]:
+    """
+    Size of the files directly inside each directory of the source (not
+    counting sub-directories), by relative path ("" being the source
+    itself). Returns None if the sizes can't be known.
+    """
+
+    excludes = " ".join(quote(f"--exclude={e}") for e in RSYNC_EXCLUDES)
+    out, err, ret = source.run_script(
+        f"cd {quote(source.path)} && du -0 -S -b {excludes} ."
+    )
+
+    if ret:
+        doing.logger.warning("Could not measure %s: %s", source, err.strip())
+        return None
+
+    sizes = {}
+
+    for entry in out.split("\0"):
+        if not entry:
+            continue
+
+        size, path = entry.split("\t", 1)
+        sizes["" if path == "." else normpath(path)] = int(size)
+
+    return sizes
+
+
+def plan_stripes(sizes: Dict[Text, int], jobs: int) -> List[StripeUnit]:
+    """
+    Cuts the tree into units which can be synced independently. Starting
+    from the whole tree, the biggest directory which is more than a stripe's
+    share is split into a shallow unit (its own files) plus one unit per
+    sub-directory, until units are small enough. This way, big directories
+    like `wp-content/uploads` end up split by year.
+    """
+
+    children: Dict[Text, List[Text]] = {path: [] for path in sizes}
+    totals = dict(sizes)
+
+    for path in sorted(sizes, key=lambda p: p.count("/"), reverse=True):
+        if not path:
+            continue
+
+        parent = dirname(path)
+
+        if parent in children:
+            children[parent].append(path)
+            totals[parent] += totals[path]
+
+    share = totals.get("", 0) / jobs
+    units = [StripeUnit("", totals.get("", 0))]
+
+    while True:
+        splittable = [
+            u
+            for u in units
+            if not u.shallow and children.get(u.path) and u.size > share
+        ]
+
+        if not splittable:
+            break
+
+        unit = max(splittable, key=lambda u: u.size)
+
+        if len(units) + len(children[unit.path]) > MAX_STRIPE_UNITS:
+            break
+
+        units.remove(unit)
+        units.append(StripeUnit(unit.path, sizes[unit.path], shallow=True))
+        units += [StripeUnit(c, totals[c]) for c in children[unit.path]]
+
+    return units
+
+
+def partition_stripes(units: List[StripeUnit], jobs: int) -> List[List[StripeUnit]]:
+    """
+    Spreads the units into buckets of balanced sizes (biggest units first,
+    each into the lightest bucket)
+    """
+
+    buckets: List[List[StripeUnit]] = [[] for _ in range(jobs)]
+    loads = [0] * jobs
+
+    for unit in sorted(units, key=lambda u: u.size, reverse=True):
+        i = loads.index(min(loads))
+        buckets[i].append(unit)
+        loads[i] += unit.size
+
+    return [bucket for bucket in buckets if bucket]
+
+
+def rsync_stripe(
+    source: Location,
+    target: Location,
+    units: List[StripeUnit],
+    delete: bool,
+    owner: Optional[FileOwner],
+) -> List[Tuple[Text, int, bytes]]:
+    """
+    Syncs units one after the other, returns the path, exit code and errors
+    of each rsync
+    """
+
+    results = []
+
+    for unit in units:
+        args = make_rsync_args(
+            source.child(unit.path),
+            target.child(unit.path),
+            recurse=not unit.shallow,
+            delete=delete,
+            dedicated=True,
+            owner=owner,
+        )
+        cp = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        results.append((unit.path or ".", cp.returncode, cp.stderr))
+
+    return results
+
+
+def rsync_files_striped(
+    source: Location,
+    target: Location,
+    jobs: int,
+    delete: bool = False,
+    owner: Optional[FileOwner] = None,
+):
+    """
+    Same as rsync_files() but the tree is cut into units (see
+    plan_stripes()) which are synced by `jobs` rsync running concurrently,
+    each through its own SSH connection. This avoids a single huge file list
+    and a single stream for trees with many files.
+
+    Shallow units are synced first (and in order) since they create the
+    directories into which the other units go. The exit codes and errors of
+    all the rsync are combined into one result: the first failure's code
+    and all the errors, prefixed by their unit.
+    """
+
+    sizes = get_dir_sizes(source)
+
+    if sizes is None:
+        return rsync_files(source, target, delete, owner)
+
+    units = plan_stripes(sizes, jobs)
+    shallow = sorted((u for u in units if u.shallow), key=lambda u: u.path)
+    buckets = partition_stripes([u for u in units if not u.shallow], jobs)
+
+    doing.logger.info(
+        "Syncing %s units of %s in %s stripes (%s)",
+        len(units),
+        source,
+        len(buckets),
+        ", ".join(f"{sum(u.size for u in b) / 1024 ** 2:.1f} MiB" for b in buckets),
+    )
+
+    results = rsync_stripe(source, target, shallow, delete, owner)
+
+    if not any(code for _, code, _ in results):
+        for stripe in run_concurrently(
+            *(
+                lambda bucket=bucket: rsync_stripe(
+                    source, target, bucket, delete, owner
+                )
+                for bucket in buckets
+            )
+        ):
+            results += stripe
+
+    codes = [code for _, code, _ in results if code]
+    errors = b"".join(
+        path.encode() + b": " + err for path, _, err in results if err.strip()
+    )
+
+    return (codes[0] if codes else 0), errors
+
+
+def sync_files(
+    source: Location,
+    target: Location,
+    delete: bool = False,
+    jobs: int = 1,
+    owner: Optional[FileOwner] = None,
+):
+    """
+    Use rsync to copy files from a location to another, with several rsync
+    in parallel if jobs is more than 1, giving them this owner (if any)
     """
 
     target.ensure_exists_as_dir()
 
-    rc, stderr = rsync_files(source, target, delete)
+    if jobs > 1:
+        rc, stderr = rsync_files_striped(source, target, jobs, delete, owner)
+    else:
+        rc, stderr = rsync_files(source, target, delete, owner)
 
     if rc:
         cmd_not_found = re.search("command not found", str(stderr))
         if not cmd_not_found:
             raise LuhError(f"Error while copying files: {stderr}")
 
-        copy_files_with_delete(source, target, delete)
+        copy_files_with_delete(source, target, delete, owner)
 
 
 def _build_args(location: Location, args: Sequence[Text]) -> Sequence[Text]:
     """
-    Builds args to use either with SSH either straight
+    Builds args to use either with SSH either straight (with the throttle of
+    the location, if any)
     """
 
+    args = location.throttled(args)
+
     if isinstance(location, LocalLocation):
         return args
     elif isinstance(location, SshLocation):
@@ -90,14 +415,36 @@ def deactivate_maintenance_mode(remote: Location):
         )
 
 
-def copy_files(source: Location, target: Location, excludes, exclude_tag_alls):
+def check_throttle(source: Location, throttle: Throttle):
     """
-    Copies files from the remote location to the local locations. Files are
-    serialized and pipelined through tar, maybe locally, maybe through SSH
-    depending on the locations.
+    Makes sure that the throttle can be applied on the source (nice and
+    ionice exist there and are allowed)
+    """
+
+    _, err, ret = source.run_script(
+        " ".join(quote(a) for a in throttle.wrap(["true"]))
+    )
+
+    if ret:
+        raise LuhError(f'Can\'t apply the limits ({throttle}) on "{source}": {err}')
+
+
+def make_source_tar_command(
+    source: Location,
+    excludes,
+    exclude_tag_alls,
+    owner: Optional[FileOwner] = None,
+):
+    """
+    Generates the tar command which serializes the files of the source to its
+    standard output (with this owner, if any)
     """
 
     source_tar_command = ["tar", "-C", source.path]
+
+    if owner:
+        source_tar_command += owner.tar_args()
+
     if excludes:
         for exclude in excludes:
             source_tar_command.append("--exclude")
@@ -108,6 +455,111 @@ def copy_files(source: Location, target: Location, excludes, exclude_tag_alls):
             source_tar_command.append(exclude_tag_all)
     source_tar_command.extend(["-c", "."])
 
+    return source_tar_command
+
+
+def pipe_direct(
+    source: SshLocation,
+    source_command: Sequence[Text],
+    target: SshLocation,
+    target_command: Text,
+) -> bool:
+    """
+    Pipes the output of a command on the source host into a (shell) command
+    on the target host, by connecting from the source host to the target host
+    (thanks to agent forwarding) so that data doesn't go through the local
+    machine. Returns False if the source host can't connect to the target
+    host.
+
+    The nice/ionice of the source's throttle apply to both ends of the pipe
+    on the source host. Its rate limit can't apply here: when there is one,
+    the caller has to relay the data instead (see copy_files()).
+    """
+
+    ssh = make_ssh_args(
+        target.user,
+        target.host,
+        target.port,
+        options={"BatchMode": "yes", "ConnectTimeout": 10},
+    )
+    ssh_command = " ".join(quote(a) for a in ssh)
+    pipeline = (
+        " ".join(quote(a) for a in source.throttled(source_command))
+        + " | "
+        + " ".join(quote(a) for a in source.throttled(ssh))
+        + f" {quote(target_command)}"
+    )
+
+    _, err, ret = source.run_script(f"{ssh_command} true")
+
+    if ret:
+        doing.logger.debug("%s can't connect to %s: %s", source, target, err)
+        return False
+
+    _, err, ret = source.run_script(
+        f"""
+            set -o pipefail
+            {pipeline}
+        """
+    )
+
+    if ret:
+        raise LuhError(
+            f'Error while copying from "{source}" to "{target}": {err[:1000]}'
+        )
+
+    return True
+
+
+def copy_files_direct(
+    source: SshLocation, target: SshLocation, source_tar_command: Sequence[Text]
+) -> bool:
+    """
+    Copies files between two remote locations without going through the
+    local machine, see pipe_direct()
+    """
+
+    target_command = f"mkdir -p {quote(target.path)} && tar -C {quote(target.path)} -x"
+
+    return pipe_direct(source, source_tar_command, target, target_command)
+
+
+def copy_files(
+    source: Location,
+    target: Location,
+    excludes,
+    exclude_tag_alls,
+    owner: Optional[FileOwner] = None,
+):
+    """
+    Copies files from the remote location to the local locations. Files are
+    serialized and pipelined through tar, maybe locally, maybe through SSH
+    depending on the locations. If an owner is given, the files get it (the
+    target's tar must run as root).
+
+    If both locations are remote, the source host tries to send files
+    directly to the target host. Otherwise (or if that fails) files are
+    relayed by the local machine. Files are also relayed if the source's
+    bandwidth is limited, since the limit is enforced by the relay.
+    """
+
+    source_tar_command = make_source_tar_command(
+        source, excludes, exclude_tag_alls, owner
+    )
+    limiter = get_limiter(getattr(source, "throttle", None))
+
+    if (
+        isinstance(source, SshLocation)
+        and isinstance(target, SshLocation)
+        and not limiter
+    ):
+        if copy_files_direct(source, target, source_tar_command):
+            return
+
+        doing.logger.info(
+            "%s can't reach %s directly, relaying files", source.host, target.host
+        )
+
     source_args = _build_args(source, source_tar_command)
     target_args_1 = _build_args(target, ["mkdir", "-p", target.path])
     target_args_2 = _build_args(target, ["tar", "-C", target.path, "-x"])
@@ -120,29 +572,706 @@ def copy_files(source: Location, target: Location, excludes, exclude_tag_alls):
     source_p = subprocess.Popen(
         source_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
+    pipe = MeteredPipe(
+        source_p.stdout, f"Copying files from {source}", limiter=limiter
+    )
     target_p = subprocess.Popen(
         target_args_2,
-        stdin=source_p.stdout,
+        stdin=pipe.stdin,
         stderr=subprocess.PIPE,
         stdout=subprocess.DEVNULL,
     )
+    pipe.start(target_p)
+    source_err = Drain(source_p.stderr)
+    target_err = Drain(target_p.stderr)
 
     source_p.wait()
+    pipe.join()
     target_p.wait()
 
     if source_p.returncode:
         raise LuhError(
-            f'Error while reading files from "{source}": {source_p.stderr.read(1000)}'
+            f'Error while reading files from "{source}": {source_err.read()[:1000]}'
         )
 
     if target_p.returncode:
-        raise LuhError(f'Error writing files to "{target}": {target_p.stderr.read(1000)}')
+        raise LuhError(f'Error writing files to "{target}": {target_err.read()[:1000]}')
+
+
+def read_bytes(location: Location) -> bytes:
+    """
+    Reads a (binary) file at any location
+    """
+
+    p = location.popen(
+        ["cat", location.path], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    out, err = p.communicate()
+
+    if p.returncode:
+        raise LuhError(f"Could not read {location}: {err[:1000]}")
+
+    return out
+
+
+def write_bytes(location: Location, data: bytes):
+    """
+    Writes a (binary) file at any location
+    """
+
+    p = location.popen(
+        ["sh", "-c", f"cat > {quote(location.path)}"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    _, err = p.communicate(data)
+
+    if p.returncode:
+        raise LuhError(f"Could not write {location}: {err[:1000]}")
+
+
+@dataclass
+class IncrementalPlan:
+    """
+    Where the next incremental snapshot stands in its chain: its level (0
+    being a full snapshot), the name of the previous archive of the chain
+    and the tar metadata (snapshot file) left by that archive.
+    """
+
+    level: int
+    parent: Optional[Text] = None
+    snar: bytes = b""
+
+
+def plan_incremental(
+    backup_dir: Location, base_name: Text, full_every: int
+) -> IncrementalPlan:
+    """
+    Decides the level of the next incremental snapshot from the state kept
+    in the backup dir. A full snapshot is made if there is no state yet or
+    once the chain reaches `full_every` archives.
+    """
+
+    state_location = backup_dir.child(base_name + INCREMENTAL_STATE_SUFFIX)
+
+    if not state_location.exists():
+        return IncrementalPlan(0)
+
+    try:
+        state = json.loads(state_location.get_content())
+    except ValueError as e:
+        raise LuhError(f"Incremental state {state_location} is corrupted: {e}")
+
+    if state["level"] + 1 >= full_every:
+        return IncrementalPlan(0)
+
+    return IncrementalPlan(
+        state["level"] + 1,
+        state["archive"],
+        read_bytes(backup_dir.child(base_name + SNAR_SUFFIX)),
+    )
+
+
+def save_incremental_state(
+    backup_dir: Location, base_name: Text, level: int, archive: Location, snar: bytes
+):
+    """
+    Once an incremental snapshot is written, keeps its metadata in the backup
+    dir for the next one
+    """
+
+    write_bytes(backup_dir.child(base_name + SNAR_SUFFIX), snar)
+    backup_dir.child(base_name + INCREMENTAL_STATE_SUFFIX).set_content(
+        json.dumps({"level": level, "archive": basename(archive.path)})
+    )
 
 
-def copy_files_with_delete(source: Location, target: Location, delete: bool = False):
+def dump_incremental_files(
+    source: Location, target_path: Text, snar: bytes, excludes, exclude_tag_alls
+) -> bytes:
+    """
+    Writes the files of the source into a local GNU tar incremental archive,
+    which only contains what changed since the archive which left this snar
+    (tar's snapshot file, empty for a full archive). The tar runs on the
+    source's host along with a copy of the snar. Returns the updated snar.
+    """
+
+    out, err, ret = source.run_script("mktemp")
+
+    if ret:
+        raise LuhError(f"Could not create a temporary file on {source}: {err}")
+
+    snar_location = replace(source, path=out.strip())
+    limiter = get_limiter(getattr(source, "throttle", None))
+    meter = (
+        Meter(f"Reading files from {source}", limiter=limiter)
+        if Meter.is_needed(limiter)
+        else None
+    )
+
+    try:
+        write_bytes(snar_location, snar)
+        tar_command = make_source_tar_command(source, excludes, exclude_tag_alls)
+        source_p = subprocess.Popen(
+            _build_args(
+                source,
+                tar_command[:1]
+                + [f"--listed-incremental={snar_location.path}", "--no-check-device"]
+                + tar_command[1:],
+            ),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        source_err = Drain(source_p.stderr)
+
+        with open(target_path, "wb") as f:
+            relay(source_p.stdout, f, meter, close_target=False)
+
+        source_p.wait()
+
+        if source_p.returncode:
+            raise LuhError(
+                f'Error while reading files from "{source}": '
+                f"{source_err.read()[:1000]}"
+            )
+
+        return read_bytes(snar_location)
+    finally:
+        source.run_script(f"rm -f {quote(snar_location.path)}")
+
+
+def copy_files_with_delete(
+    source: Location,
+    target: Location,
+    delete: bool = False,
+    owner: Optional[FileOwner] = None,
+):
 
     if delete:
         target.delete_dir_content()
         target.ensure_exists_as_dir()
 
-    copy_files(source, target, None, None)
+    copy_files(source, target, None, None, owner)
+
+
+@dataclass
+class DeltaStats:
+    """
+    What a delta copy did. Entries are files as well as directories, links
+    and so on, the bytes only count the content of files.
+    """
+
+    skipped_entries: int = 0
+    skipped_bytes: int = 0
+    transferred_entries: int = 0
+    transferred_bytes: int = 0
+    deleted: int = 0
+
+
+# Type (as find's `%y`), size, permission bits and link target of an entry
+TreeEntry = Tuple[Text, int, int, Text]
+
+
+def list_local_tree(root: Text) -> Dict[Text, TreeEntry]:
+    """
+    Lists all entries of a local directory as relative path -> (type, size,
+    mode, link target), with the types of find's `%y` (`f` for files, `d`
+    for directories, ...)
+    """
+
+    out = {}
+
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in dir_names + file_names:
+            path = join(dir_path, name)
+            st = os.lstat(path)
+
+            if stat.S_ISREG(st.st_mode):
+                kind = "f"
+            elif stat.S_ISDIR(st.st_mode):
+                kind = "d"
+            elif stat.S_ISLNK(st.st_mode):
+                kind = "l"
+            else:
+                kind = "o"
+
+            mode = stat.S_IMODE(st.st_mode)
+            link = os.readlink(path) if kind == "l" else ""
+            out[relpath(path, root)] = (kind, st.st_size, mode, link)
+
+    return out
+
+
+def list_remote_tree(location: Location) -> Dict[Text, TreeEntry]:
+    """
+    Same as list_local_tree() for any location, using scan_tree()
+    """
+
+    return {
+        path: (e.kind, e.size, e.mode, e.link)
+        for path, e in scan_tree(location).items()
+    }
+
+
+def is_same_entry(local: TreeEntry, remote: Optional[TreeEntry]) -> bool:
+    """
+    Tells if an entry which is not a regular file is already the same on the
+    remote side. The size of directories depends on the file system, so it's
+    not compared.
+    """
+
+    if remote is None or local[0] not in ("d", "l"):
+        return False
+
+    return (local[0], local[2], local[3]) == (remote[0], remote[2], remote[3])
+
+
+def hash_local_file(path: Text) -> Text:
+    """
+    SHA-256 of a local file
+    """
+
+    h = sha256()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def hash_remote_files(location: Location, paths: List[Text]) -> List[Text]:
+    """
+    SHA-256 of files relative to the location, in the same order
+    """
+
+    if not paths:
+        return []
+
+    p = location.popen(
+        ["sh", "-c", f"cd {quote(location.path)} && xargs -0 sha256sum --"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    out, err = p.communicate("\0".join(paths).encode())
+
+    if p.returncode:
+        raise LuhError(f"Could not compute checksums in {location}: {err[:1000]}")
+
+    # Names with special chars are escaped and prefixed by a backslash
+    hashes = [line.lstrip(b"\\")[:64].decode() for line in out.splitlines()]
+
+    if len(hashes) != len(paths):
+        raise LuhError(f"Unexpected checksums output from {location}")
+
+    return hashes
+
+
+def delta_copy_files(
+    source_dir: Text, target: Location, cache: Optional[ManifestCache] = None
+) -> DeltaStats:
+    """
+    Makes the target identical to the local source dir while only sending
+    the entries which differ. Files are compared by size and mode and then by
+    SHA-256 (mtimes are not reliable since the source is usually freshly
+    extracted), directories by mode and links by target. Extraneous entries
+    of the target are deleted.
+
+    With the manifest cache of the target, the target's files which didn't
+    change since they were last hashed (same size and mtime) are not hashed
+    again, and the new hashes are recorded for the next time. The hashes of
+    the files which are sent or deleted are forgotten, since the extracted
+    files may well get the same size and mtime as the ones they replace.
+    """
+
+    stats = DeltaStats()
+    target.ensure_exists_as_dir()
+
+    local = list_local_tree(source_dir)
+    known_hashes = {}
+
+    if cache:
+        changes = cache.refresh()
+        doing.logger.info("Files of %s since last time: %s", target, changes)
+        manifest = cache.entries()
+        remote = {p: (e.kind, e.size, e.mode, e.link) for p, e in manifest.items()}
+        known_hashes = {p: e.sha256 for p, e in manifest.items() if e.sha256}
+    else:
+        remote = list_remote_tree(target)
+
+    to_delete = [
+        path
+        for path, (kind, *_) in remote.items()
+        if path not in local or local[path][0] != kind
+    ]
+    candidates = [
+        path
+        for path, entry in local.items()
+        if entry[0] == "f" and remote.get(path) == entry
+    ]
+    to_hash = [path for path in candidates if path not in known_hashes]
+    remote_hashes = dict(zip(to_hash, hash_remote_files(target, to_hash)))
+
+    if cache:
+        cache.set_hashes(remote_hashes)
+
+    remote_hashes.update((p, known_hashes[p]) for p in candidates if p in known_hashes)
+    to_send = []
+
+    for path, entry in sorted(local.items()):
+        kind, size, *_ = entry
+
+        if kind == "f":
+            digest = remote_hashes.get(path)
+            unchanged = digest is not None and digest == hash_local_file(
+                join(source_dir, path)
+            )
+        else:
+            unchanged = is_same_entry(entry, remote.get(path))
+
+        if unchanged:
+            stats.skipped_entries += 1
+            stats.skipped_bytes += size if kind == "f" else 0
+            continue
+
+        to_send.append(path)
+        stats.transferred_entries += 1
+        stats.transferred_bytes += size if kind == "f" else 0
+
+    # Before touching the target, so that an interrupted copy leaves no stale
+    # hash behind (directories are sent without their content)
+    if cache:
+        cache.clear_hashes(to_delete + [p for p in to_send if local[p][0] != "d"])
+
+    if to_delete:
+        p = target.popen(
+            ["sh", "-c", f"cd {quote(target.path)} && xargs -0 rm -rf --"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        _, err = p.communicate("\0".join(to_delete).encode())
+
+        if p.returncode:
+            raise LuhError(f"Could not delete files in {target}: {err[:1000]}")
+
+        stats.deleted = len(to_delete)
+
+    if to_send:
+        source_p = subprocess.Popen(
+            ["tar", "-C", source_dir, "-c", "--null", "--no-recursion", "-T", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # Same permissions, otherwise the umask would make them differ again
+        target_p = target.popen(
+            ["tar", "-C", target.path, "-x", "-p"],
+            stdin=source_p.stdout,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        source_p.stdout.close()
+        source_err = Drain(source_p.stderr)
+        target_err = Drain(target_p.stderr)
+
+        try:
+            source_p.stdin.write("\0".join(to_send).encode())
+            source_p.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        source_p.wait()
+        target_p.wait()
+
+        if source_p.returncode:
+            raise LuhError(f"Error while reading files: {source_err.read()[:1000]}")
+
+        if target_p.returncode:
+            raise LuhError(
+                f'Error writing files to "{target}": {target_err.read()[:1000]}'
+            )
+
+    return stats
+
+
+def stream_files_to_archive(
+    source: Location,
+    archive: tarfile.TarFile,
+    prefix: Text,
+    excludes,
+    exclude_tag_alls,
+):
+    """
+    Serializes the files of the source with tar (maybe through SSH) and
+    appends them on the fly into an archive being written, inside of the
+    prefix directory. Nothing is written on the local disk.
+
+    The archive can be anything with a TarFile-like addfile() method.
+    """
+
+    def prefixed(name: Text) -> Text:
+        path = normpath(join(prefix, name))
+        return "./" if path == "." else f"./{path}"
+
+    source_args = _build_args(
+        source, make_source_tar_command(source, excludes, exclude_tag_alls)
+    )
+    source_p = subprocess.Popen(
+        source_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    source_err = Drain(source_p.stderr)
+    limiter = get_limiter(getattr(source, "throttle", None))
+    meter = (
+        Meter(f"Reading files from {source}", limiter=limiter)
+        if Meter.is_needed(limiter)
+        else None
+    )
+
+    try:
+        with tarfile.open(fileobj=source_p.stdout, mode="r|") as source_tar:
+            for member in source_tar:
+                data = source_tar.extractfile(member) if member.isreg() else None
+                member.name = prefixed(member.name)
+
+                if member.islnk():
+                    member.linkname = prefixed(member.linkname)
+
+                archive.addfile(member, data)
+
+                if meter:
+                    meter.add(tarfile.BLOCKSIZE + member.size)
+    except tarfile.TarError as e:
+        source_p.kill()
+        raise LuhError(f'Error while archiving files from "{source}": {e}')
+    finally:
+        source_p.wait()
+
+    if meter:
+        meter.done()
+
+    if source_p.returncode:
+        raise LuhError(
+            f'Error while reading files from "{source}": {source_err.read()[:1000]}'
+        )
+
+
+def is_tree_snapshot(path: Text) -> bool:
+    """
+    Tells if the snapshot at this path is a directory tree snapshot
+    """
+
+    return path.rstrip("/").endswith(TREE_SUFFIX)
+
+
+def get_previous_snapshot_size(
+    backup_dir: Location, base_name: Text, suffix: Text
+) -> Optional[int]:
+    """
+    Size of the most recent snapshot of this website in the backup dir (if
+    any), which gives an estimate of the size of the next one
+    """
+
+    out, _, ret = backup_dir.run_script(
+        f"find {quote(backup_dir.path)} -maxdepth 1 -type f -printf '%f\\t%s\\n'"
+    )
+
+    if ret:
+        return None
+
+    snapshots = sorted(
+        (name, int(size))
+        for name, size in (line.split("\t", 1) for line in out.splitlines())
+        if name.startswith(base_name) and name.endswith(suffix)
+    )
+
+    return snapshots[-1][1] if snapshots else None
+
+
+def find_previous_tree(
+    backup_dir: Location, name_template: Text, base_name: Text
+) -> Optional[Location]:
+    """
+    Finds the most recent tree snapshot of the same website in the backup
+    dir, which can be used as reference for the next one. Snapshots are
+    matched against the file name template (with this exact base name and
+    any time), so the trees of other websites are never used.
+    """
+
+    out, err, ret = backup_dir.run_script(f"ls -1 {quote(backup_dir.path)}")
+
+    if ret:
+        raise LuhError(f"Could not list {backup_dir}: {err}")
+
+    parts = re.split(r"(\{time\})", name_template)
+    pattern = re.compile(
+        "".join(
+            SNAPSHOT_TIME_RE
+            if part == "{time}"
+            else re.escape(part.format(base=base_name))
+            for part in parts
+        )
+    )
+    trees = sorted(n for n in out.split("\n") if pattern.fullmatch(n))
+
+    if not trees:
+        return None
+
+    return backup_dir.child(trees[-1])
+
+
+def get_rsync_throttle_args(source: Location) -> List[Text]:
+    """
+    Arguments applying the throttle of the source (if any) to rsync: the
+    bandwidth limit and, for a remote source, the priority of the rsync
+    which runs there
+    """
+
+    throttle = getattr(source, "throttle", None)
+
+    if not throttle:
+        return []
+
+    args = throttle.rsync_args()
+
+    if isinstance(source, SshLocation):
+        args.append(f"--rsync-path={' '.join(throttle.wrap(['rsync']))}")
+
+    return args
+
+
+def rsync_tree(
+    source: Location,
+    target: Location,
+    link_dest: Optional[Location],
+    excludes: Optional[Sequence[Text]] = None,
+    delete: bool = False,
+):
+    """
+    Copies the source into the target directory with rsync. Files which are
+    unchanged since the link_dest directory (the previous snapshot) are
+    hardlinked from there instead of being copied.
+
+    When both source and target are remote, rsync runs on the target's host
+    and pulls from the source (through the forwarded agent).
+    """
+
+    args = ["rsync", "-aH", "--numeric-ids"] + get_rsync_throttle_args(source)
+
+    if link_dest:
+        # Relative to the target, so that it works the same on any host
+        args.append(f"--link-dest={relpath(link_dest.path, target.path)}")
+
+    for exclude in excludes or []:
+        args.append(f"--exclude={exclude}")
+
+    if delete:
+        args.append("--delete")
+
+    if isinstance(source, SshLocation) and isinstance(target, SshLocation):
+        ssh = ["ssh"]
+
+        if source.port:
+            ssh += ["-p", f"{source.port}"]
+
+        args += ["-e", " ".join(ssh), source.rsync_path(True), target.path + "/"]
+        out, err, ret = target.run_script(
+            f"mkdir -p {quote(target.path)} && {' '.join(quote(a) for a in args)}"
+        )
+    else:
+        target.ensure_exists_as_dir()
+        shell = source.rsync_shell() or target.rsync_shell()
+
+        if shell:
+            args += ["-e", shell]
+
+        args += [source.rsync_path(True), target.rsync_path(True)]
+
+        if isinstance(source, LocalLocation):
+            args = source.throttled(args)
+
+        cp = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        err, ret = cp.stderr, cp.returncode
+
+    if ret:
+        raise LuhError(f'Error while copying files from "{source}": {err}')
+
+
+def sync_staging_dir(
+    source: Location, staging_dir: Location, excludes: Optional[Sequence[Text]]
+):
+    """
+    Makes the staging dir a mirror of the source. The first time copies
+    everything, the next times only the changes.
+    """
+
+    rsync_tree(source, staging_dir, None, excludes, delete=True)
+
+
+def commit_tree(part: Location, target: Location):
+    """
+    Gives its final name to a tree snapshot once completely written
+    """
+
+    out, err, ret = part.run_script(f"mv {quote(part.path)} {quote(target.path)}")
+
+    if ret:
+        raise LuhError(f"Could not commit the snapshot {target}: {err}")
+
+
+def assemble_remote_archive(
+    source: SshLocation,
+    archive: SshLocation,
+    settings: Text,
+    dump_script: Text,
+    compression_program: Text,
+    excludes,
+    exclude_tag_alls,
+):
+    """
+    Builds the archive with a script running on the source's host, for when
+    the archive is stored on the same host. The DB is dumped into a temporary
+    dir there, then the settings, the dump and the source's files (renamed
+    into the wordpress directory) are archived in one go. Only the script and
+    its output go through the network.
+
+    Files are archived from inside the source dir (like everywhere else) so
+    that the excludes match the same paths.
+    """
+
+    part = archive.path + ".part"
+
+    tar = ["tar", "-c", "-I", compression_program, "-f", part]
+
+    for exclude in excludes or []:
+        tar += ["--exclude", exclude]
+
+    for exclude_tag_all in exclude_tag_alls or []:
+        tar += ["--exclude-tag-all", exclude_tag_all]
+
+    # Only the source's files start with ./, the settings and the dump are
+    # added without it and get it afterwards
+    tar += [
+        r"--transform=s,^\.\(/\|$\),./wordpress\1,S",
+        r"--transform=s,^\(settings\.json\|dump\.sql\)$,./\1,S",
+    ]
+
+    out, err, ret = source.run_script(
+        f"""
+            set -e
+            work=$(mktemp -d)
+            trap 'rm -rf "$work"' EXIT
+            cd "$work"
+            printf '%s' {quote(settings)} > settings.json
+            {dump_script}
+            {' '.join(quote(a) for a in tar)} \\
+                -C "$work" settings.json dump.sql \\
+                -C {quote(source.path)} .
+            mv {quote(part)} {quote(archive.path)}
+        """
+    )
+
+    if ret:
+        raise LuhError(f"Could not assemble the archive on {source.host}: {err}")
@@ -1,16 +1,73 @@
 import json
+import tarfile
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import replace
 from datetime import datetime
-from os.path import join
+from os import makedirs
+from os.path import basename, join
 from tempfile import TemporaryDirectory
-from typing import Dict, Optional, Sequence, Text
-import re
-
-from luh3417.luhfs import Location, parse_location
+from time import monotonic
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence, Text
+
+from luh3417.luhchecksum import ChecksumWriter, write_checksums
+from luh3417.luhfs import (
+    COMPRESSION_MODES,
+    Location,
+    SshLocation,
+    apply_compression_suffix,
+    get_codec,
+    get_compression_program,
+    is_same_host,
+    parse_location,
+    replace_archive_suffix,
+)
+from luh3417.luhindex import INDEXED_COMPRESSION_MODES, IndexedArchiveWriter
+from luh3417.luhmeter import Meter
 from luh3417.luhphp import parse_wp_config
-from luh3417.luhsql import create_from_source
-from luh3417.snapshot import copy_files, activate_maintenance_mode, deactivate_maintenance_mode
-from luh3417.utils import make_doer, run_main, setup_logging
+from luh3417.luhresume import Retry
+from luh3417.luhsql import (
+    DUMP_CONSISTENCY_MODES,
+    DUMP_SHARDS_DIR,
+    DUMP_SINGLE_TRANSACTION,
+    create_from_source,
+)
+from luh3417.luhstore import StoreWriter, apply_manifest_suffix
+from luh3417.luhthrottle import IONICE_CLASSES, Throttle, parse_rate
+from luh3417.restore import open_dump_pipe
+from luh3417.snapshot import (
+    INCREMENTAL_FILES_NAME,
+    TREE_SUFFIX,
+    IncrementalPlan,
+    activate_maintenance_mode,
+    assemble_remote_archive,
+    check_throttle,
+    commit_tree,
+    copy_files,
+    deactivate_maintenance_mode,
+    dump_incremental_files,
+    find_previous_tree,
+    get_previous_snapshot_size,
+    plan_incremental,
+    rsync_tree,
+    save_incremental_state,
+    stream_files_to_archive,
+    sync_staging_dir,
+)
+from luh3417.luhvolume import (
+    DEFAULT_VOLUME_JOBS,
+    archive_dir_to_volumes,
+    get_volumes_index,
+    open_volumes_stream,
+)
+from luh3417.utils import (
+    make_doer,
+    parse_size,
+    run_concurrently,
+    run_main,
+    setup_logging,
+)
 
 doing = make_doer("luh3417.snapshot")
 
@@ -53,11 +110,19 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
     parser.add_argument(
         "-c",
         "--compression-mode",
-        help="Compression mode for tar (gzip, bzip2, lzip, xz). Defaults to: gzip",
+        help=(
+            "Compression mode for tar. pigz, pbzip2, xz-mt and zstd-mt are "
+            "multi-threaded. Defaults to: gzip"
+        ),
         default="gzip",
         const="gzip",
         nargs="?",
-        choices=["gzip", "bzip2", "lzip", "xz"],
+        choices=COMPRESSION_MODES,
+    )
+    parser.add_argument(
+        "--compression-level",
+        help="Compression level. Defaults to the compression program's default",
+        type=int,
     )
     parser.add_argument(
         "--db-host",
@@ -68,6 +133,105 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
         const=None,
         nargs="?",
     )
+    parser.add_argument(
+        "--consistency",
+        help=(
+            "How to get a consistent DB dump. `single-transaction` dumps "
+            "InnoDB tables without locking them and only locks the other "
+            "(MyISAM, ...) tables, `lock` locks all tables during the dump. "
+            "Defaults to: single-transaction"
+        ),
+        default=DUMP_SINGLE_TRANSACTION,
+        choices=DUMP_CONSISTENCY_MODES,
+    )
+    parser.add_argument(
+        "--shard-table",
+        help=(
+            "Dump this (big) table separately, split in primary key ranges "
+            "which are dumped and restored concurrently (along with the rest "
+            "of the DB). All the dumps start under a global read lock to be "
+            "consistent with each other, which needs the RELOAD privilege. "
+            "Can be repeated."
+        ),
+        action="append",
+    )
+    parser.add_argument(
+        "--inconsistent-shards",
+        help=(
+            "Dump the --shard-table without the global read lock (by example "
+            "because the DB user can't take it). The sharded tables are then "
+            "NOT consistent with the rest of the dump nor between shards."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shards",
+        help="Number of shards for each --shard-table. Defaults to: 4",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--stream-db-to",
+        help=(
+            "A restore patch file. While being dumped, the DB is also patched "
+            "and imported on the fly into the DB targeted by this patch."
+        ),
+        type=parse_location,
+    )
+    parser.add_argument(
+        "--archive-format",
+        help=(
+            "Format of the snapshot. `tar` is a regular compressed archive, "
+            "`dedup` stores files into a content-addressed store inside of "
+            "backup_dir (only new content is stored) and writes a small "
+            "manifest for the snapshot, `tree` makes a directory in backup_dir "
+            "where files unchanged since the previous tree snapshot are "
+            "hardlinks (this requires rsync). Defaults to: tar"
+        ),
+        default="tar",
+        choices=["tar", "dedup", "tree"],
+    )
+    parser.add_argument(
+        "--streaming",
+        help=(
+            "Write the files straight into the archive as they are read from "
+            "the source instead of copying them into a local temporary "
+            "directory first. Only the DB dump is written on the local disk "
+            "(while the files are sent) and appended after them."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--assemble-on-source",
+        help=(
+            "When backup_dir is on the same host as the source, dump the DB "
+            "and build the archive with a script running on that host, so "
+            "that only the script goes through the network. The compression "
+            "then runs on the source (during the maintenance mode, if any) "
+            "and the time during which tables were locked is not reported. "
+            "Ignored when it can't apply (by example with --bwlimit)."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--index",
+        help=(
+            "Write the archive in independent gzip segments along with an "
+            "index, so that single entries like settings.json or dump.sql can "
+            "be extracted without reading the whole archive. Requires the "
+            "gzip compression mode."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--checksums",
+        help=(
+            "Compute the SHA-256 of each file while writing the archive and "
+            "store them inside of the archive and next to it, so that the "
+            "archive can be checked with `luh3417.verify`"
+        ),
+        action="store_true",
+    )
     parser.add_argument(
         "--maintenance-mode",
         help=(
@@ -75,6 +239,16 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
         ),
         action="store_true",
     )
+    parser.add_argument(
+        "--staging-dir",
+        help=(
+            "A persistent directory into which the files are synced with rsync "
+            "while the website is live. Then only the last changes are synced "
+            "during the maintenance mode (with the DB dump), and the snapshot "
+            "is made from the staging dir once the website is back."
+        ),
+        type=parse_location,
+    )
     parser.add_argument(
         "--exclude",
         help=(
@@ -90,52 +264,533 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
         action="append",
     )
 
+    parser.add_argument(
+        "--no-progress",
+        help="Don't meter the data pipes nor log their throughput",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--retries",
+        help=(
+            "Make the transfers of archives through SSH resumable: if the "
+            "connection drops, they resume where they stopped, up to this "
+            "number of times. Uploads are spooled on the local disk, which "
+            "needs free space for the whole archive. "
+            "Defaults to: 0 (not resumable)"
+        ),
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--nice",
+        help="Run the commands on the source with this niceness (0 to 19)",
+        type=int,
+    )
+    parser.add_argument(
+        "--ionice",
+        help="Run the commands on the source with this I/O scheduling class",
+        choices=list(IONICE_CLASSES),
+    )
+    parser.add_argument(
+        "--bwlimit",
+        help=(
+            "Limit the total rate at which data is read from the source, in "
+            "bytes per second. Accepts K, M and G suffixes (by example 10M)."
+        ),
+        type=parse_rate,
+    )
+    parser.add_argument(
+        "--incremental",
+        help=(
+            "Write the files as a GNU tar incremental archive which only "
+            "contains what changed since the previous snapshot (tar format "
+            "only). The tar metadata is kept in the backup dir."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--full-every",
+        help=(
+            "With --incremental, make a full snapshot once the chain of "
+            "snapshots reaches this length. Defaults to: 7"
+        ),
+        default=7,
+        type=int,
+    )
+    parser.add_argument(
+        "--volume-size",
+        help=(
+            "Split the archive into volumes of this size (by example 1G), "
+            "written along with an index. Volumes are uploaded in parallel."
+        ),
+        type=parse_size,
+    )
+    parser.add_argument(
+        "--volume-jobs",
+        help=(
+            "Number of volumes uploaded at the same time, each through its "
+            f"own connection. Defaults to: {DEFAULT_VOLUME_JOBS}"
+        ),
+        default=DEFAULT_VOLUME_JOBS,
+        type=int,
+    )
+
     parsed_args = parser.parse_args(args)
 
+    if parsed_args.retries < 0:
+        parser.error("--retries can't be negative")
+
+    if parsed_args.nice is not None and not 0 <= parsed_args.nice <= 19:
+        parser.error("--nice must be between 0 and 19")
+
+    if parsed_args.stream_db_to and parsed_args.shard_table:
+        parser.error("--stream-db-to cannot be used with --shard-table")
+
+    if parsed_args.index and (
+        parsed_args.archive_format != "tar"
+        or parsed_args.compression_mode not in INDEXED_COMPRESSION_MODES
+    ):
+        parser.error("--index requires the tar archive format and gzip compression")
+
+    if parsed_args.checksums and parsed_args.archive_format != "tar":
+        parser.error("--checksums requires the tar archive format")
+
+    if parsed_args.volume_size is not None and (
+        parsed_args.archive_format != "tar"
+        or parsed_args.index
+        or parsed_args.checksums
+    ):
+        parser.error(
+            "--volume-size requires the tar archive format and can't be used "
+            "with --index nor --checksums"
+        )
+
+    if parsed_args.volume_jobs < 1:
+        parser.error("--volume-jobs must be at least 1")
+
+    if parsed_args.incremental and (
+        parsed_args.archive_format != "tar"
+        or parsed_args.streaming
+        or parsed_args.index
+        or parsed_args.volume_size is not None
+        or parsed_args.staging_dir
+    ):
+        parser.error(
+            "--incremental requires the tar archive format and can't be used "
+            "with --streaming, --index, --volume-size nor --staging-dir"
+        )
+
+    if parsed_args.full_every < 1:
+        parser.error("--full-every must be at least 1")
+
+    if parsed_args.archive_format == "tree" and parsed_args.exclude_tag_all:
+        parser.error("--exclude-tag-all cannot be used with tree snapshots")
+
+    if parsed_args.staging_dir and parsed_args.exclude_tag_all:
+        parser.error("--exclude-tag-all cannot be used with --staging-dir")
+
     # apply compression mode to file name template
-    if parsed_args.compression_mode == "bzip2":
-        parsed_args.file_name_template = re.sub(".gz", ".bz2", parsed_args.file_name_template)
-        parsed_args.backup_dir.set_compression_mode(parsed_args.compression_mode)
-    elif parsed_args.compression_mode == "lzip":
-        parsed_args.file_name_template = re.sub(".gz", ".lz", parsed_args.file_name_template)
-        parsed_args.backup_dir.set_compression_mode(parsed_args.compression_mode)
-    elif parsed_args.compression_mode == "xz":
-        parsed_args.file_name_template = re.sub(".gz", ".xz", parsed_args.file_name_template)
-        parsed_args.backup_dir.set_compression_mode(parsed_args.compression_mode)
+    if parsed_args.archive_format == "dedup":
+        parsed_args.file_name_template = apply_manifest_suffix(
+            parsed_args.file_name_template
+        )
+    elif parsed_args.archive_format == "tree":
+        parsed_args.file_name_template = replace_archive_suffix(
+            parsed_args.file_name_template, TREE_SUFFIX
+        )
+    else:
+        parsed_args.file_name_template = apply_compression_suffix(
+            parsed_args.file_name_template, parsed_args.compression_mode
+        )
+    parsed_args.backup_dir.set_compression_mode(
+        parsed_args.compression_mode, parsed_args.compression_level
+    )
 
     return parsed_args
 
 
-def make_dump_file_name(args: Namespace, wp_config: Dict, now: datetime) -> Location:
+def get_base_name(args: Namespace, wp_config: Dict) -> Text:
     """
-    Generates the location name where to dump the file
+    Base name of the snapshots of this website
     """
 
     if not args.snapshot_base_name:
-        base_name = wp_config["db_name"]
+        return wp_config["db_name"]
     else:
-        base_name = args.snapshot_base_name
+        return args.snapshot_base_name
+
 
+def make_dump_file_name(args: Namespace, wp_config: Dict, now: datetime) -> Location:
+    """
+    Generates the location name where to dump the file
+    """
+
+    base_name = get_base_name(args, wp_config)
     name = args.file_name_template.format(base=base_name, time=now.isoformat() + "Z")
 
     return args.backup_dir.child(name)
 
 
-def dump_settings(args: Namespace, wp_config: Dict, now: datetime, file_path: Text):
+def get_expected_size(args: Namespace, wp_config: Dict) -> Optional[int]:
+    """
+    Expected size of the archive, based on the previous one (to log an ETA)
+    """
+
+    if not Meter.enabled:
+        return None
+
+    return get_previous_snapshot_size(
+        args.backup_dir,
+        get_base_name(args, wp_config),
+        get_codec(args.compression_mode).suffix,
+    )
+
+
+def dump_settings(
+    args: Namespace,
+    wp_config: Dict,
+    now: datetime,
+    file_path: Text,
+    incremental: Optional[IncrementalPlan] = None,
+):
     """
     Given the settings and various environmental data, dump them in a JSON file
     which will be embedded in the archive and can be used to guess things when
     restoring the snapshot.
     """
 
-    args = dict(vars(args), source=f"{args.source}", backup_dir=f"{args.backup_dir}")
+    args = {k: f"{v}" if isinstance(v, Location) else v for k, v in vars(args).items()}
 
     content = {"args": args, "wp_config": wp_config, "time": now.isoformat() + "Z"}
 
+    if incremental:
+        content["incremental"] = {
+            "level": incremental.level,
+            "parent": incremental.parent,
+        }
+
     with open(file_path, "w", encoding="utf-8") as f:
         json.dump(content, f, indent=4)
 
 
+@contextmanager
+def open_tar_writer(
+    args: Namespace, wp_config: Dict, archive_location: Location
+) -> Iterator:
+    """
+    Opens the archive to write as a TarFile-like object (with an addfile()
+    method), indexed, split into volumes or as a single stream
+    """
+
+    if args.index:
+        with IndexedArchiveWriter(archive_location) as tar:
+            yield tar
+    elif args.volume_size:
+        with open_volumes_stream(
+            archive_location,
+            args.volume_size,
+            args.volume_jobs,
+            get_expected_size(args, wp_config),
+        ) as fp:
+            with tarfile.open(fileobj=fp, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                yield tar
+    else:
+        with archive_location.open_archive_stream(
+            doing, get_expected_size(args, wp_config)
+        ) as fp:
+            with tarfile.open(fileobj=fp, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                yield tar
+
+
+@contextmanager
+def open_archive_writer(
+    args: Namespace, wp_config: Dict, archive_location: Location
+) -> Iterator:
+    """
+    Same as open_tar_writer() but also computes the checksums of the files on
+    the fly if required. They are appended to the archive and written next to
+    it once the archive is complete.
+    """
+
+    checksums = None
+
+    with open_tar_writer(args, wp_config, archive_location) as tar:
+        if args.checksums:
+            checksums = ChecksumWriter(tar)
+
+        yield checksums or tar
+
+        if checksums:
+            checksums.close()
+
+    if checksums:
+        write_checksums(archive_location, checksums.checksums)
+        doing.logger.info("Wrote the checksums of %s files", len(checksums.checksums))
+
+
+# Written in the local dir by copy_database(), possibly while the files are
+# being sent, so they're added to the snapshots after the files
+DUMP_NAMES = ["dump.sql", DUMP_SHARDS_DIR]
+
+
+def write_streaming_archive(
+    args: Namespace,
+    wp_config: Dict,
+    now: datetime,
+    local_dir: Text,
+    files: Location,
+    wait_dump: Callable[[], Any],
+) -> Location:
+    """
+    Writes the archive directly at its final location: first the settings,
+    then the files which are streamed from the source (or the staging dir)
+    into the archive's wordpress directory and finally the dump, once
+    wait_dump() says that it's complete.
+    """
+
+    args.backup_dir.ensure_exists_as_dir()
+    archive_location = make_dump_file_name(args, wp_config, now)
+    local = parse_location(local_dir)
+
+    with open_archive_writer(args, wp_config, archive_location) as tar:
+        stream_files_to_archive(local, tar, ".", DUMP_NAMES, None)
+        stream_files_to_archive(
+            files, tar, "wordpress", args.exclude, args.exclude_tag_all
+        )
+        wait_dump()
+        stream_files_to_archive(local, tar, ".", ["settings.json"], None)
+
+    if args.volume_size:
+        return get_volumes_index(archive_location)
+
+    return archive_location
+
+
+def write_dedup_snapshot(
+    args: Namespace,
+    wp_config: Dict,
+    now: datetime,
+    local_dir: Text,
+    files: Location,
+    wait_dump: Callable[[], Any],
+) -> Location:
+    """
+    Writes the snapshot into the deduplicating store found in backup_dir:
+    the settings, the source files and then the dump (once wait_dump()
+    returns) are chunked and only the chunks which are not in the store yet
+    are uploaded.
+    """
+
+    args.backup_dir.ensure_exists_as_dir()
+    manifest_location = make_dump_file_name(args, wp_config, now)
+    local = parse_location(local_dir)
+
+    with StoreWriter(args.backup_dir, basename(manifest_location.path)) as store:
+        stream_files_to_archive(local, store, ".", DUMP_NAMES, None)
+        stream_files_to_archive(
+            files, store, "wordpress", args.exclude, args.exclude_tag_all
+        )
+        wait_dump()
+        stream_files_to_archive(local, store, ".", ["settings.json"], None)
+
+    doing.logger.info(
+        "Stored %s new chunks (%.1f MiB), reused %s chunks",
+        store.new_chunks,
+        store.new_bytes / 1024 ** 2,
+        store.reused_chunks,
+    )
+
+    return manifest_location
+
+
+def write_tree_snapshot(
+    args: Namespace,
+    wp_config: Dict,
+    now: datetime,
+    local_dir: Text,
+    files: Location,
+    wait_dump: Callable[[], Any],
+) -> Location:
+    """
+    Writes the snapshot as a directory of backup_dir. Files which didn't
+    change since the previous tree snapshot are hardlinked from it, so only
+    the changed files take space. The directory is written under a temporary
+    name and renamed once complete. The dump is copied last, once wait_dump()
+    returns.
+    """
+
+    args.backup_dir.ensure_exists_as_dir()
+    tree_location = make_dump_file_name(args, wp_config, now)
+    part = args.backup_dir.child(basename(tree_location.path) + ".part")
+    previous = find_previous_tree(
+        args.backup_dir, args.file_name_template, get_base_name(args, wp_config)
+    )
+
+    if previous:
+        doing.logger.info("Linking unchanged files to %s", previous)
+
+    local = parse_location(local_dir)
+
+    rsync_tree(local, part, previous, DUMP_NAMES)
+    rsync_tree(
+        files,
+        part.child("wordpress"),
+        previous.child("wordpress") if previous else None,
+        args.exclude,
+    )
+    wait_dump()
+    rsync_tree(local, part, previous, ["settings.json"])
+    commit_tree(part, tree_location)
+
+    return tree_location
+
+
+def copy_database(args: Namespace, wp_config: Dict, local_dir: Text):
+    """
+    Dumps the DB (and the sharded tables) into the local dir, streaming it
+    into another DB at the same time if required
+    """
+
+    pipe = None
+
+    if args.stream_db_to:
+        doing.logger.info("Preparing the DB to stream into")
+        pipe = open_dump_pipe(args.stream_db_to)
+
+    try:
+        db = create_from_source(wp_config, args.source, args.db_host)
+
+        if args.shard_table:
+            makedirs(join(local_dir, DUMP_SHARDS_DIR))
+            lock_time, shards = db.dump_with_shards(
+                join(local_dir, "dump.sql"),
+                join(local_dir, DUMP_SHARDS_DIR),
+                args.shard_table,
+                args.shards,
+                args.consistency,
+                not args.inconsistent_shards,
+            )
+
+            for table, paths in shards.items():
+                doing.logger.info("Dumped %s in %s shards", table, len(paths))
+        else:
+            lock_time = db.dump_to_file(
+                join(local_dir, "dump.sql"), None, args.consistency, pipe
+            )
+    except BaseException:
+        if pipe:
+            err = pipe.abort()
+            doing.logger.error(
+                "The dump failed, %s is only partially imported%s",
+                args.stream_db_to,
+                f": {err}" if err else "",
+            )
+
+        raise
+
+    doing.logger.info("Tables were locked for %.1fs", lock_time)
+
+    if pipe:
+        doing.logger.info("Finishing the DB import")
+        pipe.close()
+
+    if args.shard_table and args.inconsistent_shards:
+        doing.logger.warning(
+            "Sharded tables were dumped without lock and are not consistent "
+            "with the rest of the dump"
+        )
+
+
+def can_assemble_on_source(args: Namespace) -> bool:
+    """
+    Tells if the archive can be entirely built on the source's host, which is
+    the case when it was asked for, the backup dir is on the same host and no
+    option requires the dump or the files to go through here
+    """
+
+    return (
+        args.assemble_on_source
+        and isinstance(args.source, SshLocation)
+        and is_same_host(args.source, args.backup_dir)
+        and args.archive_format == "tar"
+        and not args.index
+        and not args.checksums
+        and not args.volume_size
+        and not args.incremental
+        and not args.stream_db_to
+        and not args.shard_table
+        and not args.staging_dir
+        and not args.bwlimit
+    )
+
+
+def assemble_archive_on_source(
+    args: Namespace, wp_config: Dict, now: datetime, local_dir: Text
+) -> Location:
+    """
+    Dumps the DB and writes the archive with a script running on the
+    source's host, see assemble_remote_archive()
+    """
+
+    args.backup_dir.ensure_exists_as_dir()
+    archive_location = make_dump_file_name(args, wp_config, now)
+    db = create_from_source(wp_config, args.source, args.db_host)
+
+    with open(join(local_dir, "settings.json"), "r", encoding="utf-8") as f:
+        settings = f.read()
+
+    assemble_remote_archive(
+        args.source,
+        archive_location,
+        settings,
+        db.make_dump_script("dump.sql", None, args.consistency),
+        get_compression_program(args.compression_mode, args.compression_level),
+        args.exclude,
+        args.exclude_tag_all,
+    )
+
+    return archive_location
+
+
+def write_snapshot_files(
+    args: Namespace,
+    wp_config: Dict,
+    now: datetime,
+    local_dir: Text,
+    files: Location,
+    wait_dump: Callable[[], Any] = lambda: None,
+) -> Optional[Location]:
+    """
+    Copies the files (from the source or the staging dir) into the snapshot,
+    according to the archive format. Returns the snapshot's location, or
+    None if the files were copied into the local dir and the archive remains
+    to be written.
+
+    If the dump is still being written into the local dir, wait_dump() must
+    block until it's complete (and raise if it failed).
+    """
+
+    snapshot_args = (args, wp_config, now, local_dir, files, wait_dump)
+
+    if args.archive_format == "dedup":
+        with doing("Copying files into the store"):
+            return write_dedup_snapshot(*snapshot_args)
+    elif args.archive_format == "tree":
+        with doing("Copying files into the snapshot tree"):
+            return write_tree_snapshot(*snapshot_args)
+    elif args.streaming:
+        with doing("Copying files into archive"):
+            return write_streaming_archive(*snapshot_args)
+    else:
+        with doing("Copying files"):
+            copy_files(
+                files,
+                parse_location(local_dir).child("wordpress"),
+                args.exclude,
+                args.exclude_tag_all,
+            )
+
+
 def main(args: Optional[Sequence[str]] = None):
     """
     Executes things in order
@@ -144,39 +799,148 @@ def main(args: Optional[Sequence[str]] = None):
     setup_logging()
     args = parse_args(args)
     now = datetime.utcnow()
+    start = monotonic()
+    Meter.enabled = not args.no_progress
+    Retry.attempts = args.retries
+    throttle = Throttle(args.nice, args.ionice, args.bwlimit)
+
+    if throttle:
+        with doing(f"Checking the limits of the source ({throttle})"):
+            check_throttle(args.source, throttle)
+            args.source = replace(args.source, throttle=throttle)
 
     with doing("Parsing remote configuration"):
         wp_config = parse_wp_config(args.source)
 
+    incremental = None
+
+    if args.incremental:
+        with doing("Reading the state of the incremental snapshots"):
+            incremental = plan_incremental(
+                args.backup_dir, get_base_name(args, wp_config), args.full_every
+            )
+            doing.logger.info("Next snapshot is of level %s", incremental.level)
+
     with TemporaryDirectory() as d:
         work_location = parse_location(d, args.compression_mode)
 
         with doing("Saving settings"):
-            dump_settings(args, wp_config, now, join(d, "settings.json"))
+            dump_settings(args, wp_config, now, join(d, "settings.json"), incremental)
+
+        if args.staging_dir:
+            with doing("Pre-syncing files into the staging dir"):
+                sync_staging_dir(args.source, args.staging_dir, args.exclude)
 
         if args.maintenance_mode is True:
             with doing("Activate maintenance mode"):
                 activate_maintenance_mode(args.source)
 
-        try:
-            with doing("Copying database"):
-                db = create_from_source(wp_config, args.source, args.db_host)
-                db.dump_to_file(join(d, "dump.sql"))
+        maintenance_start = monotonic()
+        archive_location = None
+        remote_assembly = can_assemble_on_source(args)
+
+        if args.assemble_on_source and not remote_assembly:
+            doing.logger.warning(
+                "The archive can't be assembled on the source's host with "
+                "these options, it is built locally"
+            )
 
-            with doing("Copying files"):
-                copy_files(args.source, work_location.child("wordpress"), args.exclude, args.exclude_tag_all)
+        try:
+            if remote_assembly:
+                with doing("Assembling the archive on the source's host"):
+                    archive_location = assemble_archive_on_source(
+                        args, wp_config, now, d
+                    )
+            elif args.staging_dir:
+                with doing("Copying database and syncing the staging dir"):
+                    run_concurrently(
+                        lambda: copy_database(args, wp_config, d),
+                        lambda: sync_staging_dir(
+                            args.source, args.staging_dir, args.exclude
+                        ),
+                    )
+            elif incremental:
+                with doing("Copying database and changed files"):
+                    _, snar = run_concurrently(
+                        lambda: copy_database(args, wp_config, d),
+                        lambda: dump_incremental_files(
+                            args.source,
+                            join(d, INCREMENTAL_FILES_NAME),
+                            incremental.snar,
+                            args.exclude,
+                            args.exclude_tag_all,
+                        ),
+                    )
+            elif args.archive_format == "tar" and not args.streaming:
+                with doing("Copying database and files"):
+                    run_concurrently(
+                        lambda: copy_database(args, wp_config, d),
+                        lambda: copy_files(
+                            args.source,
+                            work_location.child("wordpress"),
+                            args.exclude,
+                            args.exclude_tag_all,
+                        ),
+                    )
+            else:
+                # The dump is spooled into the local dir while the files are
+                # sent and appended to the snapshot after them
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    dump = pool.submit(copy_database, args, wp_config, d)
+                    archive_location = write_snapshot_files(
+                        args, wp_config, now, d, args.source, dump.result
+                    )
 
         finally:
             if args.maintenance_mode is True:
                 with doing("Deactivate maintenance mode"):
                     deactivate_maintenance_mode(args.source)
 
-        with doing("Writing archive"):
-            args.backup_dir.ensure_exists_as_dir()
-            archive_location = make_dump_file_name(args, wp_config, now)
-
-            archive_location.archive_local_dir(d, doing)
-            doing.logger.info("Wrote archive %s", archive_location)
+                doing.logger.info(
+                    "Website was in maintenance mode for %.1fs",
+                    monotonic() - maintenance_start,
+                )
+
+        if args.staging_dir:
+            archive_location = write_snapshot_files(
+                args, wp_config, now, d, args.staging_dir
+            )
+
+        if args.archive_format == "tar" and not args.streaming and not remote_assembly:
+            with doing("Writing archive"):
+                args.backup_dir.ensure_exists_as_dir()
+                archive_location = make_dump_file_name(args, wp_config, now)
+
+                if args.index or args.checksums:
+                    with open_archive_writer(args, wp_config, archive_location) as tar:
+                        stream_files_to_archive(work_location, tar, ".", None, None)
+                elif args.volume_size:
+                    archive_location = archive_dir_to_volumes(
+                        d,
+                        archive_location,
+                        args.volume_size,
+                        args.volume_jobs,
+                        get_expected_size(args, wp_config),
+                    )
+                else:
+                    archive_location.archive_local_dir(
+                        d, doing, get_expected_size(args, wp_config)
+                    )
+
+        if incremental:
+            with doing("Saving the state of the incremental snapshots"):
+                save_incremental_state(
+                    args.backup_dir,
+                    get_base_name(args, wp_config),
+                    incremental.level,
+                    archive_location,
+                    snar,
+                )
+
+        doing.logger.info("Wrote archive %s", archive_location)
+        doing.logger.info(
+            "Snapshot took %.1fs (source limits: %s)", monotonic() - start, throttle
+        )
 
     return archive_location
 
@@ -2,9 +2,9 @@ import json
 from argparse import ArgumentParser, ArgumentTypeError, Namespace
 from os.path import exists
 from tempfile import NamedTemporaryFile
-from typing import Optional, Sequence, Text
+from typing import List, Optional, Sequence, Text
 
-from luh3417.luhfs import parse_location
+from luh3417.luhfs import COMPRESSION_MODES, parse_location
 from luh3417.luhphp import parse_wp_config
 from luh3417.restore.__main__ import main as restore
 from luh3417.snapshot.__main__ import main as snapshot
@@ -62,6 +62,25 @@ def generator_validator(file_path: Text):
     return module
 
 
+def get_limit_args(gen, environment: Text) -> List[Text]:
+    """
+    Snapshot arguments limiting the impact on this environment, if the
+    generator defines limits for it
+    """
+
+    if not hasattr(gen, "get_snapshot_limits"):
+        return []
+
+    limits = gen.get_snapshot_limits(environment) or {}
+    out = []
+
+    for key in ["nice", "ionice", "bwlimit"]:
+        if limits.get(key) is not None:
+            out += [f"--{key}", f"{limits[key]}"]
+
+    return out
+
+
 def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
     """
     Parses args and validates the consistency of origin/target using the
@@ -81,6 +100,54 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
         required=True,
     )
 
+    parser.add_argument(
+        "-c",
+        "--compression-mode",
+        help="Compression mode of the snapshots (see snapshot). Defaults to: gzip",
+        default="gzip",
+        choices=COMPRESSION_MODES,
+    )
+
+    parser.add_argument(
+        "--compression-level",
+        help="Compression level of the snapshots",
+        type=int,
+    )
+
+    parser.add_argument(
+        "-d",
+        "--direct",
+        help=(
+            "Stream the origin's DB dump straight into the target's DB, patching "
+            "it on the fly, instead of restoring it from the archive afterwards. "
+            "The archive of the origin still contains the dump."
+        ),
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--no-progress",
+        help="Don't meter the data pipes nor log their throughput",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--retries",
+        help=(
+            "Number of times transfers of archives resume after a dropped "
+            "connection (see snapshot). Defaults to: 0"
+        ),
+        default=0,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--rsync-jobs",
+        help="Number of rsync syncing the files in parallel (see restore)",
+        default=1,
+        type=int,
+    )
+
     parser.add_argument("origin", help="Origin environment")
     parser.add_argument("target", help="Target environment")
 
@@ -113,12 +180,28 @@ def main(args: Optional[Sequence[str]] = None):
     args = parse_args(args)
 
     gen = args.settings_generator
+    snapshot_args = ["-c", args.compression_mode]
+
+    if args.compression_level is not None:
+        snapshot_args += ["--compression-level", f"{args.compression_level}"]
+
+    common_args = ["--retries", f"{args.retries}"]
+
+    if args.no_progress:
+        common_args.append("--no-progress")
+
+    snapshot_args += common_args
 
     origin_source = parse_location(gen.get_source(args.origin), args.compression_mode)
     origin_backup_dir = gen.get_backup_dir(args.origin)
 
-    with doing(f"Backing up {args.origin} to {origin_backup_dir}"):
-        origin_archive = snapshot([f"{origin_source}", origin_backup_dir])
+    if not args.direct:
+        with doing(f"Backing up {args.origin} to {origin_backup_dir}"):
+            origin_archive = snapshot(
+                [f"{origin_source}", origin_backup_dir]
+                + snapshot_args
+                + get_limit_args(gen, args.origin)
+            )
 
     target_backup_dir = gen.get_backup_dir(args.target)
     target_source = parse_location(gen.get_source(args.target), args.compression_mode)
@@ -128,7 +211,11 @@ def main(args: Optional[Sequence[str]] = None):
 
     if target_exists:
         with doing(f"Backing up {args.target} to {target_backup_dir}"):
-            snapshot([f"{target_source}", target_backup_dir])
+            snapshot(
+                [f"{target_source}", target_backup_dir]
+                + snapshot_args
+                + get_limit_args(gen, args.target)
+            )
 
     if target_exists:
         with doing(f"Reading wp_config from {args.target}"):
@@ -145,8 +232,35 @@ def main(args: Optional[Sequence[str]] = None):
         json.dump(patch, pf)
         pf.flush()
 
+        if args.direct:
+            with doing(
+                f"Backing up {args.origin} to {origin_backup_dir} while "
+                f"streaming its DB to {args.target}"
+            ):
+                origin_archive = snapshot(
+                    [
+                        f"{origin_source}",
+                        origin_backup_dir,
+                        "--stream-db-to",
+                        pf.name,
+                    ]
+                    + snapshot_args
+                    + get_limit_args(gen, args.origin)
+                )
+
         with doing(f"Overriding {args.target} with {args.origin}"):
-            restore(["-p", pf.name, f"{origin_archive}"])
+            restore_args = common_args + [
+                "--rsync-jobs",
+                f"{args.rsync_jobs}",
+                "-p",
+                pf.name,
+                f"{origin_archive}",
+            ]
+
+            if args.direct:
+                restore_args.insert(0, "--skip-db")
+
+            restore(restore_args)
 
     if hasattr(gen, "post_exec"):
         with doing("Running post-exec hook"):
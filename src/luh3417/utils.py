@@ -1,13 +1,18 @@
+import re
+from argparse import ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from importlib.util import module_from_spec, spec_from_file_location
 from logging import DEBUG, getLogger
 from random import SystemRandom
-from typing import Text
+from typing import Any, Callable, List, Text
 
 import coloredlogs
 
 random = SystemRandom()
 
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
 
 class LuhError(Exception):
     """
@@ -93,6 +98,50 @@ def random_password(
     return "".join(random.choice(chars) for _ in range(0, n))
 
 
+def parse_size(value: Text) -> int:
+    """
+    Parses a size in bytes like `500K`, `10M` or `1G` (argparse type)
+    """
+
+    m = re.match(r"^(\d+(?:\.\d+)?)([kmg]?)(?:i?b)?$", value.strip().lower())
+
+    if not m or not float(m.group(1)):
+        raise ArgumentTypeError(f'"{value}" is not a valid size (like 500K or 10M)')
+
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2)])
+
+
+def run_concurrently(*tasks: Callable[[], Any]) -> List[Any]:
+    """
+    Runs the tasks in threads and waits for all of them. Returns their
+    results in order. If some tasks fail, a single LuhError reporting all
+    their errors is raised (once all tasks are finished). Unexpected errors
+    are reported too and the first one is chained to it, so that its
+    traceback isn't lost.
+    """
+
+    with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        futures = [pool.submit(task) for task in tasks]
+
+    results = []
+    errors = []
+    unexpected = None
+
+    for future in futures:
+        try:
+            results.append(future.result())
+        except LuhError as e:
+            errors.append(e.message)
+        except BaseException as e:
+            errors.append(f"Unexpected error: {e!r}")
+            unexpected = unexpected or e
+
+    if errors:
+        raise LuhError("\n".join(errors)) from unexpected
+
+    return results
+
+
 def run_main(main, doing):
     """
     Runs a main() function while taking care to catch the appropriate
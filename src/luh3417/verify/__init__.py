@@ -0,0 +1,50 @@
+from dataclasses import dataclass, field
+from typing import List, Text
+
+from luh3417.luhchecksum import hash_archive, read_checksums
+from luh3417.luhfs import Location
+
+
+@dataclass
+class Verification:
+    """
+    Outcome of the verification of an archive
+    """
+
+    archive: Location
+    files: int = 0
+    problems: List[Text] = field(default_factory=list)
+
+
+def verify_archive(archive: Location) -> Verification:
+    """
+    Re-hashes the files of the archive and compares them with the checksums
+    written when the archive was created (next to it, or inside of it if the
+    file next to it is missing).
+    """
+
+    result = Verification(archive)
+    sidecar = read_checksums(archive)
+    checksums, embedded = hash_archive(archive)
+    expected = sidecar if sidecar is not None else embedded
+    result.files = len(checksums)
+
+    if expected is None:
+        result.problems.append("no checksums found, inside or next to the archive")
+        return result
+
+    if sidecar is not None and embedded is not None and sidecar != embedded:
+        result.problems.append(
+            "checksums next to the archive differ from the ones inside of it"
+        )
+
+    for name, digest in expected.items():
+        if name not in checksums:
+            result.problems.append(f"{name}: missing")
+        elif checksums[name] != digest:
+            result.problems.append(f"{name}: checksum mismatch")
+
+    for name in sorted(checksums.keys() - expected.keys()):
+        result.problems.append(f"{name}: not in the checksums")
+
+    return result
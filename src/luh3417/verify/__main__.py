@@ -0,0 +1,88 @@
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence
+
+from luh3417.luhfs import parse_location
+from luh3417.utils import LuhError, make_doer, run_main, setup_logging
+from luh3417.verify import Verification, verify_archive
+
+doing = make_doer("luh3417.verify")
+
+
+def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
+    """
+    Parse arguments for the verification
+    """
+
+    parser = ArgumentParser(
+        prog="python -m luh3417.verify",
+        description=(
+            "Checks the integrity of snapshot archives written with "
+            "--checksums, without extracting them. Remote archives are "
+            "hashed on their own host when it has python3."
+        ),
+    )
+
+    parser.add_argument(
+        "archive", help="Archive to verify", type=parse_location, nargs="+"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of archives verified in parallel. Defaults to: 4",
+        default=4,
+        type=int,
+    )
+
+    parsed_args = parser.parse_args(args)
+
+    if parsed_args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    return parsed_args
+
+
+def verify(archive) -> Verification:
+    """
+    Verifies an archive, turning errors (unreadable archive, ...) into
+    problems of that archive so that the other ones are still verified
+    """
+
+    try:
+        result = verify_archive(archive)
+    except LuhError as e:
+        result = Verification(archive, problems=[e.message])
+
+    if result.problems:
+        for problem in result.problems:
+            doing.logger.error("%s: %s", archive, problem)
+    else:
+        doing.logger.info("%s: OK (%s files)", archive, result.files)
+
+    return result
+
+
+def main(args: Optional[Sequence[str]] = None) -> List[Verification]:
+    """
+    Verifies all the archives
+    """
+
+    setup_logging()
+    args = parse_args(args)
+
+    with doing(f"Verifying {len(args.archive)} archive(s)"):
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(verify, args.archive))
+
+        failed = [r for r in results if r.problems]
+
+        if failed:
+            raise LuhError(
+                f"{len(failed)} of {len(results)} archive(s) failed verification"
+            )
+
+    return results
+
+
+if __name__ == "__main__":
+    run_main(main, doing)